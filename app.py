@@ -2,8 +2,10 @@
 
 import logging
 import sys
-from flask import Flask
-from hooli_colab import app, db
+from hooli_colab import create_app, db
+from hooli_colab.schema import upgrade_schema
+
+app = create_app()
 
 # Configure logging
 handler = logging.StreamHandler(sys.stderr)
@@ -19,5 +21,5 @@ app.logger.setLevel(logging.INFO)
 
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
+        upgrade_schema(db)
     app.run(host="0.0.0.0", port=5002, debug=True)
@@ -0,0 +1,9 @@
+# driver program for the hooli streaming sidecar, see hooli_colab/streaming.py
+#
+#   uvicorn asgi:application --root-path /hooli --port 5003
+#
+# and have the web server send /hooli/download/ there, everything else to hooli.wsgi
+
+from hooli_colab.streaming import create_streaming_app
+
+application = create_streaming_app()
@@ -0,0 +1,129 @@
+""" benchmark: like/rating throughput, direct commits vs the write-behind buffer
+
+    python benchmarks/bench_engagement.py [--events 5000] [--threads 8]
+
+"accepted/s" is how fast requests can hand events off (what a user waits on),
+"committed/s" includes the final flush.  Runs against scratch sqlite files,
+not the real media.db.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from hooli_colab import db, default_config
+from hooli_colab.charts import register_chart_functions
+from hooli_colab.engagement import LIKE, RATING, APPLY, EngagementBuffer
+
+
+def make_app(path):
+    """a bare app using the hooli models against a scratch database"""
+    app = Flask("bench")
+    uri = f"sqlite:///{path}"
+    app.config["SQLALCHEMY_DATABASE_URI"] = uri
+    app.config["SQLALCHEMY_BINDS"] = {"social": uri, "users": uri}
+    # likes and ratings also update the charts
+    defaults = default_config()
+    for key in ("CHART_HALF_LIFE_DAYS", "CHART_TRENDING_WEIGHTS", "CHART_MIN_VOTES"):
+        app.config[key] = defaults[key]
+    db.init_app(app)
+    with app.app_context():
+        register_chart_functions(db)
+        db.create_all()
+    return app
+
+
+def make_events(count, users=200, files=50, seed=1):
+    """a release-day burst: lots of users liking and rating a few files"""
+    rng = random.Random(seed)
+    events = []
+    for _ in range(count):
+        if rng.random() < 0.6:
+            events.append((LIKE, rng.randint(1, users), rng.randint(1, files), rng.random() < 0.8))
+        else:
+            events.append((RATING, rng.randint(1, users), rng.randint(1, files), rng.randint(1, 5)))
+    return events
+
+
+def run_threads(events, threads, worker):
+    chunks = [events[i::threads] for i in range(threads)]
+    pool = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def bench_direct(app, events, threads):
+    def worker(chunk):
+        with app.app_context():
+            for kind, user_id, file_id, value in chunk:
+                APPLY[kind](user_id, file_id, value, "127.0.0.1")
+                db.session.commit()
+
+    elapsed = run_threads(events, threads, worker)
+    return elapsed, elapsed, len(events)
+
+
+def bench_write_behind(app, events, threads, flush_ms, journal_dir):
+    buffer = EngagementBuffer(app, flush_interval=flush_ms / 1000, journal_dir=journal_dir)
+    transactions = []
+    original_flush = buffer.flush
+
+    def counting_flush():
+        written = original_flush()
+        if written:
+            transactions.append(written)
+        return written
+
+    buffer.flush = counting_flush
+
+    def worker(chunk):
+        for kind, user_id, file_id, value in chunk:
+            buffer.add(kind, user_id, file_id, value, "127.0.0.1")
+
+    accepted = run_threads(events, threads, worker)
+    start = time.perf_counter()
+    buffer.flush()
+    return accepted, accepted + time.perf_counter() - start, len(transactions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--flush-ms", type=int, default=250)
+    args = parser.parse_args()
+
+    events = make_events(args.events)
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = [
+            ("direct", lambda app: bench_direct(app, events, args.threads)),
+            ("write-behind", lambda app: bench_write_behind(
+                app, events, args.threads, args.flush_ms, None)),
+            ("write-behind+journal", lambda app: bench_write_behind(
+                app, events, args.threads, args.flush_ms, os.path.join(tmp, "journal"))),
+        ]
+        print(f"{args.events} events from {args.threads} threads")
+        print(f"{'':>22}  {'accepted/s':>10}  {'committed/s':>11}  transactions")
+        for name, case in cases:
+            app = make_app(os.path.join(tmp, f"{name}.db"))
+            accepted, committed, transactions = case(app)
+            print(
+                f"{name:>22}  {args.events / accepted:10.0f}  {args.events / committed:11.0f}"
+                f"  {transactions}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+""" benchmark: browse.html compile and render cost
+
+    python benchmarks/bench_render.py [--rows 10 1000 10000] [--repeat 5]
+
+Times compiling the template from source, loading it from the bytecode cache
+(what a fresh wsgi worker pays with JINJA_BYTECODE_CACHE_DIR set), and
+rendering listings of each size, reported as time per row.  The rows are
+plain objects, so this measures the template and not the database.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for name in ("APP_SECRET_KEY", "SECURITY_PASSWORD_SALT", "SENDGRID_KEY", "DEFAULT_SENDER"):
+    os.environ.setdefault(name, "bench")
+
+from flask import render_template
+from jinja2 import FileSystemBytecodeCache
+
+from hooli_colab import create_app
+from hooli_colab.doodads import rating_to_stars
+
+TEMPLATE = "browse.html"
+# what browse.html extends and imports, compiled along with it
+TEMPLATES = (TEMPLATE, "base.html", "heart_icon_macro.html")
+
+
+def make_rows(count, seed=1):
+    """listing rows shaped like the ones browse_media builds"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        average = round(rng.uniform(0, 5), 2)
+        media_file = SimpleNamespace(
+            id=i + 1,
+            filepath=f"bench/album/track{i}.wav",
+            filename=f"track{i}.wav",
+            filetype="wav",
+            title=f"Track {i}" if rng.random() < 0.7 else None,
+            comments=[None] * rng.randint(0, 3),
+            gain_db=round(rng.uniform(-8, 3), 2),
+        )
+        rows.append(
+            {
+                "media_file": media_file,
+                "average_stars": average,
+                "number_of_ratings": rng.randint(0, 50),
+                "liked": rng.random() < 0.3,
+                "unicode_stars": rating_to_stars(average),
+            }
+        )
+    return rows
+
+
+def time_load(env, repeat):
+    """best time to get the templates with an empty in-memory template cache"""
+    best = float("inf")
+    for _ in range(repeat):
+        env.cache.clear()
+        start = time.perf_counter()
+        for name in TEMPLATES:
+            env.get_template(name)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    env = app.jinja_env
+    configured_cache = env.bytecode_cache
+    directory = SimpleNamespace(id=1, dirpath="bench/album", title="Bench")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env.bytecode_cache = None
+        compile_time = time_load(env, args.repeat)
+        env.bytecode_cache = FileSystemBytecodeCache(tmp)
+        time_load(env, 1)  # writes the cache
+        cached_time = time_load(env, args.repeat)
+        env.bytecode_cache = configured_cache
+
+    print(f"{', '.join(TEMPLATES)}, best of {args.repeat}")
+    print(f"  compile from source   {compile_time * 1000:8.2f} ms")
+    print(f"  load from bytecode    {cached_time * 1000:8.2f} ms")
+    print()
+    print(f"{'rows':>8}  {'render ms':>10}  {'us/row':>8}")
+    with app.test_request_context("/bench/album"):
+        render_template(TEMPLATE, directory=directory, media_files=make_rows(1), path="")
+        for count in args.rows:
+            rows = make_rows(count)
+            best = float("inf")
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                render_template(TEMPLATE, directory=directory, media_files=rows, path="")
+                best = min(best, time.perf_counter() - start)
+            print(f"{count:8d}  {best * 1000:10.2f}  {best / count * 1e6:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+""" benchmark: how long a fresh process takes to import hooli_colab and build the app
+
+    python benchmarks/bench_startup.py [--repeat 5] [--top 15]
+
+Each step runs in a new interpreter so nothing is already imported: "import"
+is "import hooli_colab", "create_app" adds building the app the way
+hooli.wsgi does, and "first request" adds rendering the browse page through
+the test client.  Then -X importtime is used to list the modules that take
+longest to import, to see what to make lazy next.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# what each step runs, printing how long it took in seconds
+STEPS = {
+    "import": """
+import time
+start = time.perf_counter()
+import hooli_colab
+print(time.perf_counter() - start)
+""",
+    "create_app": """
+import time
+start = time.perf_counter()
+from hooli_colab import create_app
+create_app({"JINJA_BYTECODE_CACHE_DIR": None})
+print(time.perf_counter() - start)
+""",
+    "first request": """
+import time
+start = time.perf_counter()
+from hooli_colab import create_app
+app = create_app({"JINJA_BYTECODE_CACHE_DIR": None, "SECRET_KEY": "bench"})
+app.test_client().get("/")
+print(time.perf_counter() - start)
+""",
+}
+
+
+def run(code, *flags):
+    """run code in a fresh interpreter from the repo root, returning (stdout, stderr)"""
+    result = subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout, result.stderr
+
+
+def slowest_imports(top):
+    """the modules with the largest cumulative import time under "import hooli_colab" """
+    _, stderr = run("import hooli_colab", "-X", "importtime")
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times.append((int(cumulative), name.rstrip()))
+    # top level packages only, their children are included in their time
+    times = [(us, name) for us, name in times if not name.startswith("    ")]
+    return sorted(times, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    print(f"{'step':<14}  {'median ms':>10}  {'min ms':>8}")
+    for step, code in STEPS.items():
+        runs = [float(run(code)[0]) for _ in range(args.repeat)]
+        print(f"{step:<14}  {statistics.median(runs) * 1000:10.1f}  {min(runs) * 1000:8.1f}")
+
+    print()
+    print("slowest imports under import hooli_colab")
+    for us, name in slowest_imports(args.top):
+        print(f"  {us / 1000:8.1f} ms  {name.strip()}")
+
+
+if __name__ == "__main__":
+    main()
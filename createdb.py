@@ -1,7 +1,9 @@
-# oneshot to create any missing database tables.
-from hooli_colab import app, db
-from hooli_colab.models import MediaFile
+# oneshot to create any missing database tables, columns and indexes.
+from hooli_colab import create_app, db
+from hooli_colab.schema import upgrade_schema
+
+app = create_app()
 
 with app.app_context():
-    # Recreate the table
-    db.create_all()
+    for change in upgrade_schema(db):
+        print(change)
@@ -11,12 +11,14 @@ Modules and Packages:
 - hooli_colab.email: Module for sending emails asynchronously.
 - hooli_colab.models: Database models for the application.
 - hooli_colab.routes: URL routes for the application.
+- hooli_colab.commands: Command line tools (flask --app hooli_colab index, etc).
 
 Configuration:
 - MEDIA_ROOT: Path to the media directory.
 - APPLICATION_ROOT: URL prefix for the application.  We are rooted here even if we reference /,
     /login, /logout, etc.
 - SQLALCHEMY_DATABASE_URI: URI for the SQLite database.
+- SQLALCHEMY_BINDS: Database URIs for the "social" and "users" tables, default media.db.
 - SQLALCHEMY_TRACK_MODIFICATIONS: Flag to disable modification tracking.
 - SECRET_KEY: Secret key for session management and flashing messages.
 - SECURITY_REGISTERABLE: Flag to enable user registration.
@@ -40,101 +42,408 @@ Configuration:
 - SECURITY_SEND_PASSWORD_RESET_NOTICE_WITH_MESSAGE: Flag to send password reset notice with message.
 - SECURITY_SEND_CONFIRMATION_EMAIL: Flag to send confirmation email.
 - SECURITY_SEND_LOGIN_EMAIL: Flag to send login email.
+- CACHE_CONTROL_POLICIES: Cache-Control values for media and static responses, by content type.
+- ENGAGEMENT_WRITE_BEHIND: Buffer likes and ratings and commit them in batches.
+- ENGAGEMENT_FLUSH_MS: How often the write-behind buffer is committed.
+- ENGAGEMENT_MAX_PENDING: Commit early once this many events are buffered.
+- ENGAGEMENT_JOURNAL_DIR: Where buffered events are journaled for crash recovery, None for no journal.
+- ENGAGEMENT_JOURNAL_FSYNC: fsync the journal on every event.
+- RECOMMENDER_TOP_K: Similar tracks the recommender keeps per track.
+- RECOMMENDATIONS_SHOWN: Similar tracks view_media shows.
+- CHART_HALF_LIFE_DAYS: How fast activity fades from the trending chart.
+- CHART_TRENDING_WEIGHTS: How much a like, a rating, a comment and a play count towards trending.
+- CHART_MIN_VOTES: Prior votes at the library mean for the Bayesian top rated chart.
+- CHART_LENGTH: Entries shown per chart.
+- ANALYSIS_WORKERS: Processes for background loudness analysis.
+- LOUDNESS_TARGET_LUFS: Loudness the player's per-track gain aims for.
+- LOUDNESS_PEAK_CEILING_DBFS: The gain never pushes a track's peak above this.
+- EVENTS_BUFFER_SIZE: Live update events kept for clients that reconnect.
+- EVENTS_MAX_SUBSCRIBERS: Live update streams allowed open at once, per process.
+- EVENTS_HEARTBEAT_SECONDS: Quiet time after which a stream sends a keepalive.
+- JINJA_BYTECODE_CACHE_DIR: Where compiled templates are cached on disk, None to not cache.
+- BULK_EDIT_MAX_FILES: Most media files one bulk metadata edit may change.
+- SLUG_REFRESH_SECONDS: How often each process checks whether its in-memory URL map is stale.
+- BACKUP_DIR: Where database snapshots are kept.
+- BACKUP_INTERVAL_HOURS: How often the app takes a snapshot itself, None for only "flask backup".
+- BACKUP_KEEP_LAST: Newest snapshots kept when rotating.
+- BACKUP_KEEP_DAILY: Days for which the newest snapshot of the day is also kept.
+- BACKUP_PAGES_PER_STEP: Database pages copied per backup step; each step briefly holds off writers.
+- BACKUP_STEP_PAUSE: Seconds a backup sleeps between steps so writers get in.
+- RATE_LIMITS: Token buckets per endpoint, {"user": (burst, seconds), "ip": (burst, seconds)}.
+- RATE_LIMIT_STORE: "memory" for per-process buckets, or a SQLite file path the workers share.
+- RATE_LIMIT_MAX_KEYS: Buckets kept by the "memory" store.
+- UPLOAD_STAGING_DIR: Where chunked uploads are put together, None for .uploads in MEDIA_ROOT.
+- UPLOAD_EXTENSIONS: File types that can be uploaded.
+- UPLOAD_MAX_BYTES: Largest file that can be uploaded.
+- UPLOAD_CHUNK_BYTES: Largest chunk of an upload one request may carry.
+- UPLOAD_STALE_HOURS: Unfinished uploads untouched this long are deleted.
+- LIBRARY_PAGE_SIZE: Entries per page of a user's library.
+- LIBRARY_MAX_PAGE_SIZE: Most entries /api/library returns at once.
+- COMMENTS_PAGE_SIZE: Comments view_media shows at first, and per "more comments".
+- COMMENTS_MAX_PAGE_SIZE: Most comments /api/comments returns at once.
+- MEDIA_ROOT_TIER: Whether MEDIA_ROOT is "fast" or "slow" storage.
+- STORAGE_ROOTS: More places media files can live, name -> {"path", "tier", "max_bytes"}.
+- STORAGE_PROMOTE_HEAT: Files at least this hot are moved onto the fast roots.
+- STORAGE_DEMOTE_HEAT: Files on the fast roots that cool below this are moved off.
+- STORAGE_MOVES_PER_PASS: Most files one rebalance moves.
+- STORAGE_MOVE_INTERVAL_MINUTES: Rebalance storage this often in the background, None for never.
+- STORAGE_MOVE_GRACE_SECONDS: How long a moved file's old copy is kept before it's deleted.
+- STORAGE_RESERVE_BYTES: Free space a move must leave on the destination.
+- STREAM_MAX_CONCURRENT: Most downloads the streaming sidecar serves at once.
+- STREAM_CHUNK_BYTES: Bytes the streaming sidecar reads and sends at a time.
+- STREAM_READ_THREADS: Threads the streaming sidecar reads files on.
+- STREAM_REQUIRE_LOGIN: The streaming sidecar refuses downloads without a logged-in session.
+- LOG_LEVEL: Level of the app logger, whose records go to stderr as JSON lines.
+- LOG_REQUESTS: Log every request with its id, route, user, status and duration.
+- LOG_SAMPLE_RATES: Event -> fraction of its INFO records kept, e.g. {"request": 0.1}.
+- PLAYS_LOG_DIR: Where plays are logged until they're rolled up, None to not count plays.
+- PLAYS_SEGMENT_SECONDS: How long each process appends to one play log file before starting another.
+- PLAYS_ROLLUP_INTERVAL_MINUTES: Roll up the play log this often in the background, None for never.
 
 Initialization:
-- Flask app instance.
-- Flask-Mail instance.
-- SQLAlchemy instance.
-- Flask-Security instance with custom forms and email task.
+- create_app(config) builds a Flask app; config overrides the defaults below.
+- The SQLAlchemy, Flask-Mail, Flask-Security and CSRF extensions are created
+    unbound here and set up on each app by create_app.
+- APP_SECRET_KEY, SECURITY_PASSWORD_SALT, SENDGRID_KEY and DEFAULT_SENDER come
+    from the environment (or .env).  Offline tools (createdb.py, the flask
+    commands, the benchmarks) run without them, with a throwaway SECRET_KEY;
+    serving pages needs the first two and sending email the last two.
+- Importing hooli_colab doesn't import the heavy optional pieces (sendgrid,
+    numpy/scipy for the recommender and loudness analysis); they're imported
+    the first time they're used.
+- hooli_colab.app is a default app built with create_app() the first time it's
+    asked for, for "flask --app hooli_colab" and older scripts.
 """
 
 import os
+import secrets
+import threading
+
 from dotenv import load_dotenv
 from flask import Flask
+from jinja2 import FileSystemBytecodeCache
 
-from flask_mail import Mail, Message
+from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy
 from flask_security import Security, SQLAlchemyUserDatastore
-from hooli_colab.forms import CustomLoginForm, ExtendedRegisterForm
-from hooli_colab.email import send_mail_task
+from flask_wtf.csrf import CSRFProtect
 
 load_dotenv()
 
-app = Flask(__name__)
-
 mode = "dev"
 
-# Configuration
 MEDIA_ROOT = "/var/www/anodynename.com/public_html/hooli"
-app.config["APPLICATION_ROOT"] = "/hooli"
-#app.config["APPLICATION_ROOT"] = "/"
-
-if mode == "dev":
-    app.config["SESSION_COOKIE_PATH"] = "/"
-else:
-    app.config["SESSION_COOKIE_PATH"] = "/hooli"
-
-app.config["MYAPP_NAME"] = "Hooli Colab"
-app.config["MEDIA_ROOT"] = MEDIA_ROOT
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:////var/www/hooli_colab/media.db"
-# app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hooli.db'
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-
-app.secret_key = os.environ['APP_SECRET_KEY']  # Required for flashing messages
-
-app.config["SECURITY_REGISTERABLE"] = True  # Required for registering users
-app.config["SECURITY_PASSWORD_SALT"] = os.environ['SECURITY_PASSWORD_SALT']
-app.config["SECURITY_POST_LOGIN_VIEW"] = "/login"
-app.config["SECURITY_POST_LOGOUT_VIEW"] = "/logout"
-
-sendgrid_key = os.environ['SENDGRID_KEY']
-default_sender = os.environ['DEFAULT_SENDER']
-
-app.config["MAIL_SERVER"] = "smtp.sendgrid.net"
-app.config["MAIL_PORT"] = 587
-app.config["MAIL_USE_TLS"] = True
-app.config["MAIL_USERNAME"] = "apikey"
-app.config["MAIL_PASSWORD"] = sendgrid_key
-app.config["MAIL_DEFAULT_SENDER"] = default_sender
-
-app.config["SENDGRID_API_KEY"] = sendgrid_key
-
-app.config["SECURITY_EMAIL_SENDER"] = default_sender
-app.config["SECURITY_EMAIL_SUBJECT_REGISTER"] = "Welcome to Hooli Colab!"
-app.config["SECURITY_EMAIL_SUBJECT_PASSWORD_RESET"] = "Password reset instructions"
-app.config["SECURITY_SEND_REGISTER_EMAIL"] = True
-app.config["SECURITY_SEND_PASSWORD_CHANGE_EMAIL"] = True
-app.config["SECURITY_SEND_PASSWORD_RESET_NOTICE_EMAIL"] = True
-app.config["SECURITY_SEND_PASSWORD_RESET_EMAIL"] = True
-app.config["SECURITY_SEND_PASSWORD_RESET_NOTICE_WITH_MESSAGE"] = True
-app.config["SECURITY_SEND_CONFIRMATION_EMAIL"] = True
-app.config["SECURITY_SEND_LOGIN_EMAIL"] = True
-
-# Add CSRF configuration
-app.config["WTF_CSRF_ENABLED"] = True
-
-# secret key is taken from app.secret_key if not set here
-#app.config["WTF_CSRF_SECRET_KEY"]='xxx'
-
-app.config["SESSION_PROTECTION"] = "strong"
-app.config["PERMANENT_SESSION_LIFETIME"] = 1800
-
-mail = Mail(app)
-db = SQLAlchemy(app)
-
-# Import models and routes after initializing db
-from hooli_colab import models, routes
-from hooli_colab.models import User, Role
 
+mail = Mail()
+db = SQLAlchemy()
+csrf = CSRFProtect()
+security = Security()
+
+# models need db, so they're imported after it
+from hooli_colab.models import User, Role
 
 # Setup the user data store with SQLAlchemy, using the User and Role models
 user_datastore = SQLAlchemyUserDatastore(db, User, Role)
 
-# Initialize Flask-Security with the app, user data store, and custom forms and email task
-security = Security(
-    app,
-    user_datastore,
-    login_form=CustomLoginForm,
-    register_form=ExtendedRegisterForm,
-    send_mail_task=send_mail_task,
-)
+
+def default_config():
+    """
+    Return the configuration create_app starts from.
+
+    Returns:
+        dict: Config keys and values, see the list at the top of this module.
+    """
+    config = {}
+    config["APPLICATION_ROOT"] = "/hooli"
+    #config["APPLICATION_ROOT"] = "/"
+
+    if mode == "dev":
+        config["SESSION_COOKIE_PATH"] = "/"
+    else:
+        config["SESSION_COOKIE_PATH"] = "/hooli"
+
+    config["MYAPP_NAME"] = "Hooli Colab"
+    config["MEDIA_ROOT"] = MEDIA_ROOT
+    config["SQLALCHEMY_DATABASE_URI"] = "sqlite:////var/www/hooli_colab/media.db"
+    # config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hooli.db'
+    config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    config["SECRET_KEY"] = os.environ.get("APP_SECRET_KEY")  # Required for flashing messages
+
+    config["SECURITY_REGISTERABLE"] = True  # Required for registering users
+    config["SECURITY_PASSWORD_SALT"] = os.environ.get("SECURITY_PASSWORD_SALT")
+    config["SECURITY_POST_LOGIN_VIEW"] = "/login"
+    config["SECURITY_POST_LOGOUT_VIEW"] = "/logout"
+
+    sendgrid_key = os.environ.get("SENDGRID_KEY")
+    default_sender = os.environ.get("DEFAULT_SENDER")
+
+    config["MAIL_SERVER"] = "smtp.sendgrid.net"
+    config["MAIL_PORT"] = 587
+    config["MAIL_USE_TLS"] = True
+    config["MAIL_USERNAME"] = "apikey"
+    config["MAIL_PASSWORD"] = sendgrid_key
+    config["MAIL_DEFAULT_SENDER"] = default_sender
+
+    config["SENDGRID_API_KEY"] = sendgrid_key
+
+    config["SECURITY_EMAIL_SENDER"] = default_sender
+    config["SECURITY_EMAIL_SUBJECT_REGISTER"] = "Welcome to Hooli Colab!"
+    config["SECURITY_EMAIL_SUBJECT_PASSWORD_RESET"] = "Password reset instructions"
+    config["SECURITY_SEND_REGISTER_EMAIL"] = True
+    config["SECURITY_SEND_PASSWORD_CHANGE_EMAIL"] = True
+    config["SECURITY_SEND_PASSWORD_RESET_NOTICE_EMAIL"] = True
+    config["SECURITY_SEND_PASSWORD_RESET_EMAIL"] = True
+    config["SECURITY_SEND_PASSWORD_RESET_NOTICE_WITH_MESSAGE"] = True
+    config["SECURITY_SEND_CONFIRMATION_EMAIL"] = True
+    config["SECURITY_SEND_LOGIN_EMAIL"] = True
+
+    # Add CSRF configuration
+    config["WTF_CSRF_ENABLED"] = True
+
+    # secret key is taken from SECRET_KEY if not set here
+    #config["WTF_CSRF_SECRET_KEY"]='xxx'
+
+    # Cache-Control by mimetype major type; "versioned" is for static urls that
+    # carry a ?v=<content hash> so they can be cached forever
+    config["CACHE_CONTROL_POLICIES"] = {
+        "audio": "public, max-age=604800",
+        "video": "public, max-age=604800",
+        "image": "public, max-age=604800",
+        "default": "public, max-age=3600",
+        "versioned": "public, max-age=31536000, immutable",
+    }
+
+    # write-behind for likes and ratings, see hooli_colab/engagement.py
+    config["ENGAGEMENT_WRITE_BEHIND"] = False
+    config["ENGAGEMENT_FLUSH_MS"] = 250
+    config["ENGAGEMENT_MAX_PENDING"] = 5000
+    config["ENGAGEMENT_JOURNAL_DIR"] = None  # e.g. "/var/www/hooli_colab/journal"
+    config["ENGAGEMENT_JOURNAL_FSYNC"] = False
+
+    # "more like this": neighbors kept per track by the recommender job, and how
+    # many of them view_media shows
+    config["RECOMMENDER_TOP_K"] = 20
+    config["RECOMMENDATIONS_SHOWN"] = 8
+
+    # charts, see hooli_colab/charts.py; run "flask rebuild-charts" after
+    # changing the half-life or the weights
+    config["CHART_HALF_LIFE_DAYS"] = 7
+    config["CHART_TRENDING_WEIGHTS"] = {"like": 1.0, "rating": 1.0, "comment": 2.0, "play": 0.2}
+    config["CHART_MIN_VOTES"] = 5
+    config["CHART_LENGTH"] = 50
+
+    # loudness analysis, see hooli_colab/analysis.py; run "flask analyze --regain"
+    # after changing the target or the ceiling
+    config["ANALYSIS_WORKERS"] = 2
+    config["LOUDNESS_TARGET_LUFS"] = -16.0
+    config["LOUDNESS_PEAK_CEILING_DBFS"] = -1.0
+
+    # live count updates over server-sent events, see hooli_colab/events.py.  each
+    # open stream holds a server thread, so keep EVENTS_MAX_SUBSCRIBERS well under
+    # the number of threads the wsgi server has
+    config["EVENTS_BUFFER_SIZE"] = 1000
+    config["EVENTS_MAX_SUBSCRIBERS"] = 50
+    config["EVENTS_HEARTBEAT_SECONDS"] = 15
+
+    # compiled templates are kept on disk so a fresh wsgi worker loads them
+    # instead of compiling them again.  entries are keyed by the template
+    # source's checksum, so edits never serve stale code
+    config["JINJA_BYTECODE_CACHE_DIR"] = "/var/www/hooli_colab/jinja_cache"
+
+    # most files the bulk metadata editor takes at once, see hooli_colab/bulkedit.py
+    config["BULK_EDIT_MAX_FILES"] = 1000
+
+    # directory and file URLs are resolved from an in-memory map, see
+    # hooli_colab/slugs.py; the indexer running elsewhere shows up this late
+    config["SLUG_REFRESH_SECONDS"] = 5
+
+    # online snapshots of every database file, see hooli_colab/backup.py
+    config["BACKUP_DIR"] = "/var/www/hooli_colab/backups"
+    config["BACKUP_INTERVAL_HOURS"] = None  # e.g. 6, or run "flask backup" from cron
+    config["BACKUP_KEEP_LAST"] = 7
+    config["BACKUP_KEEP_DAILY"] = 14
+    config["BACKUP_PAGES_PER_STEP"] = 256
+    config["BACKUP_STEP_PAUSE"] = 0.01
+
+    # rate limits, see hooli_colab/ratelimit.py.  (burst, seconds): up to burst
+    # requests at once, refilling at burst per seconds.  with more than one
+    # worker process set RATE_LIMIT_STORE to a file, e.g.
+    # "/var/www/hooli_colab/ratelimit.db", or each worker gets its own buckets
+    config["RATE_LIMITS"] = {
+        "hooli.toggle_like": {"user": (60, 60), "ip": (300, 60)},
+        "hooli.add_rating": {"user": (30, 60), "ip": (150, 60)},
+        "hooli.add_comment": {"user": (10, 60), "ip": (50, 60)},
+        "hooli.login": {"user": (10, 600), "ip": (30, 300)},
+        "hooli.forgot_password": {"user": (3, 3600), "ip": (10, 3600)},
+        "hooli.record_play": {"user": (30, 600), "ip": (300, 600)},
+    }
+    config["RATE_LIMIT_STORE"] = "memory"
+    config["RATE_LIMIT_MAX_KEYS"] = 10000
+
+    # chunked, resumable audio uploads, see hooli_colab/uploads.py.  keep the
+    # staging directory on the media root's filesystem so finishing an upload
+    # is a link, not a copy
+    config["UPLOAD_STAGING_DIR"] = None
+    config["UPLOAD_EXTENSIONS"] = (".wav", ".mp3")
+    config["UPLOAD_MAX_BYTES"] = 2 * 1024 * 1024 * 1024
+    config["UPLOAD_CHUNK_BYTES"] = 8 * 1024 * 1024
+    config["UPLOAD_STALE_HOURS"] = 24
+
+    # a user's liked and rated tracks and comments, see hooli_colab/library.py
+    config["LIBRARY_PAGE_SIZE"] = 50
+    config["LIBRARY_MAX_PAGE_SIZE"] = 200
+
+    # a file's comments a page at a time, see hooli_colab/comments.py
+    config["COMMENTS_PAGE_SIZE"] = 20
+    config["COMMENTS_MAX_PAGE_SIZE"] = 100
+
+    # tiered storage roots, see hooli_colab/storage.py
+    config["MEDIA_ROOT_TIER"] = "slow"
+    config["STORAGE_ROOTS"] = {}
+    config["STORAGE_PROMOTE_HEAT"] = 5.0
+    config["STORAGE_DEMOTE_HEAT"] = 1.0
+    config["STORAGE_MOVES_PER_PASS"] = 100
+    config["STORAGE_MOVE_INTERVAL_MINUTES"] = None
+    config["STORAGE_MOVE_GRACE_SECONDS"] = 60
+    config["STORAGE_RESERVE_BYTES"] = 1024**3
+
+    # the asgi download server, see hooli_colab/streaming.py
+    config["STREAM_MAX_CONCURRENT"] = 500
+    config["STREAM_CHUNK_BYTES"] = 256 * 1024
+    config["STREAM_READ_THREADS"] = 16
+    config["STREAM_REQUIRE_LOGIN"] = False
+
+    # json logs written off the request thread, see hooli_colab/logs.py
+    config["LOG_LEVEL"] = "INFO"
+    config["LOG_REQUESTS"] = True
+    config["LOG_SAMPLE_RATES"] = {}
+
+    # play counts, see hooli_colab/plays.py; or run "flask rollup-plays" from cron
+    config["PLAYS_LOG_DIR"] = "/var/www/hooli_colab/plays"
+    config["PLAYS_SEGMENT_SECONDS"] = 60
+    config["PLAYS_ROLLUP_INTERVAL_MINUTES"] = 5
+
+    config["SESSION_PROTECTION"] = "strong"
+    config["PERMANENT_SESSION_LIFETIME"] = 1800
+    return config
+
+
+def create_app(config=None):
+    """
+    Build and set up a Hooli Colab app.
+
+    Args:
+        config (dict, optional): Settings that override default_config().
+
+    Returns:
+        Flask: The app.
+    """
+    # static files are served by routes.static_files so they get our cache headers
+    app = Flask(__name__, static_folder=None)
+    app.config.update(default_config())
+    app.config.update(config or {})
+
+    from hooli_colab.logs import init_logging
+
+    # first, so everything from here on is logged through it
+    init_logging(app)
+
+    # the social tables (comments, stars, likes) and the users tables can live in
+    # their own database files so indexer writes and like/comment writes don't
+    # fight over one write lock.  Defaults to everything in media.db; use
+    # "flask split-database" to move the tables out of an existing media.db.
+    # binds on the same file share one engine, see databases.share_bind_engines
+    app.config.setdefault(
+        "SQLALCHEMY_BINDS",
+        {
+            "social": os.environ.get(
+                "HOOLI_SOCIAL_DATABASE_URI", app.config["SQLALCHEMY_DATABASE_URI"]
+            ),
+            "users": os.environ.get(
+                "HOOLI_USERS_DATABASE_URI", app.config["SQLALCHEMY_DATABASE_URI"]
+            ),
+        },
+    )
+
+    if not app.config["SECRET_KEY"]:
+        # fine for offline tools; a web server needs the real one or every
+        # restart logs everyone out and invalidates their reset links
+        app.logger.warning("APP_SECRET_KEY isn't set, using a throwaway key")
+        app.config["SECRET_KEY"] = secrets.token_hex(32)
+
+    if app.config["JINJA_BYTECODE_CACHE_DIR"]:
+        try:
+            os.makedirs(app.config["JINJA_BYTECODE_CACHE_DIR"], exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+                app.config["JINJA_BYTECODE_CACHE_DIR"]
+            )
+        except OSError:
+            app.logger.warning(
+                "can't create %s, templates won't be cached",
+                app.config["JINJA_BYTECODE_CACHE_DIR"],
+            )
+
+    mail.init_app(app)
+    db.init_app(app)
+    csrf.init_app(app)
+
+    from hooli_colab.databases import attach_bind_databases, share_bind_engines
+    from hooli_colab.charts import register_chart_functions
+
+    with app.app_context():
+        share_bind_engines(db)
+        attach_bind_databases(db)
+        register_chart_functions(db)
+
+    from hooli_colab import routes, commands
+    from hooli_colab.backup import init_backups
+    from hooli_colab.engagement import init_engagement
+    from hooli_colab.events import init_events
+    from hooli_colab.plays import init_plays
+    from hooli_colab.ratelimit import init_rate_limits
+    from hooli_colab.slugs import init_slugs
+    from hooli_colab.storage import init_storage
+
+    app.register_blueprint(routes.bp)
+    app.add_url_rule(
+        "/static/<path:filename>", endpoint="static", view_func=routes.static_files
+    )
+    app.register_blueprint(commands.bp)
+
+    # first, so limited requests are turned away before any other hook runs
+    init_rate_limits(app)
+    init_engagement(app)
+    init_events(app, db)
+    init_slugs(app)
+    init_backups(app)
+    init_storage(app)
+    init_plays(app)
+
+    from hooli_colab.forms import CustomLoginForm, ExtendedRegisterForm
+    from hooli_colab.email import send_mail_task
+
+    # Initialize Flask-Security with the app, user data store, and custom forms and email task
+    security.init_app(
+        app,
+        user_datastore,
+        login_form=CustomLoginForm,
+        register_form=ExtendedRegisterForm,
+        send_mail_task=send_mail_task,
+    )
+    return app
+
+
+_default_app = None
+_default_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    """build hooli_colab.app with create_app() the first time it's used"""
+    global _default_app
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _default_app_lock:
+        if _default_app is None:
+            _default_app = create_app()
+    return _default_app
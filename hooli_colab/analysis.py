@@ -0,0 +1,391 @@
+""" hooli loudness analysis: integrated loudness, peak and playback gain per track
+
+Loudness is measured the ITU-R BS.1770 way: K-weight every channel, take the
+mean square over 400 ms blocks overlapping by 75%, drop blocks quieter than
+-70 LUFS and then blocks more than 10 LU below the mean of the rest.  WAV
+files are decoded a few seconds at a time and the filter state is carried
+from one chunk to the next, so memory stays flat however long the track is.
+
+The gain stored on MediaFile is what brings the track to
+LOUDNESS_TARGET_LUFS, held back so the peak doesn't go over
+LOUDNESS_PEAK_CEILING_DBFS.  The player applies it; nothing is transcoded.
+
+Analysis runs in a process pool: "flask analyze" does the backlog, and
+queue_analysis() hands new files to a background pool from inside the app.
+"""
+
+import math
+import os
+import queue
+import threading
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.signal import lfilter
+from sqlalchemy import func
+
+from hooli_colab.models import MediaFile
+from hooli_colab.storage import media_path
+
+# lowercase; filetype keeps the extension's case, so it's compared with func.lower
+ANALYZED_TYPES = ("wav",)
+
+# 100 ms steps; a 400 ms gating block is four of them
+STEPS_PER_SECOND = 10
+STEPS_PER_BLOCK = 4
+
+# decode this many steps (10 s) at a time
+CHUNK_STEPS = 100
+
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+
+
+def k_weighting(rate):
+    """
+    Return the two BS.1770 K-weighting biquads for a sample rate.
+
+    The filters are specified at 48 kHz; these are the analog prototypes
+    re-derived for any rate (as libebur128 does), which give the standard
+    coefficients at 48 kHz.
+
+    Args:
+        rate (int): Sample rate in Hz.
+
+    Returns:
+        list: [(b, a), (b, a)], the high shelf then the high pass.
+    """
+    # high shelf modelling the head
+    f0, gain_db, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = math.tan(math.pi * f0 / rate)
+    vh = 10 ** (gain_db / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (
+        np.array(
+            [
+                (vh + vb * k / q + k * k) / a0,
+                2 * (k * k - vh) / a0,
+                (vh - vb * k / q + k * k) / a0,
+            ]
+        ),
+        np.array([1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]),
+    )
+
+    # RLB high pass
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = math.tan(math.pi * f0 / rate)
+    a0 = 1 + k / q + k * k
+    highpass = (
+        np.array([1.0, -2.0, 1.0]),
+        np.array([1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]),
+    )
+    return [shelf, highpass]
+
+
+def channel_weights(channels):
+    """BS.1770 channel weights: surrounds count 1.41, the LFE of 5.1 not at all"""
+    if channels == 6:
+        return np.array([1.0, 1.0, 1.0, 0.0, 1.41, 1.41])
+    if channels == 5:
+        return np.array([1.0, 1.0, 1.0, 1.41, 1.41])
+    return np.ones(channels)
+
+
+def decode_frames(data, sample_width, channels):
+    """
+    Turn raw PCM frames from the wave module into floats in [-1, 1).
+
+    Args:
+        data (bytes): The frames.
+        sample_width (int): Bytes per sample, 1 to 4.
+        channels (int): Number of channels.
+
+    Returns:
+        ndarray: float64 samples shaped (frames, channels).
+    """
+    if sample_width == 1:
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float64) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(data, dtype="<i2") / 32768.0
+    elif sample_width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        ints = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        ints = np.where(ints >= 1 << 23, ints - (1 << 24), ints)
+        samples = ints / float(1 << 23)
+    elif sample_width == 4:
+        samples = np.frombuffer(data, dtype="<i4") / 2147483648.0
+    else:
+        raise ValueError(f"unsupported sample width {sample_width}")
+    return samples.reshape(-1, channels)
+
+
+def measure_loudness(path):
+    """
+    Measure a WAV file's integrated loudness and sample peak.
+
+    Args:
+        path (str): Full path of the file.
+
+    Returns:
+        tuple: (loudness in LUFS, peak in dBFS).  Loudness is None for a file
+            that's silent or shorter than one 400 ms block; peak is None for
+            digital silence.
+    """
+    with wave.open(path, "rb") as wav:
+        channels = wav.getnchannels()
+        sample_width = wav.getsampwidth()
+        rate = wav.getframerate()
+
+        step = max(1, round(rate / STEPS_PER_SECOND))
+        filters = k_weighting(rate)
+        states = [np.zeros((2, channels)) for _ in filters]
+
+        step_energies = []  # per 100 ms step, per channel sum of squares
+        leftover = np.zeros((0, channels))
+        peak = 0.0
+        while True:
+            data = wav.readframes(step * CHUNK_STEPS)
+            if not data:
+                break
+            samples = decode_frames(data, sample_width, channels)
+            if len(samples):
+                peak = max(peak, float(np.abs(samples).max()))
+
+            for i, (b, a) in enumerate(filters):
+                samples, states[i] = lfilter(b, a, samples, axis=0, zi=states[i])
+
+            squared = np.concatenate([leftover, samples * samples])
+            whole = len(squared) // step * step
+            step_energies.append(squared[:whole].reshape(-1, step, channels).sum(axis=1))
+            leftover = squared[whole:]
+
+    peak_dbfs = 20 * math.log10(peak) if peak > 0 else None
+    energies = np.concatenate(step_energies) if step_energies else np.zeros((0, channels))
+    if len(energies) < STEPS_PER_BLOCK:
+        return None, peak_dbfs
+
+    # mean square of every 400 ms block, blocks start every 100 ms
+    cumulative = np.concatenate([np.zeros((1, channels)), np.cumsum(energies, axis=0)])
+    blocks = (cumulative[STEPS_PER_BLOCK:] - cumulative[:-STEPS_PER_BLOCK]) / (
+        STEPS_PER_BLOCK * step
+    )
+    weighted = blocks @ channel_weights(channels)
+
+    with np.errstate(divide="ignore"):
+        block_loudness = -0.691 + 10 * np.log10(weighted)
+    gated = weighted[block_loudness > ABSOLUTE_GATE_LUFS]
+    if len(gated) == 0:
+        return None, peak_dbfs
+    relative_gate = -0.691 + 10 * math.log10(gated.mean()) + RELATIVE_GATE_LU
+    gated = weighted[(block_loudness > ABSOLUTE_GATE_LUFS) & (block_loudness > relative_gate)]
+    return -0.691 + 10 * math.log10(gated.mean()), peak_dbfs
+
+
+def track_gain(loudness_lufs, peak_dbfs, target_lufs, ceiling_dbfs):
+    """
+    Return the gain in dB that brings a track to the target loudness without clipping.
+
+    Args:
+        loudness_lufs (float): Integrated loudness, None if unmeasurable.
+        peak_dbfs (float): Sample peak, None for silence.
+        target_lufs (float): LOUDNESS_TARGET_LUFS.
+        ceiling_dbfs (float): LOUDNESS_PEAK_CEILING_DBFS.
+
+    Returns:
+        float: The gain, 0.0 if the loudness couldn't be measured.
+    """
+    if loudness_lufs is None:
+        return 0.0
+    gain = target_lufs - loudness_lufs
+    if peak_dbfs is not None:
+        gain = min(gain, ceiling_dbfs - peak_dbfs)
+    return round(gain, 2)
+
+
+def _analysis_job(media_file_id, path):
+    """process pool worker: return (media_file_id, loudness, peak), both None if unreadable"""
+    try:
+        loudness, peak = measure_loudness(path)
+    except (OSError, EOFError, wave.Error, ValueError):
+        return media_file_id, None, None
+    return media_file_id, loudness, peak
+
+
+def _store(media_file, loudness, peak, config):
+    media_file.loudness_lufs = None if loudness is None else round(loudness, 2)
+    media_file.peak_dbfs = None if peak is None else round(peak, 2)
+    media_file.gain_db = track_gain(
+        loudness,
+        peak,
+        config["LOUDNESS_TARGET_LUFS"],
+        config["LOUDNESS_PEAK_CEILING_DBFS"],
+    )
+
+
+def pending_analysis():
+    """query for the analyzable files that haven't been analyzed yet"""
+    return MediaFile.query.filter(
+        MediaFile.gain_db.is_(None), func.lower(MediaFile.filetype).in_(ANALYZED_TYPES)
+    )
+
+
+def analyze_media(workers=None, reanalyze=False, batch_size=100, media_file_ids=None):
+    """
+    Analyze every file without a gain yet, in a process pool.
+
+    Results are committed every batch_size files so an interrupted run keeps
+    what it's done.  Must be called inside an app context.
+
+    Args:
+        workers (int, optional): Number of processes.  Defaults to the CPU count.
+        reanalyze (bool, optional): Analyze every file again.  Defaults to False.
+        batch_size (int, optional): Files per commit.  Defaults to 100.
+        media_file_ids (list, optional): Only these files, e.g. the ones the
+            indexer just found.  Defaults to all of them.
+
+    Returns:
+        dict: Counts of files analyzed and of files that couldn't be measured.
+    """
+    from flask import current_app
+    from hooli_colab import db
+
+    query = (
+        MediaFile.query.filter(func.lower(MediaFile.filetype).in_(ANALYZED_TYPES))
+        if reanalyze
+        else pending_analysis()
+    )
+    if media_file_ids is not None:
+        query = query.filter(MediaFile.id.in_(media_file_ids))
+    files = {media_file.id: media_file for media_file in query}
+    report = {"analyzed": 0, "unmeasured": 0}
+    if not files:
+        return report
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            _analysis_job,
+            list(files),
+            [media_path(current_app.config, f) for f in files.values()],
+            chunksize=4,
+        )
+        for media_file_id, loudness, peak in results:
+            _store(files[media_file_id], loudness, peak, current_app.config)
+            report["analyzed"] += 1
+            if loudness is None:
+                report["unmeasured"] += 1
+            if report["analyzed"] % batch_size == 0:
+                db.session.commit()
+    db.session.commit()
+    return report
+
+
+def regain_media():
+    """
+    Recompute gain_db from the stored loudness and peak, e.g. after changing the target.
+
+    Must be called inside an app context.
+
+    Returns:
+        int: The number of files updated.
+    """
+    from flask import current_app
+    from hooli_colab import db
+
+    count = 0
+    for media_file in MediaFile.query.filter(MediaFile.gain_db.isnot(None)):
+        _store(media_file, media_file.loudness_lufs, media_file.peak_dbfs, current_app.config)
+        count += 1
+    db.session.commit()
+    return count
+
+
+class AnalysisQueue:
+    """
+    Background loudness analysis for files the app has just found out about.
+
+    A thread takes media file ids off a queue, runs them through a process
+    pool and stores the results.  Like the engagement buffer, it starts on
+    first use so it's created in the worker process, not a parent that forks.
+
+    Attributes:
+        app (Flask): The app, for the thread's app context.
+        workers (int): Number of analysis processes.
+    """
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            threading.Thread(target=self._run, name="loudness-analysis", daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, media_file_ids):
+        """queue media files for analysis"""
+        self._start()
+        for media_file_id in media_file_ids:
+            self._queue.put(media_file_id)
+
+    def _run(self):
+        from hooli_colab import db
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                ids = [self._queue.get()]
+                while not self._queue.empty():
+                    ids.append(self._queue.get_nowait())
+                try:
+                    with self.app.app_context():
+                        files = {
+                            media_file.id: media_file
+                            for media_file in pending_analysis().filter(MediaFile.id.in_(ids))
+                        }
+                        jobs = [
+                            pool.submit(_analysis_job, f.id, media_path(self.app.config, f))
+                            for f in files.values()
+                        ]
+                        for job in jobs:
+                            media_file_id, loudness, peak = job.result()
+                            _store(files[media_file_id], loudness, peak, self.app.config)
+                        db.session.commit()
+                except Exception:  # keep the thread alive for the next files
+                    self.app.logger.exception("loudness analysis failed")
+
+
+# guards creating an app's AnalysisQueue
+_queue_lock = threading.Lock()
+
+
+def queue_analysis(media_file_ids):
+    """
+    Have files analyzed in the background.  Files that aren't WAVs or already
+    have a gain are skipped when their turn comes.
+
+    The app's AnalysisQueue is created the first time this is called, so apps
+    that never find new files never load this module.
+
+    Args:
+        media_file_ids (list): Ids of the media files.
+    """
+    from flask import current_app
+
+    if not media_file_ids:
+        return
+    with _queue_lock:
+        analysis_queue = current_app.extensions.get("analysis_queue")
+        if analysis_queue is None:
+            app = current_app._get_current_object()
+            analysis_queue = AnalysisQueue(app, app.config["ANALYSIS_WORKERS"])
+            app.extensions["analysis_queue"] = analysis_queue
+    analysis_queue.submit(media_file_ids)
@@ -0,0 +1,237 @@
+""" hooli static asset pipeline: vendored bundles, content-hashed and precompressed """
+
+import gzip
+import hashlib
+import json
+import os
+import urllib.request
+
+from flask import current_app, url_for
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, we just don't write .br files without it
+    brotli = None
+
+# bundle name -> source files relative to the static folder, in order
+BUNDLES = {
+    "hooli.css": [
+        "vendor/bootstrap.min.css",
+        "styles.css",
+        "player.css",
+    ],
+    "hooli.js": [
+        "vendor/jquery.slim.min.js",
+        "vendor/popper.min.js",
+        "vendor/bootstrap.min.js",
+        "site.js",
+        "player.js",
+    ],
+}
+
+# third party files we self-host; fetched by the build, and linked from the
+# CDN directly if the build hasn't been run
+VENDOR_SOURCES = {
+    "vendor/bootstrap.min.css": "https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css",
+    "vendor/jquery.slim.min.js": "https://code.jquery.com/jquery-3.5.1.slim.min.js",
+    "vendor/popper.min.js": "https://cdn.jsdelivr.net/npm/@popperjs/core@2.5.4/dist/umd/popper.min.js",
+    "vendor/bootstrap.min.js": "https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/js/bootstrap.min.js",
+}
+
+DIST_DIR = "dist"
+MANIFEST_NAME = "manifest.json"
+
+# encoding -> suffix of the precompressed variant, in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+_manifest_cache = {}
+
+
+def fetch_vendor_files(static_dir, force=False):
+    """
+    Download the third party files into static/vendor.
+
+    Args:
+        static_dir (str): Path of the static folder.
+        force (bool, optional): Download even if the file is already there.
+
+    Returns:
+        list: The vendor files that were downloaded.
+    """
+    fetched = []
+    for name, url in VENDOR_SOURCES.items():
+        path = os.path.join(static_dir, name)
+        if os.path.exists(path) and not force:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as response:
+            data = response.read()
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        fetched.append(name)
+    return fetched
+
+
+def _write_variants(path, data):
+    """write data to path along with .gz and (if we can) .br variants"""
+    with open(path, "wb") as f:
+        f.write(data)
+    encodings = []
+    with open(path + ".gz", "wb") as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    encodings.append("gzip")
+    if brotli is not None:
+        with open(path + ".br", "wb") as f:
+            f.write(brotli.compress(data, quality=11))
+        encodings.append("br")
+    return encodings
+
+
+def build_assets(static_dir, fetch=True):
+    """
+    Build the static bundles.
+
+    Each bundle's sources are concatenated and written to static/dist under a
+    content-hashed name (hooli.<hash>.css), along with gzip and brotli
+    precompressed copies, and a manifest mapping bundle names to built files.
+    The previous build's files are kept, and recorded in each entry as
+    "previous", so pages that were rendered (or cached) before this build
+    still load; anything older is removed.
+
+    Args:
+        static_dir (str): Path of the static folder.
+        fetch (bool, optional): Download missing vendor files first.  Defaults to True.
+
+    Returns:
+        dict: The manifest that was written.
+    """
+    if fetch:
+        fetch_vendor_files(static_dir)
+
+    dist_dir = os.path.join(static_dir, DIST_DIR)
+    os.makedirs(dist_dir, exist_ok=True)
+    manifest_path = os.path.join(dist_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_path) as f:
+            old_manifest = json.load(f)
+    except (OSError, ValueError):
+        old_manifest = {}
+
+    manifest = {}
+    for bundle, sources in BUNDLES.items():
+        parts = []
+        for source in sources:
+            with open(os.path.join(static_dir, source), "rb") as f:
+                parts.append(f.read())
+        separator = b";\n" if bundle.endswith(".js") else b"\n"
+        data = separator.join(parts)
+
+        stem, ext = os.path.splitext(bundle)
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        filename = f"{stem}.{digest}{ext}"
+        encodings = _write_variants(os.path.join(dist_dir, filename), data)
+        manifest[bundle] = {"file": filename, "encodings": encodings, "size": len(data)}
+        old = old_manifest.get(bundle)
+        if old is not None and old["file"] != filename:
+            manifest[bundle]["previous"] = {"file": old["file"], "encodings": old["encodings"]}
+        elif old is not None and "previous" in old:
+            manifest[bundle]["previous"] = old["previous"]  # nothing changed, keep it too
+
+    keep = {MANIFEST_NAME}
+    for entry in _built_files(manifest):
+        keep.add(entry["file"])
+        keep.update(entry["file"] + suffix for _, suffix in ENCODINGS)
+    # the new manifest goes in before anything is removed, so no process links a removed file
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    for name in os.listdir(dist_dir):
+        if name not in keep:
+            os.remove(os.path.join(dist_dir, name))
+    _manifest_cache.clear()
+    return manifest
+
+
+def _built_files(manifest):
+    """the manifest entries of every built file it lists, current and previous"""
+    for entry in manifest.values():
+        yield entry
+        if "previous" in entry:
+            yield entry["previous"]
+
+
+def load_manifest():
+    """
+    Return the asset manifest, read again whenever the file changes, so running
+    processes pick up a new build without a restart.
+
+    Returns:
+        dict: The manifest written by build_assets, empty if it hasn't been run.
+    """
+    path = os.path.join(current_app.root_path, "static", DIST_DIR, MANIFEST_NAME)
+    try:
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_ino)
+    except OSError:
+        stamp = None
+    if "manifest" in _manifest_cache and _manifest_cache["stamp"] == stamp:
+        return _manifest_cache["manifest"]
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    _manifest_cache["manifest"] = manifest
+    _manifest_cache["encodings"] = {
+        f"{DIST_DIR}/{entry['file']}": entry["encodings"] for entry in _built_files(manifest)
+    }
+    _manifest_cache["stamp"] = stamp
+    return manifest
+
+
+def asset_urls(bundle):
+    """
+    Template global: the urls to load for a bundle.
+
+    Once the bundle has been built that's the single content-hashed file.
+    Before then it's each source file, with vendor files that haven't been
+    fetched yet coming from their CDN.
+
+    Args:
+        bundle (str): The bundle name, e.g. "hooli.css".
+
+    Returns:
+        list: The urls, in load order.
+    """
+    entry = load_manifest().get(bundle)
+    if entry is not None:
+        return [url_for("static", filename=f"{DIST_DIR}/{entry['file']}")]
+
+    static_dir = os.path.join(current_app.root_path, "static")
+    urls = []
+    for source in BUNDLES[bundle]:
+        if source in VENDOR_SOURCES and not os.path.exists(os.path.join(static_dir, source)):
+            urls.append(VENDOR_SOURCES[source])
+        else:
+            urls.append(url_for("static", filename=source))
+    return urls
+
+
+def is_built_asset(filename):
+    """return True if filename (relative to static) is a content-hashed build output"""
+    return filename.startswith(DIST_DIR + "/")
+
+
+def precompressed_encodings(filename):
+    """
+    Return the precompressed variants the build wrote for a static file.
+
+    Args:
+        filename (str): Path relative to the static folder.
+
+    Returns:
+        list: Encodings ("br", "gzip") available for the file, empty if none.
+    """
+    load_manifest()
+    return _manifest_cache["encodings"].get(filename, [])
@@ -0,0 +1,294 @@
+""" hooli backups: consistent snapshots of the live database files
+
+Copying media.db with cp while the app writes to it can give a torn copy, and
+locking it for the whole copy holds up every like and comment.  This uses
+SQLite's online backup API instead, a few hundred pages per step with a short
+sleep in between, so a writer only ever waits for one step.  If another
+connection writes while a copy is running SQLite starts the copy over; when
+that keeps happening the steps are made bigger until one pass gets through.
+
+A snapshot is a directory named by its UTC time under BACKUP_DIR holding one
+copy of each database file (media.db, and social.db and users.db once split),
+each integrity checked before the snapshot is kept.  Old snapshots are rotated
+out: the newest BACKUP_KEEP_LAST are kept, plus the newest of each of the last
+BACKUP_KEEP_DAILY days.
+"""
+
+import fcntl
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from hooli_colab.databases import sqlite_path
+
+SNAPSHOT_FORMAT = "%Y%m%dT%H%M%SZ"
+SNAPSHOT_NAME = re.compile(r"\d{8}T\d{6}Z\Z")
+
+# doubling the step size after this many restarts in a row
+RESTARTS_PER_STEP_SIZE = 3
+
+
+class BackupError(Exception):
+    """raised when a snapshot can't be made or doesn't check out; nothing is kept"""
+
+
+class _Restarted(Exception):
+    """the copy started over because the source was written to"""
+
+
+def database_files(config):
+    """
+    The distinct database files of an app, by bind.
+
+    Args:
+        config (dict): The app's config.
+
+    Returns:
+        dict: Bind key (None for the catalog) -> file path, each file once.
+    """
+    files = {None: sqlite_path(config["SQLALCHEMY_DATABASE_URI"])}
+    for key, uri in (config.get("SQLALCHEMY_BINDS") or {}).items():
+        path = sqlite_path(uri)
+        if path not in files.values():
+            files[key] = path
+    return files
+
+
+def backup_file(source_path, target_path, pages=256, pause=0.01):
+    """
+    Copy a live SQLite database with the online backup API and check the copy.
+
+    Args:
+        source_path (str): The database.
+        target_path (str): Where the copy goes; mustn't exist.
+        pages (int, optional): Pages copied per step.  Defaults to 256.
+        pause (float, optional): Seconds to sleep between steps.  Defaults to 0.01.
+
+    Returns:
+        dict: "bytes" copied, "seconds" taken, "bytes_per_second", "steps",
+            "restarts", and "longest_step", the longest time in seconds the
+            source was held for one step, i.e. the longest a writer could
+            have waited on this copy.
+
+    Raises:
+        BackupError: If the copy fails its integrity check.
+    """
+    source = sqlite3.connect(source_path, timeout=30)
+    stats = {"steps": 0, "restarts": 0, "longest_step": 0.0}
+    start = time.monotonic()
+    try:
+        while True:
+            last_remaining = None
+            step_start = time.monotonic()
+
+            def progress(status, remaining, total):
+                nonlocal last_remaining, step_start
+                stats["longest_step"] = max(stats["longest_step"], time.monotonic() - step_start)
+                stats["steps"] += 1
+                if last_remaining is not None and remaining > last_remaining:
+                    raise _Restarted()
+                last_remaining = remaining
+                time.sleep(pause)
+                step_start = time.monotonic()
+
+            target = sqlite3.connect(target_path)
+            try:
+                source.backup(target, pages=pages, progress=progress)
+                break
+            except _Restarted:
+                stats["restarts"] += 1
+                if stats["restarts"] % RESTARTS_PER_STEP_SIZE == 0:
+                    pages *= 2
+            finally:
+                target.close()
+    finally:
+        source.close()
+    seconds = time.monotonic() - start
+
+    check = sqlite3.connect(f"file:{target_path}?mode=ro", uri=True)
+    try:
+        result = [row[0] for row in check.execute("PRAGMA integrity_check")]
+        page_count = check.execute("PRAGMA page_count").fetchone()[0]
+        page_size = check.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        check.close()
+    if result != ["ok"]:
+        raise BackupError(f"copy of {source_path} failed its integrity check: {result[0]}")
+
+    stats["bytes"] = page_count * page_size
+    stats["seconds"] = seconds
+    stats["bytes_per_second"] = stats["bytes"] / seconds if seconds else 0.0
+    return stats
+
+
+def list_snapshots(backup_dir):
+    """the snapshot directories in backup_dir, oldest first, as (time, path)"""
+    if not os.path.isdir(backup_dir):
+        return []
+    snapshots = []
+    for name in os.listdir(backup_dir):
+        path = os.path.join(backup_dir, name)
+        if SNAPSHOT_NAME.match(name) and os.path.isdir(path):
+            taken = datetime.strptime(name, SNAPSHOT_FORMAT).replace(tzinfo=timezone.utc)
+            snapshots.append((taken, path))
+    return sorted(snapshots)
+
+
+def rotate_snapshots(backup_dir, keep_last, keep_daily, now=None):
+    """
+    Delete the snapshots the retention policy doesn't keep.
+
+    Args:
+        backup_dir (str): Where the snapshots are.
+        keep_last (int): Keep this many of the newest.
+        keep_daily (int): Also keep the newest of each of this many days, today included.
+        now (datetime, optional): The time to count days back from.  Defaults to now.
+
+    Returns:
+        list: Paths of the snapshots deleted.
+    """
+    now = now or datetime.now(timezone.utc)
+    snapshots = list_snapshots(backup_dir)
+    keep = {path for _, path in snapshots[-keep_last:]} if keep_last > 0 else set()
+    newest_of_day = {}
+    for taken, path in snapshots:
+        newest_of_day[taken.date()] = path
+    oldest_day = (now - timedelta(days=keep_daily - 1)).date()
+    keep.update(path for day, path in newest_of_day.items() if day >= oldest_day)
+
+    deleted = []
+    for _, path in snapshots:
+        if path not in keep:
+            shutil.rmtree(path)
+            deleted.append(path)
+    return deleted
+
+
+def take_snapshot(config, echo=print):
+    """
+    Back up every database file of an app into a new snapshot, then rotate.
+
+    Args:
+        config (dict): The app's config.
+        echo (callable, optional): Progress reporter.  Defaults to print.
+
+    Returns:
+        dict: "path" of the snapshot, "files" {file name: backup_file stats}
+            and "deleted", the snapshots rotated out.
+
+    Raises:
+        BackupError: If a copy fails; the partial snapshot is removed.
+    """
+    backup_dir = config["BACKUP_DIR"]
+    os.makedirs(backup_dir, exist_ok=True)
+    name = datetime.now(timezone.utc).strftime(SNAPSHOT_FORMAT)
+    path = os.path.join(backup_dir, name)
+    partial = path + ".partial"
+    os.makedirs(partial)
+
+    files = {}
+    try:
+        for source_path in database_files(config).values():
+            file_name = os.path.basename(source_path)
+            stats = backup_file(
+                source_path,
+                os.path.join(partial, file_name),
+                pages=config["BACKUP_PAGES_PER_STEP"],
+                pause=config["BACKUP_STEP_PAUSE"],
+            )
+            files[file_name] = stats
+            echo(
+                f"{file_name}: {stats['bytes']} bytes in {stats['seconds']:.2f}s "
+                f"({stats['bytes_per_second'] / 1e6:.1f} MB/s), {stats['steps']} steps, "
+                f"{stats['restarts']} restarts, longest step {stats['longest_step'] * 1000:.1f} ms"
+            )
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    os.replace(partial, path)
+
+    deleted = rotate_snapshots(
+        backup_dir, config["BACKUP_KEEP_LAST"], config["BACKUP_KEEP_DAILY"]
+    )
+    for old in deleted:
+        echo(f"rotated out {os.path.basename(old)}")
+    return {"path": path, "files": files, "deleted": deleted}
+
+
+class BackupScheduler:
+    """
+    Takes a snapshot every BACKUP_INTERVAL_HOURS from a thread in the app.
+
+    Every worker process runs one, started on its first request; they share
+    a lock file in BACKUP_DIR and go by the newest snapshot's time, so only
+    one of them backs up each interval.
+
+    Attributes:
+        app (Flask): The app, for its config and logger.
+        interval (timedelta): Time between snapshots.
+    """
+
+    def __init__(self, app, interval_hours):
+        self.app = app
+        self.interval = timedelta(hours=interval_hours)
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """start the thread in this process if it isn't running yet"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="backup-scheduler", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _due_in(self):
+        """seconds until the next snapshot is due"""
+        snapshots = list_snapshots(self.app.config["BACKUP_DIR"])
+        if not snapshots:
+            return 0.0
+        due = snapshots[-1][0] + self.interval
+        return max(0.0, (due - datetime.now(timezone.utc)).total_seconds())
+
+    def _run(self):
+        while True:
+            try:
+                wait = self._due_in()
+                if wait > 0:
+                    time.sleep(min(wait, 600))
+                    continue
+                os.makedirs(self.app.config["BACKUP_DIR"], exist_ok=True)
+                lock_path = os.path.join(self.app.config["BACKUP_DIR"], ".lock")
+                with open(lock_path, "w") as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # another process is backing up; check again once it's done
+                        time.sleep(60)
+                        continue
+                    # it may have just finished one
+                    if self._due_in() == 0:
+                        take_snapshot(self.app.config, echo=self.app.logger.info)
+            except Exception:  # keep the thread alive for the next interval
+                self.app.logger.exception("scheduled backup failed")
+                time.sleep(600)
+
+
+def init_backups(app):
+    """
+    Start scheduled backups in each worker process, if BACKUP_INTERVAL_HOURS is set.
+
+    Args:
+        app (Flask): The app.
+    """
+    if not app.config["BACKUP_INTERVAL_HOURS"]:
+        return
+    scheduler = BackupScheduler(app, app.config["BACKUP_INTERVAL_HOURS"])
+    app.extensions["backup_scheduler"] = scheduler
+    app.before_request(scheduler.start)
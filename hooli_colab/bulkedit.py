@@ -0,0 +1,228 @@
+""" hooli bulk metadata editing: apply the same changes to many media files at once
+
+An edit is a list of operations applied in order to every selected file,
+followed by per-file values from the grid:
+
+    {"op": "set", "field": "artist", "value": "The Band"}
+    {"op": "add_tag", "value": "live"}
+    {"op": "remove_tag", "value": "demo"}
+    {"op": "title_from_filename", "pattern": "{track} - {title}"}
+
+A pattern is matched against the filename without its extension; {name}
+matches any text, and names that are fields (title, artist, album, genre)
+are set from what they matched, others ({track}, {_}) are ignored.
+
+Everything is validated before anything is changed, and then applied in one
+transaction, so an edit either happens to every file or to none.
+"""
+
+import re
+
+from hooli_colab.models import MediaFile
+
+# field -> longest value the column holds, None for Text
+EDITABLE_FIELDS = {
+    "title": 255,
+    "artist": 255,
+    "album": 255,
+    "genre": 255,
+    "tags": 255,
+    "description": None,
+}
+# the columns of the editor's grid
+GRID_FIELDS = ("title", "artist", "album", "genre", "tags")
+PATTERN_FIELDS = ("title", "artist", "album", "genre")
+OPERATIONS = ("set", "add_tag", "remove_tag", "title_from_filename")
+
+
+class BulkEditError(Exception):
+    """
+    Raised when an edit doesn't validate; nothing has been changed.
+
+    Attributes:
+        errors (list): {"id": media file id or None, "error": message} for each problem.
+    """
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} problems")
+        self.errors = errors
+
+
+def compile_pattern(pattern):
+    """
+    Turn a "{track} - {title}" style pattern into a regular expression.
+
+    Args:
+        pattern (str): The pattern.
+
+    Returns:
+        re.Pattern: Matches a whole filename stem, with a named group per {name}.
+
+    Raises:
+        ValueError: If the pattern is malformed or names something twice.
+    """
+    parts = re.split(r"\{(\w+)\}", pattern)
+    regex = ""
+    seen = set()
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            if "{" in part or "}" in part:
+                raise ValueError(f"bad placeholder in {pattern!r}")
+            regex += re.escape(part)
+        elif part == "_":
+            regex += ".+?"
+        elif part in seen:
+            raise ValueError(f"{{{part}}} appears twice in {pattern!r}")
+        else:
+            seen.add(part)
+            regex += f"(?P<{part}>.+?)"
+    if not seen & set(PATTERN_FIELDS):
+        raise ValueError(f"{pattern!r} doesn't set any of {', '.join(PATTERN_FIELDS)}")
+    return re.compile(regex + r"\Z", re.DOTALL)
+
+
+def split_tags(tags):
+    """the tags in a comma separated tags value, in order"""
+    return [tag.strip() for tag in (tags or "").split(",") if tag.strip()]
+
+
+def _check_operations(operations):
+    """validate the operations, returning them with patterns compiled"""
+    checked = []
+    errors = []
+    for operation in operations:
+        op = operation.get("op") if isinstance(operation, dict) else None
+        if op not in OPERATIONS:
+            errors.append({"id": None, "error": f"unknown operation {op!r}"})
+            continue
+        if op == "set":
+            field = operation.get("field")
+            value = operation.get("value")
+            if field not in EDITABLE_FIELDS:
+                errors.append({"id": None, "error": f"can't set {field!r}"})
+            elif value is not None and not isinstance(value, str):
+                errors.append({"id": None, "error": f"{field} must be text"})
+            else:
+                checked.append((op, field, value))
+        elif op in ("add_tag", "remove_tag"):
+            tag = operation.get("value")
+            if not isinstance(tag, str) or not tag.strip() or "," in tag:
+                errors.append({"id": None, "error": f"bad tag {tag!r}"})
+            else:
+                checked.append((op, "tags", tag.strip()))
+        else:
+            try:
+                checked.append((op, None, compile_pattern(operation.get("pattern") or "")))
+            except ValueError as e:
+                errors.append({"id": None, "error": str(e)})
+    return checked, errors
+
+
+def _edited_values(media_file, operations, row_values):
+    """the media file's field values after the edit, raising ValueError if it can't be applied"""
+    values = {field: getattr(media_file, field) for field in EDITABLE_FIELDS}
+    for op, field, argument in operations:
+        if op == "set":
+            values[field] = argument
+        elif op == "add_tag":
+            tags = split_tags(values["tags"])
+            if argument.lower() not in (tag.lower() for tag in tags):
+                values["tags"] = ", ".join(tags + [argument])
+        elif op == "remove_tag":
+            tags = split_tags(values["tags"])
+            values["tags"] = ", ".join(t for t in tags if t.lower() != argument.lower())
+        else:
+            stem = media_file.filename.rsplit(".", 1)[0]
+            match = argument.match(stem)
+            if match is None:
+                raise ValueError(f"{media_file.filename} doesn't match the pattern")
+            for name, matched in match.groupdict().items():
+                if name in PATTERN_FIELDS:
+                    values[name] = matched.strip()
+    for field, value in row_values.items():
+        if field not in EDITABLE_FIELDS:
+            raise ValueError(f"can't set {field!r}")
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f"{field} must be text")
+        values[field] = value
+    for field, value in values.items():
+        if isinstance(value, str):
+            value = value.strip() or None
+            values[field] = value
+        limit = EDITABLE_FIELDS[field]
+        if value is not None and limit is not None and len(value) > limit:
+            raise ValueError(f"{field} is longer than {limit} characters")
+    return values
+
+
+def bulk_edit(media_file_ids, operations, rows=None, dry_run=False):
+    """
+    Apply an edit to many media files in one transaction.
+
+    Must be called inside an app context.
+
+    Args:
+        media_file_ids (list): The files to edit.
+        operations (list): Operation dicts, see the top of this module.
+        rows (dict, optional): Media file id -> {field: value} from the grid,
+            applied after the operations.
+        dry_run (bool, optional): Work out the diff without changing anything.
+
+    Returns:
+        list: {"id", "filename", "changes": {field: [old, new]}} for each file
+            the edit changes, in the order of media_file_ids.
+
+    Raises:
+        BulkEditError: If anything doesn't validate; nothing is changed.
+    """
+    from hooli_colab import db
+
+    try:
+        rows = {int(key): values for key, values in (rows or {}).items()}
+    except ValueError:
+        raise BulkEditError([{"id": None, "error": "rows must be keyed by media file id"}])
+    checked, errors = _check_operations(operations)
+    media_files = {
+        media_file.id: media_file
+        for media_file in MediaFile.query.filter(MediaFile.id.in_(media_file_ids))
+    }
+
+    # every row is checked even after a problem so they're all reported at once
+    edits = []
+    for media_file_id in media_file_ids:
+        media_file = media_files.get(media_file_id)
+        if media_file is None:
+            errors.append({"id": media_file_id, "error": "no such media file"})
+            continue
+        row_values = rows.get(media_file_id, {})
+        if not isinstance(row_values, dict):
+            errors.append({"id": media_file_id, "error": "row values must be an object"})
+            continue
+        try:
+            values = _edited_values(media_file, checked, row_values)
+        except ValueError as e:
+            errors.append({"id": media_file_id, "error": str(e)})
+            continue
+        changes = {
+            field: [getattr(media_file, field), value]
+            for field, value in values.items()
+            if getattr(media_file, field) != value
+        }
+        if changes:
+            edits.append((media_file, changes))
+    selected = set(media_file_ids)
+    for media_file_id in rows:
+        if media_file_id not in selected:
+            errors.append({"id": media_file_id, "error": "not one of the selected files"})
+    if errors:
+        raise BulkEditError(errors)
+
+    if not dry_run:
+        for media_file, changes in edits:
+            for field, (_, new) in changes.items():
+                setattr(media_file, field, new)
+        db.session.commit()
+    return [
+        {"id": media_file.id, "filename": media_file.filename, "changes": changes}
+        for media_file, changes in edits
+    ]
@@ -0,0 +1,126 @@
+""" hooli http caching: validators, cache-control policies, versioned static urls """
+
+import mimetypes
+import os
+import stat
+from datetime import datetime, timezone
+
+from flask import current_app, request, Response
+from werkzeug.http import is_resource_modified
+from werkzeug.security import safe_join
+
+# static file name -> (mtime, short content hash)
+_static_versions = {}
+
+
+def cache_control_for(filename, versioned=False):
+    """
+    Pick the Cache-Control value for a file from the CACHE_CONTROL_POLICIES config.
+
+    Policies are keyed by the major part of the mimetype (audio, image, ...),
+    with "versioned" used for static urls that carry a content version and
+    "default" for anything else.
+
+    Args:
+        filename (str): The file name, used to guess the mimetype.
+        versioned (bool, optional): True if the url includes a matching content version.
+
+    Returns:
+        str: The Cache-Control header value.
+    """
+    policies = current_app.config["CACHE_CONTROL_POLICIES"]
+    if versioned:
+        return policies["versioned"]
+    mimetype = mimetypes.guess_type(filename)[0] or ""
+    return policies.get(mimetype.split("/")[0], policies["default"])
+
+
+def media_file_validators(media_file):
+    """
+    Build an ETag and Last-Modified for a media file from what the indexer stored.
+
+    Args:
+        media_file (MediaFile): The media file.
+
+    Returns:
+        tuple: (etag, last_modified) or (None, None) if the file hasn't been indexed yet.
+    """
+    if media_file is None or media_file.mtime is None:
+        return None, None
+    if media_file.content_hash:
+        etag = media_file.content_hash
+    else:
+        etag = f"{media_file.filesize}-{media_file.mtime}-{media_file.inode}"
+    last_modified = datetime.fromtimestamp(int(media_file.mtime), tz=timezone.utc)
+    return etag, last_modified
+
+
+def not_modified_response(etag, last_modified, cache_control):
+    """
+    Answer a conditional GET without touching the file.
+
+    Args:
+        etag (str): The current strong ETag of the resource.
+        last_modified (datetime): When the resource was last modified.
+        cache_control (str): The Cache-Control header value to send.
+
+    Returns:
+        Response: A 304 response if the client's copy is still good, else None.
+    """
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def static_version(filename):
+    """
+    Return a short content hash for a file in the static folder.
+
+    The hash is computed once per process and remembered; in debug mode the
+    file is re-stat'ed so edits show up without a restart.
+
+    Args:
+        filename (str): Path of the file relative to the static folder.
+
+    Returns:
+        str: The first 12 hex digits of the file's SHA-256, or None if it isn't a
+            file in the static folder.
+    """
+    from hooli_colab.indexer import hash_file
+
+    cached = _static_versions.get(filename)
+    if cached is not None and not current_app.debug:
+        return cached[1]
+
+    # filename can come straight from a request's url
+    path = safe_join(os.path.join(current_app.root_path, "static"), filename)
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    if cached is not None and cached[0] == st.st_mtime:
+        return cached[1]
+
+    version = hash_file(path)[:12]
+    _static_versions[filename] = (st.st_mtime, version)
+    return version
+
+
+def add_static_version(endpoint, values):
+    """url_defaults hook: give url_for('static', ...) a ?v=<content hash> parameter"""
+    if endpoint != "static" or "v" in values or "filename" not in values:
+        return
+    if values["filename"].startswith("dist/"):
+        # build outputs carry their content hash in the name already
+        return
+    version = static_version(values["filename"])
+    if version:
+        values["v"] = version
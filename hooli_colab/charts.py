@@ -0,0 +1,426 @@
+""" hooli charts: trending, top rated, most discussed and most played, kept up to date incrementally
+
+Every like, rating and comment bumps a row of media_file_stats in the same
+transaction that writes it, and every rollup of the play log bumps the rows
+of the files it counted plays for (see hooli_colab/plays.py), so a chart page
+is one read down an index on media_file_stats and never an aggregate over
+likes, stars, comments or plays.
+
+trending is a sum of exponentially decaying event weights, kept in log space
+relative to a fixed epoch: an event at time t adds w * exp(lambda * t) to the
+sum, with lambda = ln 2 / CHART_HALF_LIFE_DAYS.  Every file's score decays by
+the same factor as time passes, so the order by the stored key is the order
+by current score without anything having to be rewritten as time passes.
+Logs keep the numbers in range; an unlike or a deleted comment subtracts the
+weight it was added with, using the timestamp of the row being removed.
+
+top_rated is the Bayesian average (C * m + sum of stars) / (C + ratings), where
+m is the library-wide mean rating and C is CHART_MIN_VOTES, so a file with one
+5 star rating doesn't outrank one with fifty 4.8s.  A file's top_rated is
+recomputed with the current m whenever it's rated; "flask rebuild-charts"
+recomputes everything, e.g. after changing CHART_HALF_LIFE_DAYS or the weights.
+It counts plays from play_count_daily, which only keeps days, so a rebuild
+puts each day's plays at noon.
+"""
+
+import math
+from datetime import datetime, time, timezone
+
+from flask import current_app
+from sqlalchemy import event, text
+
+from hooli_colab.events import queue_event
+from hooli_colab.models import (
+    ChartTotals,
+    Comments,
+    Likes,
+    MediaFile,
+    MediaFileStats,
+    PlayCountDaily,
+    Stars,
+)
+
+TRENDING = "trending"
+TOP_RATED = "top-rated"
+MOST_DISCUSSED = "most-discussed"
+MOST_PLAYED = "most-played"
+
+CHARTS = {
+    TRENDING: ("Trending", MediaFileStats.trending),
+    TOP_RATED: ("Top rated", MediaFileStats.top_rated),
+    MOST_DISCUSSED: ("Most discussed", MediaFileStats.comment_count),
+    MOST_PLAYED: ("Most played", MediaFileStats.play_count),
+}
+
+# charts of plain counts, which leave out files with none
+COUNT_CHARTS = (MOST_DISCUSSED, MOST_PLAYED)
+
+# trending keys are relative to this, so exp() of them stays in range for decades
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _logaddexp(a, b):
+    """log(exp(a) + exp(b)), with None standing for log(0)"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+def _logsubexp(a, b):
+    """log(exp(a) - exp(b)), with None standing for log(0); never below 0"""
+    if b is None:
+        return a
+    if a is None or b >= a - 1e-9:
+        return None
+    return a + math.log1p(-math.exp(b - a))
+
+
+def register_chart_functions(db):
+    """
+    Make hooli_logaddexp() and hooli_logsubexp() available to SQL on every connection.
+
+    They let the upserts in _bump() update trending atomically, so concurrent
+    writers can't lose each other's updates.  Must be called inside an app context.
+
+    Args:
+        db (SQLAlchemy): The Flask-SQLAlchemy instance.
+    """
+    from hooli_colab.databases import distinct_engines
+
+    for engine in distinct_engines(db).values():
+
+        @event.listens_for(engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            dbapi_connection.create_function(
+                "hooli_logaddexp", 2, _logaddexp, deterministic=True
+            )
+            dbapi_connection.create_function(
+                "hooli_logsubexp", 2, _logsubexp, deterministic=True
+            )
+
+
+def _days(when):
+    """days since EPOCH of a naive UTC datetime (what sqlite timestamps are), None for now"""
+    if when is None:
+        when = datetime.now(timezone.utc)
+    elif when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return (when - EPOCH).total_seconds() / 86400
+
+
+def decay_rate():
+    """lambda per day for the configured half-life"""
+    return math.log(2) / current_app.config["CHART_HALF_LIFE_DAYS"]
+
+
+def trending_key(weight, when=None):
+    """
+    Return the log-space contribution of an event to a file's trending key.
+
+    Args:
+        weight (float): The event's weight from CHART_TRENDING_WEIGHTS.
+        when (datetime, optional): When it happened, naive UTC.  Defaults to now.
+
+    Returns:
+        float: log(weight) + lambda * days since EPOCH, or None for a zero weight.
+    """
+    if weight <= 0:
+        return None
+    return math.log(weight) + decay_rate() * _days(when)
+
+
+def trending_score(key, now=None):
+    """the current decayed score of a trending key, for display"""
+    if key is None:
+        return 0.0
+    return math.exp(key - decay_rate() * _days(now))
+
+
+def _bump(
+    media_file_id, likes=0, ratings=0, rating_sum=0, comments=0, plays=0, add=None, remove=None
+):
+    """
+    Apply deltas to a file's stats row in the current session, and queue the
+    new counts to be published to live pages on commit.  Doesn't commit.
+
+    Args:
+        media_file_id (int): The media file.
+        likes, ratings, rating_sum, comments, plays (int): Deltas for the counters.
+        add (float, optional): Trending key contribution to add.
+        remove (float, optional): Trending key contribution to take away.
+    """
+    from hooli_colab import db
+
+    session = db.session
+    bind = session.get_bind(mapper=MediaFileStats)
+    params = {
+        "media_file_id": media_file_id,
+        "likes": likes,
+        "ratings": ratings,
+        "rating_sum": rating_sum,
+        "comments": comments,
+        "plays": plays,
+        "add": add,
+        "remove": remove,
+        "min_votes": current_app.config["CHART_MIN_VOTES"],
+    }
+    if ratings or rating_sum:
+        session.execute(
+            text(
+                "INSERT INTO chart_totals (id, rating_count, rating_sum)"
+                " VALUES (1, :ratings, :rating_sum)"
+                " ON CONFLICT (id) DO UPDATE SET"
+                " rating_count = rating_count + excluded.rating_count,"
+                " rating_sum = rating_sum + excluded.rating_sum"
+            ),
+            params,
+            bind_arguments={"bind": bind},
+        )
+    counts = session.execute(
+        text(
+            "INSERT INTO media_file_stats"
+            " (media_file_id, directory_id, like_count, rating_count, rating_sum,"
+            " comment_count, play_count, trending)"
+            " VALUES (:media_file_id,"
+            " (SELECT directory_id FROM media_file WHERE id = :media_file_id),"
+            " :likes, :ratings, :rating_sum, :comments, :plays,"
+            " hooli_logsubexp(:add, :remove))"
+            " ON CONFLICT (media_file_id) DO UPDATE SET"
+            " like_count = like_count + excluded.like_count,"
+            " rating_count = rating_count + excluded.rating_count,"
+            " rating_sum = rating_sum + excluded.rating_sum,"
+            " comment_count = comment_count + excluded.comment_count,"
+            " play_count = play_count + excluded.play_count,"
+            " trending = hooli_logsubexp(hooli_logaddexp(trending, :add), :remove)"
+            " RETURNING directory_id, like_count, rating_count, rating_sum, comment_count,"
+            " play_count"
+        ),
+        params,
+        bind_arguments={"bind": bind},
+    ).one()
+    if ratings or rating_sum:
+        session.execute(
+            text(
+                "UPDATE media_file_stats SET top_rated = CASE WHEN rating_count > 0 THEN"
+                " (:min_votes * (SELECT 1.0 * rating_sum / rating_count FROM chart_totals"
+                " WHERE id = 1) + rating_sum) / (:min_votes + rating_count) END"
+                " WHERE media_file_id = :media_file_id"
+            ),
+            params,
+            bind_arguments={"bind": bind},
+        )
+
+    # live count updates for open pages, sent once this commits
+    queue_event(
+        session,
+        [f"file:{media_file_id}", f"directory:{counts.directory_id}"],
+        "counts",
+        {
+            "media_file_id": media_file_id,
+            "delta": {
+                "likes": likes,
+                "ratings": ratings,
+                "rating_sum": rating_sum,
+                "comments": comments,
+                "plays": plays,
+            },
+            "likes": counts.like_count,
+            "ratings": counts.rating_count,
+            "rating_sum": counts.rating_sum,
+            "comments": counts.comment_count,
+            "plays": counts.play_count,
+        },
+    )
+
+
+def _weight(kind):
+    return current_app.config["CHART_TRENDING_WEIGHTS"].get(kind, 0.0)
+
+
+def record_like(media_file_id, liked, when=None):
+    """
+    Count a like or an unlike in the charts.  Doesn't commit.
+
+    Args:
+        media_file_id (int): The media file.
+        liked (bool): True for a new like, False for a removed one.
+        when (datetime, optional): The like's timestamp, naive UTC.  For an
+            unlike this is when the removed like was made.  Defaults to now.
+    """
+    key = trending_key(_weight("like"), when)
+    if liked:
+        _bump(media_file_id, likes=1, add=key)
+    else:
+        _bump(media_file_id, likes=-1, remove=key)
+
+
+def record_rating(media_file_id, stars, previous=None, when=None):
+    """
+    Count a rating in the charts.  Doesn't commit.
+
+    Changing a rating moves top rated but isn't new activity, so only a
+    first rating counts towards trending.
+
+    Args:
+        media_file_id (int): The media file.
+        stars (int): The new rating.
+        previous (int, optional): The user's old rating, None for a first rating.
+        when (datetime, optional): When it was rated, naive UTC.  Defaults to now.
+    """
+    if previous is None:
+        _bump(
+            media_file_id,
+            ratings=1,
+            rating_sum=stars,
+            add=trending_key(_weight("rating"), when),
+        )
+    elif stars != previous:
+        _bump(media_file_id, rating_sum=stars - previous)
+
+
+def record_comment(media_file_id, added, when=None):
+    """
+    Count a new or deleted comment in the charts.  Doesn't commit.
+
+    Args:
+        media_file_id (int): The media file.
+        added (bool): True for a new comment, False for a deleted one.
+        when (datetime, optional): The comment's timestamp, naive UTC.  Defaults to now.
+    """
+    key = trending_key(_weight("comment"), when)
+    if added:
+        _bump(media_file_id, comments=1, add=key)
+    else:
+        _bump(media_file_id, comments=-1, remove=key)
+
+
+def record_plays(media_file_id, times):
+    """
+    Count plays in the charts.  Doesn't commit.
+
+    Args:
+        media_file_id (int): The media file.
+        times (list): When each play happened, as datetimes.
+    """
+    weight = _weight("play")
+    key = None
+    for when in times:
+        key = _logaddexp(key, trending_key(weight, when))
+    _bump(media_file_id, plays=len(times), add=key)
+
+
+def chart(name, directory_id=None, limit=50):
+    """
+    Read a chart from media_file_stats.
+
+    Args:
+        name (str): TRENDING, TOP_RATED, MOST_DISCUSSED or MOST_PLAYED.
+        directory_id (int, optional): Only files in this directory.  Defaults to the whole library.
+        limit (int, optional): Number of entries.  Defaults to 50.
+
+    Returns:
+        list: (MediaFileStats, MediaFile) tuples, best first.
+    """
+    from hooli_colab import db
+
+    column = CHARTS[name][1]
+    query = (
+        db.session.query(MediaFileStats, MediaFile)
+        .join(MediaFile, MediaFile.id == MediaFileStats.media_file_id)
+        .filter(column > 0 if name in COUNT_CHARTS else column.isnot(None))
+    )
+    if directory_id is not None:
+        query = query.filter(MediaFileStats.directory_id == directory_id)
+    return (
+        query.order_by(column.desc(), MediaFileStats.media_file_id.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def rebuild_charts():
+    """
+    Recompute media_file_stats and chart_totals from the likes, stars, comments
+    and play_count_daily tables.
+
+    This is the only place the whole tables are aggregated.  Must be called
+    inside an app context.
+
+    Returns:
+        dict: Counts of files with stats, likes, ratings, comments and plays.
+    """
+    from hooli_colab import db
+
+    stats = {}
+
+    def row(media_file_id):
+        if media_file_id not in stats:
+            stats[media_file_id] = {
+                "media_file_id": media_file_id,
+                "like_count": 0,
+                "rating_count": 0,
+                "rating_sum": 0,
+                "comment_count": 0,
+                "play_count": 0,
+                "trending": None,
+                "top_rated": None,
+            }
+        return stats[media_file_id]
+
+    counts = {"likes": 0, "ratings": 0, "comments": 0, "plays": 0}
+    sources = [
+        ("like", "likes", "like_count", db.session.query(
+            Likes.media_file_id, Likes.timestamp, db.literal(0)
+        )),
+        ("rating", "ratings", "rating_count", db.session.query(
+            Stars.media_file_id, Stars.timestamp, Stars.stars
+        )),
+        ("comment", "comments", "comment_count", db.session.query(
+            Comments.media_file_id, Comments.timestamp, db.literal(0)
+        )),
+    ]
+    for kind, counter, column, query in sources:
+        weight = _weight(kind)
+        for media_file_id, timestamp, stars in query.yield_per(5000):
+            entry = row(media_file_id)
+            entry[column] += 1
+            entry["rating_sum"] += stars
+            entry["trending"] = _logaddexp(entry["trending"], trending_key(weight, timestamp))
+            counts[counter] += 1
+
+    weight = _weight("play")
+    for media_file_id, day, plays in db.session.query(
+        PlayCountDaily.media_file_id, PlayCountDaily.day, PlayCountDaily.plays
+    ).yield_per(5000):
+        entry = row(media_file_id)
+        entry["play_count"] += plays
+        noon = datetime.combine(day, time(12))
+        entry["trending"] = _logaddexp(entry["trending"], trending_key(weight * plays, noon))
+        counts["plays"] += plays
+
+    total_ratings = sum(entry["rating_count"] for entry in stats.values())
+    total_stars = sum(entry["rating_sum"] for entry in stats.values())
+    mean = total_stars / total_ratings if total_ratings else 0.0
+    min_votes = current_app.config["CHART_MIN_VOTES"]
+    for entry in stats.values():
+        if entry["rating_count"]:
+            entry["top_rated"] = (min_votes * mean + entry["rating_sum"]) / (
+                min_votes + entry["rating_count"]
+            )
+
+    directories = dict(db.session.query(MediaFile.id, MediaFile.directory_id))
+    for entry in stats.values():
+        entry["directory_id"] = directories.get(entry["media_file_id"])
+
+    db.session.query(MediaFileStats).delete()
+    db.session.query(ChartTotals).delete()
+    if stats:
+        db.session.execute(db.insert(MediaFileStats), list(stats.values()))
+    db.session.add(ChartTotals(id=1, rating_count=total_ratings, rating_sum=total_stars))
+    db.session.commit()
+
+    counts["files"] = len(stats)
+    return counts
@@ -0,0 +1,215 @@
+""" hooli command line tools, run with "flask --app hooli_colab <command>" """
+
+import os
+
+import click
+from flask import Blueprint, current_app
+
+from hooli_colab import db
+from hooli_colab.assets import build_assets
+from hooli_colab.charts import rebuild_charts
+from hooli_colab.databases import BIND_TABLES, split_database, sqlite_path
+from hooli_colab.indexer import index_media, find_duplicates
+from hooli_colab.markup import rerender_comments
+from hooli_colab.schema import upgrade_schema
+from hooli_colab.storage import root_paths
+
+# registered by create_app; cli_group=None puts the commands at the top level
+bp = Blueprint("commands", __name__, cli_group=None)
+
+
+@bp.cli.command("upgrade-schema")
+def upgrade_schema_command():
+    """Create missing tables, columns and indexes."""
+    for change in upgrade_schema(db):
+        click.echo(change)
+
+
+@bp.cli.command("index")
+@click.option("--workers", type=int, default=None, help="Number of hashing processes.")
+def index_command(workers):
+    """Hash new and changed media files, re-link moved ones and analyze the new ones."""
+    from hooli_colab.analysis import analyze_media
+
+    report = index_media(root_paths(current_app.config), workers=workers)
+    click.echo(
+        "scanned {scanned}, hashed {hashed}, added {added}, moved {moved}, "
+        "updated {updated}, missing {missing}, {slugged} new urls".format(**report)
+    )
+    if report["changed"]:
+        analyzed = analyze_media(workers=workers, media_file_ids=report["changed"])
+        click.echo("analyzed {analyzed}, {unmeasured} couldn't be measured".format(**analyzed))
+    duplicates = find_duplicates()
+    if duplicates:
+        click.echo(f"{len(duplicates)} sets of duplicate files, see 'flask duplicates'")
+
+
+@bp.cli.command("duplicates")
+def duplicates_command():
+    """List media files with identical contents."""
+    for group in find_duplicates():
+        click.echo(group[0].content_hash)
+        for media_file in group:
+            click.echo(f"    {media_file.filepath} (id {media_file.id})")
+
+
+@bp.cli.command("build-assets")
+@click.option("--no-fetch", is_flag=True, help="Don't download missing vendor files.")
+def build_assets_command(no_fetch):
+    """Bundle, hash and precompress the static css and javascript."""
+    manifest = build_assets(os.path.join(current_app.root_path, "static"), fetch=not no_fetch)
+    for bundle, entry in manifest.items():
+        encodings = ", ".join(entry["encodings"])
+        click.echo(f"{bundle} -> dist/{entry['file']} ({entry['size']} bytes; {encodings})")
+
+
+@bp.cli.command("split-database")
+@click.argument("bind", type=click.Choice(sorted(BIND_TABLES)))
+@click.argument("target", type=click.Path(dir_okay=False))
+@click.option("--batch-size", type=int, default=5000, show_default=True)
+def split_database_command(bind, target, batch_size):
+    """Move the BIND tables out of media.db into TARGET while the app runs."""
+    source = sqlite_path(current_app.config["SQLALCHEMY_DATABASE_URI"])
+    moved = split_database(
+        source, target, BIND_TABLES[bind], batch_size=batch_size, echo=click.echo
+    )
+    for table, count in moved.items():
+        click.echo(f"{table}: {count} rows in {target}")
+    env_name = f"HOOLI_{bind.upper()}_DATABASE_URI"
+    click.echo(f"now restart the app with {env_name}=sqlite:///{os.path.abspath(target)}")
+
+
+@bp.cli.command("recommend")
+@click.option("--full", is_flag=True, help="Recompute every track, not just changed ones.")
+@click.option("--top-k", type=int, default=None, help="Neighbors to keep per track.")
+def recommend_command(full, top_k):
+    """Rebuild the "more like this" lists from likes and stars."""
+    from hooli_colab.recommender import rebuild_neighbors
+
+    top_k = top_k or current_app.config["RECOMMENDER_TOP_K"]
+    report = rebuild_neighbors(top_k=top_k, full=full)
+    click.echo(
+        "{tracks} tracks with engagement, {changed} changed, "
+        "{recomputed} recomputed, {dropped} dropped".format(**report)
+    )
+
+
+@bp.cli.command("rebuild-charts")
+def rebuild_charts_command():
+    """Recompute the charts from every like, rating, comment and day of plays."""
+    report = rebuild_charts()
+    click.echo(
+        "{files} files from {likes} likes, {ratings} ratings, "
+        "{comments} comments and {plays} plays".format(**report)
+    )
+
+
+@bp.cli.command("rollup-plays")
+def rollup_plays_command():
+    """Count the play log into the per-day play counts and the charts, and clear it."""
+    from hooli_colab.plays import roll_up
+
+    if not current_app.config["PLAYS_LOG_DIR"]:
+        raise click.ClickException("PLAYS_LOG_DIR isn't set")
+    report = roll_up(current_app.config)
+    click.echo(
+        "{plays} plays of {files} files from {segments} log files, "
+        "{unknown} of files no longer in the catalog".format(**report)
+    )
+
+
+@bp.cli.command("analyze")
+@click.option("--workers", type=int, default=None, help="Number of analysis processes.")
+@click.option("--all", "reanalyze", is_flag=True, help="Analyze every file again.")
+@click.option("--regain", is_flag=True, help="Only recompute gains from stored loudness.")
+def analyze_command(workers, reanalyze, regain):
+    """Measure loudness and peak of WAV files and set their playback gain."""
+    from hooli_colab.analysis import analyze_media, regain_media
+
+    if regain:
+        click.echo(f"{regain_media()} gains recomputed")
+        return
+    report = analyze_media(workers=workers, reanalyze=reanalyze)
+    click.echo("analyzed {analyzed}, {unmeasured} couldn't be measured".format(**report))
+
+
+@bp.cli.command("render-comments")
+@click.option("--all", "everything", is_flag=True, help="Re-render every comment.")
+def render_comments_command(everything):
+    """Re-render stored comment HTML after the markup policy changes."""
+    click.echo(f"{rerender_comments(everything=everything)} comments rendered")
+
+
+@bp.cli.command("export-jsonl")
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option("--resume", is_flag=True, help="Carry on an interrupted export of PATH.")
+def export_jsonl_command(path, resume):
+    """Write the catalog, users, comments, ratings and likes to PATH as JSONL."""
+    from hooli_colab.transfer import export_catalog
+
+    counts = export_catalog(path, resume=resume)
+    click.echo(", ".join(f"{kind}: {count}" for kind, count in counts.items()))
+
+
+@bp.cli.command("import-jsonl")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--resume", is_flag=True, help="Start after the last batch a previous run committed.")
+@click.option("--batch-size", type=int, default=5000, show_default=True)
+@click.option("--create-users", is_flag=True, help="Create missing users, inactive, no password.")
+def import_jsonl_command(path, resume, batch_size, create_users):
+    """Load a JSONL dump made by export-jsonl, matching rows by path and username."""
+    from hooli_colab.transfer import DumpError, import_catalog
+
+    try:
+        report = import_catalog(
+            path, batch_size=batch_size, resume=resume, create_users=create_users
+        )
+    except DumpError as e:
+        raise click.ClickException(str(e))
+    complete = report.pop("complete")
+    for kind, (loaded, skipped) in report.items():
+        click.echo(f"{kind}: {loaded} loaded, {skipped} skipped")
+    if not complete:
+        click.echo("the dump has no end line; it may be from an export that didn't finish")
+    click.echo("run 'flask rebuild-charts' to count the imported likes, ratings and comments")
+
+
+@bp.cli.command("backup")
+def backup_command():
+    """Snapshot every database file into BACKUP_DIR without blocking the app, then rotate."""
+    from hooli_colab.backup import BackupError, take_snapshot
+
+    try:
+        snapshot = take_snapshot(current_app.config, echo=click.echo)
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"snapshot in {snapshot['path']}")
+
+
+@bp.cli.command("rebalance-storage")
+@click.option("--limit", type=int, default=None, help="Most files to move.")
+@click.option("--dry-run", is_flag=True, help="Only list the moves.")
+def rebalance_storage_command(limit, dry_run):
+    """Move hot files onto the fast storage roots and cold ones off them."""
+    import time
+
+    from hooli_colab import storage
+
+    config = current_app.config
+    limit = config["STORAGE_MOVES_PER_PASS"] if limit is None else limit
+    try:
+        if dry_run:
+            for media_file, target in storage.plan_moves(config, storage.chart_heat())[:limit]:
+                source = media_file.storage_root or storage.MAIN
+                click.echo(f"{media_file.filepath}: {source} -> {target or storage.MAIN}")
+            return
+        report = storage.rebalance(config, limit=limit, echo=click.echo)
+    except storage.StorageError as e:
+        raise click.ClickException(str(e))
+    if report["old_copies"]:
+        # a download that looked a file up just before its switch may not have opened it yet
+        time.sleep(config["STORAGE_MOVE_GRACE_SECONDS"])
+        storage.delete_old_copies(config)
+    click.echo(
+        f"moved {report['moved']} files ({report['bytes']} bytes), {report['failed']} failed"
+    )
@@ -0,0 +1,64 @@
+""" hooli comment pages: a file's comments newest first, a page at a time
+
+view_media shows the first page and fetches the rest from /api/comments
+when asked, so a long thread costs the same to open as a short one.  Each
+page is one query: the comments joined to their authors' names (the users
+database is ATTACHed, see databases.py), read off the (media_file_id,
+timestamp, id) index from where the last page stopped, like the library's
+pages (see library.py, whose cursors these are).
+"""
+
+from sqlalchemy import String, func, tuple_, type_coerce
+
+from hooli_colab.library import decode_keyset, encode_cursor
+from hooli_colab.models import Comments, User
+
+
+def comment_count(media_file_id):
+    """how many comments a file has"""
+    from hooli_colab import db
+
+    return (
+        db.session.query(func.count(Comments.id))
+        .filter(Comments.media_file_id == media_file_id)
+        .scalar()
+    )
+
+
+def comment_page(media_file_id, cursor=None, limit=20):
+    """
+    One page of a file's comments, newest first.
+
+    Args:
+        media_file_id (int): The media file.
+        cursor (str, optional): The "next" of the previous page.  Defaults to the first page.
+        limit (int, optional): Comments per page.  Defaults to 20.
+
+    Returns:
+        dict: "comments", a list of (Comments, author's username or None),
+            and "next", the cursor for the next page, None on the last one.
+
+    Raises:
+        library.CursorError: For a bad cursor.
+    """
+    from hooli_colab import db
+
+    # compared as stored text, see library._sort_columns
+    timestamp = type_coerce(Comments.timestamp, String).label("timestamp_text")
+    columns = [timestamp, Comments.id]
+    query = (
+        db.session.query(Comments, User.username, *columns)
+        .outerjoin(User, User.id == Comments.user_id)
+        .filter(Comments.media_file_id == media_file_id)
+    )
+    if cursor is not None:
+        after = decode_keyset(cursor, (str, int))
+        query = query.filter(tuple_(*columns) < tuple_(*after))
+    rows = query.order_by(timestamp.desc(), Comments.id.desc()).limit(limit + 1).all()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "comments": [(row[0], row[1]) for row in rows],
+        "next": encode_cursor(list(rows[-1][2:])) if more else None,
+    }
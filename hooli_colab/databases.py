@@ -0,0 +1,211 @@
+""" hooli database files: attaching split binds, and splitting media.db online """
+
+import re
+import sqlite3
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# schema name each bind is attached under on the other binds' connections
+ATTACH_NAMES = {None: "catalog", "social": "social", "users": "users"}
+
+# tables that move out of media.db for each bind
+BIND_TABLES = {
+    "social": ["comments", "stars", "likes", "media_file_stats", "chart_totals"],
+    "users": ["user", "role", "roles_users"],
+}
+
+
+def sqlite_path(uri):
+    """return the file path of a sqlite:// database uri"""
+    return make_url(uri).database
+
+
+def share_bind_engines(db):
+    """
+    Make binds that point at the same database file use one engine.
+
+    Flask-SQLAlchemy gives every bind an engine of its own, so with the
+    default config, where the binds are all media.db, a transaction that
+    writes catalog and social tables held two connections to one file and
+    waited on its own write lock.  Sharing the engine puts them on one
+    connection and in one transaction.  Must be called inside an app
+    context, before the engines are used.
+
+    Args:
+        db (SQLAlchemy): The Flask-SQLAlchemy instance.
+    """
+    engines = db.engines
+    by_path = {engines[None].url.database: engines[None]}
+    for key in list(engines):
+        path = engines[key].url.database
+        if by_path.setdefault(path, engines[key]) is not engines[key]:
+            engines[key].dispose()
+            engines[key] = by_path[path]
+
+
+def distinct_engines(db):
+    """
+    Each engine once, after share_bind_engines.
+
+    Returns:
+        dict: Bind key -> engine, for the first bind key of each engine.
+    """
+    engines = {}
+    for key, engine in db.engines.items():
+        if engine not in engines.values():
+            engines[key] = engine
+    return engines
+
+
+def attach_bind_databases(db):
+    """
+    ATTACH each bind's database file to every other bind's connections.
+
+    SQLite resolves an unqualified table name by searching main and then each
+    attached database, so once e.g. social.db is attached to the catalog
+    connections a query that joins media_file against stars runs as a single
+    statement on one connection, same as when everything was in media.db.
+    Binds that point at the same file as another bind aren't attached.
+    Must be called inside an app context, after share_bind_engines and
+    before the engines are used.
+
+    Args:
+        db (SQLAlchemy): The Flask-SQLAlchemy instance.
+    """
+    paths = {key: engine.url.database for key, engine in db.engines.items()}
+
+    for key, engine in distinct_engines(db).items():
+        attach = {}
+        for other_key, path in paths.items():
+            if path == paths[key] or path in attach.values():
+                continue
+            attach[ATTACH_NAMES.get(other_key, other_key)] = path
+        if not attach:
+            continue
+
+        def on_connect(dbapi_connection, connection_record, attach=attach):
+            for name, path in attach.items():
+                if not re.fullmatch(r"\w+", name):
+                    raise ValueError(f"bad attach name {name!r}")
+                dbapi_connection.execute(f"ATTACH DATABASE ? AS {name}", (path,))
+
+        event.listen(engine, "connect", on_connect)
+
+
+def _has_integer_primary_key(conn, table):
+    """return True if the table's rowid is an INTEGER PRIMARY KEY column"""
+    pk_columns = [
+        row for row in conn.execute(f'PRAGMA main.table_info("{table}")') if row[5]
+    ]
+    return len(pk_columns) == 1 and pk_columns[0][2].upper() == "INTEGER"
+
+
+def split_database(
+    source_path, target_path, tables, batch_size=5000, pause=0.05, echo=print
+):
+    """
+    Move tables out of a live SQLite database into another file.
+
+    The rows are copied in small batches, each its own short transaction with
+    a pause in between, so the app keeps getting the write lock while this
+    runs.  Then, inside one BEGIN IMMEDIATE transaction, anything inserted,
+    changed or deleted during the copy is caught up and the tables are
+    dropped from the source.  That last step is the only time writers wait.
+
+    Restart the app with the bind pointing at target_path right after this
+    finishes; until then the old processes will fail writes to the moved
+    tables.
+
+    Args:
+        source_path (str): The database to move the tables out of (media.db).
+        target_path (str): The database to move them into; created if needed.
+        tables (list): Names of the tables to move.
+        batch_size (int, optional): Rows per copy transaction.  Defaults to 5000.
+        pause (float, optional): Seconds to sleep between batches.  Defaults to 0.05.
+        echo (callable, optional): Progress reporter.  Defaults to print.
+
+    Returns:
+        dict: Number of rows moved per table.
+    """
+    conn = sqlite3.connect(source_path, isolation_level=None, timeout=30)
+    conn.execute("ATTACH DATABASE ? AS target", (target_path,))
+
+    # create the tables and their indexes in the target using the source's own DDL
+    for table in tables:
+        rows = conn.execute(
+            "SELECT type, sql FROM main.sqlite_master"
+            " WHERE tbl_name = ? AND sql IS NOT NULL ORDER BY type DESC",
+            (table,),
+        ).fetchall()
+        if not rows:
+            raise ValueError(f"no table {table} in {source_path}")
+        exists = conn.execute(
+            "SELECT 1 FROM target.sqlite_master WHERE type = 'table' AND name = ?",
+            (table,),
+        ).fetchone()
+        if exists:
+            continue
+        target = sqlite3.connect(target_path)
+        with target:
+            for _, sql in rows:
+                target.execute(sql)
+        target.close()
+
+    # online bulk copy in small transactions
+    copied = {}
+    for table in tables:
+        last_rowid = conn.execute(
+            f'SELECT coalesce(max(rowid), 0) FROM target."{table}"'
+        ).fetchone()[0]
+        copied[table] = 0
+        while True:
+            conn.execute("BEGIN")
+            cursor = conn.execute(
+                f'INSERT INTO target."{table}" SELECT * FROM main."{table}"'
+                " WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size),
+            )
+            count = cursor.rowcount
+            last_rowid = conn.execute(
+                f'SELECT coalesce(max(rowid), 0) FROM target."{table}"'
+            ).fetchone()[0]
+            conn.execute("COMMIT")
+            copied[table] += count
+            if count < batch_size:
+                break
+            echo(f"{table}: {copied[table]} rows copied")
+            time.sleep(pause)
+
+    # short locked catch-up: new rows, changed rows, deleted rows, then drop
+    start = time.monotonic()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        moved = {}
+        for table in tables:
+            if _has_integer_primary_key(conn, table):
+                conn.execute(
+                    f'INSERT OR REPLACE INTO target."{table}"'
+                    f' SELECT * FROM main."{table}" EXCEPT SELECT * FROM target."{table}"'
+                )
+                conn.execute(
+                    f'DELETE FROM target."{table}"'
+                    f' WHERE rowid NOT IN (SELECT rowid FROM main."{table}")'
+                )
+            else:
+                # no stable key to diff on (roles_users), it's small, recopy it
+                conn.execute(f'DELETE FROM target."{table}"')
+                conn.execute(f'INSERT INTO target."{table}" SELECT * FROM main."{table}"')
+            moved[table] = conn.execute(
+                f'SELECT count(*) FROM target."{table}"'
+            ).fetchone()[0]
+            conn.execute(f'DROP TABLE main."{table}"')
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    echo(f"writers were locked out for {time.monotonic() - start:.3f}s")
+    return moved
@@ -1,10 +1,34 @@
 """ assorted doodads for hooli """
 
+import logging
+
 from flask import current_app
 
+# max_rating -> star strings for every half step from 0 to max_rating
+_star_strings = {}
+
+
+def _build_star_strings(max_rating):
+    filled_star = "★"
+    half_star = "⭐"
+    empty_star = "☆"
+
+    strings = []
+    for half_steps in range(2 * max_rating + 1):
+        full, half = divmod(half_steps, 2)
+        strings.append(
+            filled_star * full + half_star * half + empty_star * (max_rating - full - half)
+        )
+    return strings
+
+
 def rating_to_stars(rating, max_rating=5):
     """
     Returns a string representation of a star rating.
+
+    The strings are built once per max_rating and looked up by the number of
+    whole half stars in the rating, since that's all that changes the result.
+
     Args:
         rating (float): The rating value to be converted into stars.
         max_rating (int, optional): The maximum possible rating. Defaults to 5.
@@ -13,27 +37,27 @@ def rating_to_stars(rating, max_rating=5):
              represent full points, half stars (⭐) represent half points, and empty stars (☆)
              represent no points.
     """
-    filled_star = "★"
-    half_star = "⭐"
-    empty_star = "☆"
+    strings = _star_strings.get(max_rating)
+    if strings is None:
+        strings = _star_strings[max_rating] = _build_star_strings(max_rating)
+    return strings[min(max(int(rating * 2), 0), 2 * max_rating)]
+
 
-    stars = ""
-    for i in range(1, max_rating + 1):
-        if rating >= i:
-            stars += filled_star
-        elif rating >= i - 0.5:
-            stars += half_star
-        else:
-            stars += empty_star
-    return stars
-
-def log_message(message, *args, level="info"):
-    """ log a message to the application logger """
-    if level.lower() == 'info':
-        current_app.logger.info(message, *args)
-    elif level.lower() == 'warning':
-        current_app.logger.warning(message, *args)
-    elif level.lower() == 'error':
-        current_app.logger.error(message, *args)
-    else:
-        current_app.logger.debug(message, *args)
+def log_message(message, *args, level="info", exc_info=False, **fields):
+    """
+    Log a message to the application logger.
+
+    Args:
+        message (str): The message, %-formatted with args.
+        level (str, optional): debug, info, warning or error.  Defaults to info.
+        exc_info (bool, optional): Include the exception being handled.
+        **fields: Extra values for the JSON log line, e.g. event="login".
+    """
+    levels = {"info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+    current_app.logger.log(
+        levels.get(level.lower(), logging.DEBUG),
+        message,
+        *args,
+        exc_info=exc_info,
+        extra={"fields": fields},
+    )
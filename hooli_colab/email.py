@@ -1,12 +1,15 @@
 """ hooli stuff for sending an email """
 
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
 from flask import current_app
 
+from hooli_colab.doodads import log_message
+
 
 def send_email(to_email, subject, content):
     """Send an email using SendGrid API"""
+    # sendgrid is slow to import and only needed once someone gets an email
+    from sendgrid import SendGridAPIClient
+    from sendgrid.helpers.mail import Mail
 
     message = Mail(
         from_email=current_app.config["MAIL_DEFAULT_SENDER"],
@@ -17,11 +20,15 @@ def send_email(to_email, subject, content):
     try:
         sg = SendGridAPIClient(current_app.config["SENDGRID_API_KEY"])
         response = sg.send(message)
-        print(f"Status Code: {response.status_code}")
-        print(f"Body: {response.body}")
-        print(f"Headers: {response.headers}")
-    except Exception as e:
-        print(f"SendGrid Error: {str(e)}")
+        log_message(
+            "sent %r",
+            subject,
+            event="email",
+            status=response.status_code,
+            message_id=response.headers.get("X-Message-Id"),
+        )
+    except Exception:
+        log_message("sending %r failed", subject, level="error", exc_info=True, event="email")
 
 
 def send_mail_task(msg):
@@ -0,0 +1,382 @@
+""" hooli engagement writes (likes and ratings), applied directly or write-behind
+
+With ENGAGEMENT_WRITE_BEHIND off (the default) every like and rating is its
+own transaction, same as always.  With it on, set_like() and set_rating()
+just record the event in an in-process buffer and return; a flusher thread
+coalesces the buffer per (user, file) and commits everything in a single
+transaction every ENGAGEMENT_FLUSH_MS milliseconds.  A burst of a thousand
+likes on a new album becomes a handful of transactions.
+
+Reads made in the process that buffered an event see it straight away
+(pending_like, pending_rating); other processes, and so other users under a
+server with several workers, see it after that process's next flush.  That's
+why the like button sends the state it wants rather than a toggle: a second
+click may reach a worker that hasn't seen the first yet.
+
+Crash safety: without a journal, events still in the buffer when the process
+dies are lost, at most ENGAGEMENT_FLUSH_MS worth.  With ENGAGEMENT_JOURNAL_DIR
+set, each event is appended to a per-process journal file before the request
+returns, and the journal is only discarded after the transaction holding its
+events has committed.  On startup any journal left behind by a dead process
+is claimed and replayed.  Replaying is harmless even if the events had already
+been committed, since every event sets an absolute state ("liked", "3 stars")
+rather than toggling.  ENGAGEMENT_JOURNAL_FSYNC additionally fsyncs every
+append, which survives power loss too at the cost of a disk flush per event.
+"""
+
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+
+from hooli_colab.charts import record_like, record_rating
+from hooli_colab.models import Likes, Stars
+
+LIKE = "like"
+RATING = "rating"
+
+# returned by the pending_* functions when nothing is buffered for the key
+NOT_PENDING = object()
+
+
+def apply_like(user_id, media_file_id, liked, ip_address):
+    """
+    Make the session's likes table say whether the user likes the file, and
+    count the change in the charts.  Doesn't commit.
+
+    Args:
+        user_id (int): The user.
+        media_file_id (int): The media file.
+        liked (bool): True to like, False to unlike.
+        ip_address (str): Where the request came from.
+    """
+    from hooli_colab import db
+
+    like = Likes.query.filter_by(user_id=user_id, media_file_id=media_file_id).first()
+    if liked and like is None:
+        db.session.add(
+            Likes(user_id=user_id, media_file_id=media_file_id, ip_address=ip_address)
+        )
+        record_like(media_file_id, True)
+    elif not liked and like is not None:
+        db.session.delete(like)
+        record_like(media_file_id, False, when=like.timestamp)
+
+
+def apply_rating(user_id, media_file_id, stars, ip_address):
+    """
+    Insert or update the user's rating of the file, and count it in the charts.  Doesn't commit.
+
+    Args:
+        user_id (int): The user.
+        media_file_id (int): The media file.
+        stars (int): The rating, 1 to 5.
+        ip_address (str): Where the request came from.
+    """
+    from hooli_colab import db
+
+    rating = Stars.query.filter_by(user_id=user_id, media_file_id=media_file_id).first()
+    if rating is not None:
+        record_rating(media_file_id, stars, previous=rating.stars)
+        rating.stars = stars
+    else:
+        record_rating(media_file_id, stars)
+        db.session.add(
+            Stars(
+                user_id=user_id,
+                media_file_id=media_file_id,
+                stars=stars,
+                ip_address=ip_address,
+            )
+        )
+
+
+APPLY = {LIKE: apply_like, RATING: apply_rating}
+
+
+class EngagementBuffer:
+    """
+    Coalescing write-behind buffer for likes and ratings.
+
+    Attributes:
+        app (Flask): The app, for the flusher's app context.
+        flush_interval (float): Seconds between flushes.
+        max_pending (int): Flush early once this many keys are buffered.
+        journal_dir (str): Directory for the journals, or None for no journal.
+        fsync (bool): fsync the journal after every append.
+    """
+
+    def __init__(self, app, flush_interval, max_pending=5000, journal_dir=None, fsync=False):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {}
+        self._flushing = {}
+        self._journal_fd = None
+        self._pid = None
+        self._thread = None
+
+    def _journal_path(self, suffix=""):
+        return os.path.join(self.journal_dir, f"engagement-{os.getpid()}.jsonl{suffix}")
+
+    def start(self):
+        """
+        Start the flusher in this process, replaying any journals dead processes
+        left behind; after a fork the parent's thread is gone.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pending = {}
+            self._flushing = {}
+            if self.journal_dir is not None:
+                os.makedirs(self.journal_dir, exist_ok=True)
+                self._journal_fd = os.open(
+                    self._journal_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600
+                )
+                self._recover()
+                if self._pending:
+                    self._wake.set()  # commit the recovered events without waiting
+            self._thread = threading.Thread(
+                target=self._run, name="engagement-flusher", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.flush)
+            self._pid = os.getpid()
+
+    def _recover(self):
+        """claim journals left behind by processes that are gone and buffer their events"""
+        for path in glob.glob(os.path.join(self.journal_dir, "engagement-*.jsonl*")):
+            pid = os.path.basename(path).split("-")[1].split(".")[0]
+            if int(pid) == os.getpid() or _pid_alive(int(pid)):
+                continue
+            claimed = self._journal_path(f".recovered-{pid}-{time.time_ns()}")
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # another worker got it first
+            with open(claimed) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line from the crash
+                    self._pending[_key(event)] = event
+            with self._lock:
+                self._write_journal(list(self._pending.values()))
+            os.remove(claimed)
+
+    def _write_journal(self, events):
+        if self._journal_fd is None or not events:
+            return
+        data = "".join(json.dumps(event) + "\n" for event in events).encode()
+        os.write(self._journal_fd, data)
+        if self.fsync:
+            os.fsync(self._journal_fd)
+
+    def add(self, kind, user_id, media_file_id, value, ip_address):
+        """
+        Buffer an event.  The last event for a (kind, user, file) wins.
+
+        Args:
+            kind (str): LIKE or RATING.
+            user_id (int): The user.
+            media_file_id (int): The media file.
+            value: True/False for a like, the number of stars for a rating.
+            ip_address (str): Where the request came from.
+        """
+        self.start()
+        event = {
+            "kind": kind,
+            "user_id": user_id,
+            "media_file_id": media_file_id,
+            "value": value,
+            "ip_address": ip_address,
+        }
+        with self._lock:
+            self._write_journal([event])
+            self._pending[_key(event)] = event
+            if len(self._pending) >= self.max_pending:
+                self._wake.set()
+
+    def pending(self, kind, user_id, media_file_id):
+        """return the buffered value for the key, or NOT_PENDING"""
+        if self._pid != os.getpid():
+            return NOT_PENDING
+        key = (kind, user_id, media_file_id)
+        with self._lock:
+            event = self._pending.get(key) or self._flushing.get(key)
+        return NOT_PENDING if event is None else event["value"]
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:  # keep flushing; the events went back in the buffer
+                self.app.logger.exception("engagement flush failed")
+
+    def flush(self):
+        """
+        Commit everything buffered so far in one transaction.
+
+        Returns:
+            int: The number of coalesced events written.
+        """
+        from hooli_colab import db
+
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                if not batch:
+                    return 0
+                # still visible to pending() until it's committed
+                self._flushing = batch
+                flushing = None
+                if self._journal_fd is not None:
+                    # events that arrive during the commit go to a fresh journal
+                    os.close(self._journal_fd)
+                    flushing = self._journal_path(f".flushing-{time.time_ns()}")
+                    os.rename(self._journal_path(), flushing)
+                    self._journal_fd = os.open(
+                        self._journal_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600
+                    )
+
+            try:
+                with self.app.app_context():
+                    for event in batch.values():
+                        APPLY[event["kind"]](
+                            event["user_id"],
+                            event["media_file_id"],
+                            event["value"],
+                            event["ip_address"],
+                        )
+                    db.session.commit()
+            except Exception:
+                with self._lock:
+                    # anything newer that arrived meanwhile wins over the failed batch
+                    batch.update(self._pending)
+                    self._pending = batch
+                    self._flushing = {}
+                    self._write_journal(list(batch.values()))
+                if flushing is not None:
+                    os.remove(flushing)
+                raise
+
+            with self._lock:
+                self._flushing = {}
+            if flushing is not None:
+                os.remove(flushing)
+            return len(batch)
+
+
+def _key(event):
+    return (event["kind"], event["user_id"], event["media_file_id"])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def init_engagement(app):
+    """
+    Set up the write-behind buffer if ENGAGEMENT_WRITE_BEHIND is on.
+
+    The flusher thread starts, and recovers the journals of dead processes, with
+    the first request each process handles (or its first event, outside a
+    request), so it's created in the worker process rather than in a parent
+    that forks.
+
+    Args:
+        app (Flask): The app.
+    """
+    if not app.config.get("ENGAGEMENT_WRITE_BEHIND"):
+        return
+    buffer = EngagementBuffer(
+        app,
+        flush_interval=app.config["ENGAGEMENT_FLUSH_MS"] / 1000,
+        max_pending=app.config["ENGAGEMENT_MAX_PENDING"],
+        journal_dir=app.config["ENGAGEMENT_JOURNAL_DIR"],
+        fsync=app.config["ENGAGEMENT_JOURNAL_FSYNC"],
+    )
+    app.extensions["engagement_buffer"] = buffer
+    app.before_request(buffer.start)
+
+
+def _buffer():
+    from flask import current_app
+
+    return current_app.extensions.get("engagement_buffer")
+
+
+def set_like(user_id, media_file_id, liked, ip_address):
+    """
+    Like or unlike a file, through the write-behind buffer if it's enabled.
+
+    Args:
+        user_id (int): The user.
+        media_file_id (int): The media file.
+        liked (bool): True to like, False to unlike.
+        ip_address (str): Where the request came from.
+    """
+    from hooli_colab import db
+
+    buffer = _buffer()
+    if buffer is not None:
+        buffer.add(LIKE, user_id, media_file_id, liked, ip_address)
+        return
+    apply_like(user_id, media_file_id, liked, ip_address)
+    db.session.commit()
+
+
+def set_rating(user_id, media_file_id, stars, ip_address):
+    """
+    Rate a file, through the write-behind buffer if it's enabled.
+
+    Args:
+        user_id (int): The user.
+        media_file_id (int): The media file.
+        stars (int): The rating, 1 to 5.
+        ip_address (str): Where the request came from.
+    """
+    from hooli_colab import db
+
+    buffer = _buffer()
+    if buffer is not None:
+        buffer.add(RATING, user_id, media_file_id, stars, ip_address)
+        return
+    apply_rating(user_id, media_file_id, stars, ip_address)
+    db.session.commit()
+
+
+def pending_like(user_id, media_file_id):
+    """return the user's not yet flushed like state for the file, or NOT_PENDING"""
+    buffer = _buffer()
+    if buffer is None:
+        return NOT_PENDING
+    return buffer.pending(LIKE, user_id, media_file_id)
+
+
+def pending_rating(user_id, media_file_id):
+    """return the user's not yet flushed rating for the file, or NOT_PENDING"""
+    buffer = _buffer()
+    if buffer is None:
+        return NOT_PENDING
+    return buffer.pending(RATING, user_id, media_file_id)
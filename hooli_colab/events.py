@@ -0,0 +1,233 @@
+""" hooli live updates: in-process pub/sub of count changes, streamed as server-sent events
+
+When a like, rating or comment is committed its new counts are published to
+the file's channel and its directory's channel.  Pages hold an EventSource on
+one channel and patch the numbers in place instead of reloading.
+
+Every event gets an id; the last EVENTS_BUFFER_SIZE are kept so a client that
+reconnects with Last-Event-ID is sent what it missed.  If what it missed is no
+longer buffered, or it was connected to another process (ids carry a per-
+process prefix), it's sent a "reset" event and should reload its counts.
+Each open stream holds a server thread, so at most EVENTS_MAX_SUBSCRIBERS are
+allowed per process; past that the endpoint answers 503.
+
+Publishing is per process.  With several worker processes a subscriber sees
+the changes made through its own process live and the rest on its next reset.
+"""
+
+import itertools
+import json
+import os
+import queue
+import threading
+from collections import deque
+
+from sqlalchemy import event
+
+# session.info key for events waiting for their transaction to commit
+PENDING_KEY = "hooli_pending_events"
+
+
+class TooManySubscribers(Exception):
+    """raised by EventBroker.subscribe when EVENTS_MAX_SUBSCRIBERS streams are open"""
+
+
+class Subscription:
+    """
+    One open stream's queue of events.
+
+    Attributes:
+        channels (set): The channels it listens to.
+        overflowed (bool): Set if the client fell too far behind and events were dropped.
+    """
+
+    def __init__(self, channels, queue_size):
+        self.channels = set(channels)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+    def offer(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.overflowed = True
+
+
+class EventBroker:
+    """
+    In-process publish/subscribe with a replay buffer.
+
+    Attributes:
+        buffer_size (int): Events kept for Last-Event-ID replay.
+        max_subscribers (int): Streams allowed at once.
+        queue_size (int): Events a slow subscriber may have queued before it's reset.
+    """
+
+    def __init__(self, buffer_size=1000, max_subscribers=100, queue_size=100):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _reset_after_fork(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._prefix = f"{os.getpid():x}"
+        self._counter = itertools.count(1)
+        self._buffer = deque(maxlen=self.buffer_size)
+        self._subscribers = []
+
+    def publish(self, channels, event_type, data):
+        """
+        Send an event to everyone subscribed to any of the channels.
+
+        Args:
+            channels (list): Channel names, e.g. ["file:3", "directory:1"].
+            event_type (str): The SSE event name.
+            data (dict): The payload, sent as JSON.
+        """
+        with self._lock:
+            self._reset_after_fork()
+            number = next(self._counter)
+            item = (number, f"{self._prefix}-{number}", set(channels), event_type, data)
+            self._buffer.append(item)
+            for subscription in self._subscribers:
+                if subscription.channels & item[2]:
+                    subscription.offer(item)
+
+    def subscribe(self, channels, last_event_id=None):
+        """
+        Open a subscription.
+
+        Args:
+            channels (list): Channel names to listen to.
+            last_event_id (str, optional): The Last-Event-ID the client reconnected with.
+
+        Returns:
+            tuple: (Subscription, replay) where replay is the list of missed
+                events, or None if they can't be replayed and the client should reset.
+
+        Raises:
+            TooManySubscribers: If max_subscribers streams are already open.
+        """
+        subscription = Subscription(channels, self.queue_size)
+        with self._lock:
+            self._reset_after_fork()
+            if len(self._subscribers) >= self.max_subscribers:
+                raise TooManySubscribers()
+            self._subscribers.append(subscription)
+            if not last_event_id:
+                return subscription, []
+            prefix, _, number = last_event_id.rpartition("-")
+            if prefix != self._prefix or not number.isdigit():
+                return subscription, None
+            number = int(number)
+            if self._buffer and number < self._buffer[0][0] - 1:
+                return subscription, None
+            replay = [
+                item
+                for item in self._buffer
+                if item[0] > number and subscription.channels & item[2]
+            ]
+            return subscription, replay
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+
+    def subscriber_count(self):
+        with self._lock:
+            self._reset_after_fork()
+            return len(self._subscribers)
+
+
+def format_event(event_id, event_type, data):
+    """return one event in text/event-stream format"""
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream(broker, subscription, replay, heartbeat):
+    """
+    Generate the text/event-stream body for a subscription until the client goes away.
+
+    Args:
+        broker (EventBroker): The broker, to unsubscribe at the end.
+        subscription (Subscription): The open subscription.
+        replay (list): Missed events to send first, or None to send a reset.
+        heartbeat (float): Seconds of quiet after which a comment line is sent,
+            which keeps proxies from closing the connection and notices dead clients.
+
+    Yields:
+        str: Chunks of the response.
+    """
+    try:
+        yield "retry: 3000\n\n"
+        if replay is None:
+            yield "event: reset\ndata: {}\n\n"
+        else:
+            for _, event_id, _, event_type, data in replay:
+                yield format_event(event_id, event_type, data)
+        while True:
+            try:
+                _, event_id, _, event_type, data = subscription.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield format_event(event_id, event_type, data)
+            if subscription.overflowed:
+                # the client is too slow to keep up; it reloads and reconnects
+                yield "event: reset\ndata: {}\n\n"
+                return
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def queue_event(session, channels, event_type, data):
+    """
+    Publish an event once the session's transaction commits; dropped if it rolls back.
+
+    Args:
+        session (Session): The session doing the write.
+        channels (list): Channel names.
+        event_type (str): The SSE event name.
+        data (dict): The payload.
+    """
+    session.info.setdefault(PENDING_KEY, []).append((channels, event_type, data))
+
+
+def _publish_pending(session):
+    from flask import current_app
+
+    pending = session.info.pop(PENDING_KEY, [])
+    broker = current_app.extensions.get("event_broker") if pending else None
+    if broker is None:
+        return
+    for channels, event_type, data in pending:
+        broker.publish(channels, event_type, data)
+
+
+def _drop_pending(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+
+
+def init_events(app, db):
+    """
+    Create the app's broker and publish queued events when db.session commits.
+
+    db.session is shared by every app, so the session listeners are added
+    once and publish to the broker of the app whose context the commit is in.
+
+    Args:
+        app (Flask): The app.
+        db (SQLAlchemy): The Flask-SQLAlchemy instance.
+    """
+    app.extensions["event_broker"] = EventBroker(
+        buffer_size=app.config["EVENTS_BUFFER_SIZE"],
+        max_subscribers=app.config["EVENTS_MAX_SUBSCRIBERS"],
+    )
+    if not event.contains(db.session, "after_commit", _publish_pending):
+        event.listen(db.session, "after_commit", _publish_pending)
+        event.listen(db.session, "after_soft_rollback", _drop_pending)
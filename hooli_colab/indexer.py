@@ -0,0 +1,335 @@
+""" hooli media indexer: walk the media tree, hash contents, track moved files """
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import func
+
+from hooli_colab.models import (
+    MediaDirectory,
+    MediaFile,
+    MediaFileStats,
+    Comments,
+    Stars,
+    Likes,
+)
+from hooli_colab.slugs import assign_slugs, retire_file_slug
+
+MEDIA_EXTENSIONS = (".mp3", ".wav", ".mp4", ".avi", ".pdf")
+
+# read files a megabyte at a time so hashing a long wav doesn't pull the
+# whole thing into memory
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# below this many files it isn't worth spinning up a process pool
+POOL_THRESHOLD = 4
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Compute the SHA-256 of a file using chunked reads into a reused buffer.
+
+    Args:
+        path (str): Full path of the file to hash.
+        chunk_size (int, optional): Size of each read. Defaults to HASH_CHUNK_SIZE.
+
+    Returns:
+        str: The hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            nread = f.readinto(buf)
+            if not nread:
+                break
+            digest.update(view[:nread])
+    return digest.hexdigest()
+
+
+def _hash_job(path):
+    """process pool worker: return (path, hexdigest), digest is None if unreadable"""
+    try:
+        return path, hash_file(path)
+    except OSError:
+        return path, None
+
+
+def hash_files(paths, workers=None):
+    """
+    Hash many files, in a process pool if there are enough of them.
+
+    Args:
+        paths (list): Full paths of the files to hash.
+        workers (int, optional): Number of worker processes.  Defaults to the CPU count.
+
+    Returns:
+        dict: Map of path to hex digest (None for files that couldn't be read).
+    """
+    if len(paths) < POOL_THRESHOLD or workers == 1:
+        return dict(_hash_job(path) for path in paths)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return dict(pool.map(_hash_job, paths, chunksize=8))
+
+
+def is_media_filename(name):
+    """return True if the filename has one of the extensions we index"""
+    return name.lower().endswith(MEDIA_EXTENSIONS)
+
+
+def scan_media_root(media_root):
+    """
+    Walk the media tree and stat every media file.
+
+    Args:
+        media_root (str): Root directory of the media library.
+
+    Returns:
+        dict: Map of path relative to media_root to its os.stat_result.
+    """
+    found = {}
+    for dirpath, dirnames, filenames in os.walk(media_root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for name in filenames:
+            if not is_media_filename(name):
+                continue
+            full_path = os.path.join(dirpath, name)
+            try:
+                found[os.path.relpath(full_path, media_root)] = os.stat(full_path)
+            except OSError:
+                continue
+    return found
+
+
+def stat_unchanged(media_file, st):
+    """return True if the row's cached (size, mtime, inode) still matches the file"""
+    return (
+        media_file.content_hash is not None
+        and media_file.filesize == st.st_size
+        and media_file.mtime == st.st_mtime
+        and media_file.inode == st.st_ino
+    )
+
+
+def relative_dirpath(relative_filepath):
+    """directory part of a relative file path, '.' for the media root itself"""
+    return os.path.dirname(relative_filepath) or "."
+
+
+def get_or_create_directory(relative_dirpath, commit=True):
+    """Get or create a MediaDirectory object for the given directory path
+
+    Args:
+        relative_dirpath (str): The relative directory path.
+        commit (bool, optional): Commit a newly created directory right away.
+            The indexer passes False and commits once at the end.  Defaults to True.
+
+    Returns:
+        MediaDirectory: The MediaDirectory object for the given directory path.
+    """
+    from hooli_colab import db
+
+    directory = MediaDirectory.query.filter_by(dirpath=relative_dirpath).first()
+    if not directory:
+        directory = MediaDirectory(dirpath=relative_dirpath)
+        db.session.add(directory)
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
+    return directory
+
+
+def _has_social_data(media_file_id):
+    """return True if anybody has commented on, rated or liked the file"""
+    return any(
+        model.query.filter_by(media_file_id=media_file_id).first() is not None
+        for model in (Comments, Stars, Likes)
+    )
+
+
+def _apply_stat(media_file, relative_filepath, st, content_hash, storage_root=None):
+    if media_file.content_hash != content_hash:
+        # new contents need a new loudness analysis
+        media_file.loudness_lufs = None
+        media_file.peak_dbfs = None
+        media_file.gain_db = None
+    media_file.filepath = relative_filepath
+    media_file.filename = os.path.basename(relative_filepath)
+    media_file.filesize = st.st_size
+    media_file.mtime = st.st_mtime
+    media_file.inode = st.st_ino
+    media_file.content_hash = content_hash
+    media_file.storage_root = storage_root
+
+
+def index_media(media_root, workers=None):
+    """
+    Bring MediaFile rows in line with what's on disk.
+
+    Files whose size, mtime and inode match what was recorded the last time
+    they were hashed are skipped, so re-running the indexer over an unchanged
+    library only costs a stat per file.  Everything else is hashed in a
+    process pool.  A file that shows up at a new path with the same content as
+    a row whose file has disappeared is treated as a move: the existing row is
+    re-pointed at the new path so it keeps its comments, stars and likes.
+
+    Every directory above a media file gets a row too, so each level of the
+    tree can be browsed, and new rows get their URL slugs (see slugs.py).
+
+    With several storage roots (see storage.py) they're scanned as one tree,
+    and each row records the root its file was found in.  A file in two roots,
+    the old copy of one being moved, counts where its row already says it is.
+
+    Must be called inside an app context.
+
+    Args:
+        media_root (str or dict): Root directory of the media library, or
+            {storage root name: directory} for every storage root.
+        workers (int, optional): Number of hashing processes.  Defaults to the CPU count.
+
+    Returns:
+        dict: Counts of files scanned, hashed, added, moved, updated and
+            missing, and of slugs assigned, and "changed", the ids of the
+            added and updated files, whose loudness needs analyzing.
+    """
+    from hooli_colab import db
+
+    roots = media_root if isinstance(media_root, dict) else {None: media_root}
+    rows = {media_file.filepath: media_file for media_file in MediaFile.query.all()}
+    on_disk = {}
+    found_in = {}
+    for root_name, root in roots.items():
+        for rel, st in scan_media_root(root).items():
+            if rel in on_disk and (rel not in rows or rows[rel].storage_root != root_name):
+                continue
+            on_disk[rel] = st
+            found_in[rel] = root_name
+
+    def full_path(rel):
+        return os.path.join(roots[found_in[rel]], rel)
+
+    to_hash = [
+        rel
+        for rel, st in on_disk.items()
+        if rel not in rows
+        or not stat_unchanged(rows[rel], st)
+        or rows[rel].storage_root != found_in[rel]
+    ]
+    digests = hash_files([full_path(rel) for rel in to_hash], workers)
+
+    # rows whose file is gone are candidates for having been moved
+    vanished = {}
+    for rel, media_file in rows.items():
+        if rel not in on_disk and media_file.content_hash:
+            vanished.setdefault(media_file.content_hash, []).append(media_file)
+
+    report = {
+        "scanned": len(on_disk),
+        "hashed": len(to_hash),
+        "added": 0,
+        "moved": 0,
+        "updated": 0,
+        "missing": 0,
+        "slugged": 0,
+    }
+    directories = {}
+    changed = []
+    # media file id -> new directory id, for media_file_stats once the catalog is committed
+    moved_directories = {}
+
+    def directory_id_for_dirpath(dirpath):
+        if dirpath not in directories:
+            if dirpath != ".":
+                directory_id_for_dirpath(os.path.dirname(dirpath) or ".")
+            directories[dirpath] = get_or_create_directory(dirpath, commit=False).id
+        return directories[dirpath]
+
+    def directory_id_for(rel):
+        return directory_id_for_dirpath(relative_dirpath(rel))
+
+    for rel in on_disk:
+        directory_id_for(rel)
+
+    for rel in to_hash:
+        content_hash = digests.get(full_path(rel))
+        if content_hash is None:
+            continue
+        st = on_disk[rel]
+        media_file = rows.get(rel)
+        candidates = vanished.get(content_hash)
+
+        if media_file is not None and media_file.content_hash is None and candidates:
+            # something (browse_media used to) created a bare row for the new
+            # path before we got here; fold it into the old row unless it has
+            # already collected social data of its own
+            if not _has_social_data(media_file.id):
+                db.session.delete(media_file)
+                db.session.flush()
+                media_file = None
+
+        if media_file is None and candidates:
+            media_file = candidates.pop()
+            if media_file.directory_id != directory_id_for(rel):
+                # its URL is under the new directory now; the old one redirects to it
+                retire_file_slug(media_file)
+                media_file.directory_id = directory_id_for(rel)
+            moved_directories[media_file.id] = media_file.directory_id
+            _apply_stat(media_file, rel, st, content_hash, found_in[rel])
+            report["moved"] += 1
+        elif media_file is None:
+            media_file = MediaFile(
+                filetype=rel.rsplit(".", 1)[-1],
+                directory_id=directory_id_for(rel),
+            )
+            _apply_stat(media_file, rel, st, content_hash, found_in[rel])
+            db.session.add(media_file)
+            changed.append(media_file)
+            report["added"] += 1
+        else:
+            _apply_stat(media_file, rel, st, content_hash, found_in[rel])
+            changed.append(media_file)
+            report["updated"] += 1
+
+    report["missing"] = sum(len(files) for files in vanished.values())
+    db.session.commit()
+    # the social tables can be another database file, so this is a transaction of its own;
+    # if it doesn't happen "flask rebuild-charts" sets the directories from media_file
+    for media_file_id, directory_id in moved_directories.items():
+        MediaFileStats.query.filter_by(media_file_id=media_file_id).update(
+            {"directory_id": directory_id}
+        )
+    db.session.commit()
+    report["changed"] = [media_file.id for media_file in changed]
+    report["slugged"] = assign_slugs()
+    return report
+
+
+def find_duplicates():
+    """
+    Find media files that have identical contents.
+
+    Must be called inside an app context.
+
+    Returns:
+        list: One list of MediaFile objects per content hash shared by more than one file.
+    """
+    from hooli_colab import db
+
+    duplicate_hashes = (
+        db.session.query(MediaFile.content_hash)
+        .filter(MediaFile.content_hash.isnot(None))
+        .group_by(MediaFile.content_hash)
+        .having(func.count(MediaFile.id) > 1)
+        .subquery()
+    )
+    groups = {}
+    for media_file in (
+        MediaFile.query.filter(MediaFile.content_hash.in_(duplicate_hashes.select()))
+        .order_by(MediaFile.content_hash, MediaFile.filepath)
+        .all()
+    ):
+        groups.setdefault(media_file.content_hash, []).append(media_file)
+    return list(groups.values())
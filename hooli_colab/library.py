@@ -0,0 +1,156 @@
+""" hooli library: a user's liked and rated tracks and their comments, across every folder
+
+Each section is a page of the user's own rows from likes, stars or comments,
+read straight off a (user_id, ...) index in the order asked for and cut at
+the page size, then the page's media files fetched by id.  Pages are
+chained with an opaque cursor holding the sort key of the last row
+(keyset pagination), not an OFFSET, so page 50 of someone with ten thousand
+likes costs the same as page 1 of someone with ten.
+"""
+
+import base64
+import json
+
+from sqlalchemy import String, tuple_, type_coerce
+
+from hooli_colab.models import Comments, Likes, MediaFile, Stars
+
+LIKED = "liked"
+RATED = "rated"
+COMMENTS = "comments"
+SECTIONS = {LIKED: "Liked", RATED: "Rated", COMMENTS: "Comments"}
+
+RECENT = "recent"
+OLDEST = "oldest"
+TOP = "top"
+# sort -> title, per section
+SORTS = {
+    LIKED: {RECENT: "Newest", OLDEST: "Oldest"},
+    RATED: {RECENT: "Newest", OLDEST: "Oldest", TOP: "Highest rated"},
+    COMMENTS: {RECENT: "Newest", OLDEST: "Oldest"},
+}
+
+MODELS = {LIKED: Likes, RATED: Stars, COMMENTS: Comments}
+
+
+class CursorError(ValueError):
+    """raised for a cursor that this module didn't make"""
+
+
+def _sort_columns(section, sort):
+    """
+    The columns a section is ordered by; each index ends with the row id.
+
+    The timestamp is compared as the text SQLite holds, since rows written by
+    different code paths store it with and without fractional seconds, and
+    a parsed datetime bound back in wouldn't compare the way the index sorts.
+    """
+    model = MODELS[section]
+    timestamp = type_coerce(model.timestamp, String).label("timestamp_text")
+    if sort == TOP:
+        return [model.stars, timestamp, model.id]
+    return [timestamp, model.id]
+
+
+def encode_cursor(values):
+    """an opaque page cursor from the last row's sort key"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_keyset(cursor, types):
+    """
+    The sort key a cursor from encode_cursor holds, checked against types.
+
+    Args:
+        cursor (str): The cursor.
+        types (sequence): The type of each value in the key, str or int.
+
+    Raises:
+        CursorError: If it isn't a cursor with values of those types.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise CursorError("bad cursor")
+    if not isinstance(values, list) or len(values) != len(types):
+        raise CursorError("bad cursor")
+    for value, expected in zip(values, types):
+        # bool is an int too, but never one of ours
+        if not isinstance(value, expected) or isinstance(value, bool):
+            raise CursorError("bad cursor")
+    return values
+
+
+def decode_cursor(cursor, section, sort):
+    """
+    The sort key a cursor from encode_cursor holds.
+
+    Raises:
+        CursorError: If it isn't one, or is for a different sort.
+    """
+    columns = _sort_columns(section, sort)
+    return decode_keyset(
+        cursor, [str if column.key == "timestamp_text" else int for column in columns]
+    )
+
+
+def library_page(user_id, section, sort=RECENT, cursor=None, limit=50):
+    """
+    One page of a section of a user's library.
+
+    Args:
+        user_id (int): The user.
+        section (str): LIKED, RATED or COMMENTS.
+        sort (str, optional): One of SORTS[section].  Defaults to RECENT.
+        cursor (str, optional): The "next" of the previous page.  Defaults to the first page.
+        limit (int, optional): Entries per page.  Defaults to 50.
+
+    Returns:
+        dict: "entries", each {"media_file", "timestamp"} plus "stars" for
+            RATED and "comment" for COMMENTS, in order; and "next", the
+            cursor for the next page, None on the last one.
+
+    Raises:
+        ValueError: For an unknown section or sort.
+        CursorError: For a bad cursor.
+    """
+    from hooli_colab import db
+
+    if section not in SECTIONS or sort not in SORTS[section]:
+        raise ValueError(f"no {sort!r} sort for {section!r}")
+    model = MODELS[section]
+    columns = _sort_columns(section, sort)
+    descending = sort != OLDEST
+
+    # a likes row is a like (unliking deletes it), so every section is just the user's rows
+    query = db.session.query(model, *columns).filter(model.user_id == user_id)
+    if cursor is not None:
+        after = decode_cursor(cursor, section, sort)
+        key = tuple_(*columns)
+        query = query.filter(key < tuple_(*after) if descending else key > tuple_(*after))
+    order = [column.desc() if descending else column.asc() for column in columns]
+    results = query.order_by(*order).limit(limit + 1).all()
+
+    more = len(results) > limit
+    results = results[:limit]
+    rows = [result[0] for result in results]
+    media_files = {
+        media_file.id: media_file
+        for media_file in MediaFile.query.filter(
+            MediaFile.id.in_({row.media_file_id for row in rows})
+        )
+    }
+    entries = []
+    for row in rows:
+        media_file = media_files.get(row.media_file_id)
+        if media_file is None:
+            continue  # the file has been deleted since
+        entry = {"media_file": media_file, "timestamp": row.timestamp}
+        if section == RATED:
+            entry["stars"] = row.stars
+        elif section == COMMENTS:
+            entry["comment"] = row
+        entries.append(entry)
+    next_cursor = encode_cursor(list(results[-1][1:])) if more else None
+    return {"entries": entries, "next": next_cursor}
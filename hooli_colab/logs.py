@@ -0,0 +1,203 @@
+""" hooli logging: JSON log lines written off the request thread, with request ids and sampling
+
+The app logger gets a QueueHandler, so a request only formats its record and
+puts it on a queue; a QueueListener thread does the writing, and a slow or
+blocked stderr pipe under mod_wsgi no longer holds up requests or
+interleaves lines from different threads.
+
+Each record becomes one JSON object per line, with the time, level and
+message, whatever fields were passed in extra={"fields": {...}} (see
+doodads.log_message), and, for records made while handling a request, the
+request's id, method, route and user id.  The id comes from an X-Request-ID
+header the web server set, or is made up, and is sent back in the response's
+X-Request-ID.  Every request is logged once as a "request" event with its
+status and duration.
+
+LOG_SAMPLE_RATES keeps only a fraction of the INFO and DEBUG records for
+busy events, e.g. {"request": 0.1}; each kept one carries its sample_rate so
+counts can be scaled back up.  Warnings and errors are always kept.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from flask import g, has_request_context, request, request_started
+
+REQUEST_EVENT = "request"
+
+# request ids taken from the web server's X-Request-ID header must look like this
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def record_fields(record):
+    """the fields a record was logged with, see doodads.log_message"""
+    return getattr(record, "fields", None) or {}
+
+
+def request_fields():
+    """the current request's id, method, route and user id, for a log line"""
+    if not has_request_context():
+        return {}
+    fields = {"method": request.method}
+    if g.get("request_id"):
+        fields["request_id"] = g.request_id
+    fields["route"] = request.url_rule.rule if request.url_rule else request.path
+    # only if it's already been loaded, logging shouldn't cost a query
+    user = g.get("_login_user")
+    if user is not None and user.is_authenticated:
+        fields["user_id"] = user.id
+    return fields
+
+
+class JsonFormatter(logging.Formatter):
+    """formats a record as one line of JSON"""
+
+    def format(self, record):
+        line = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        line.update(request_fields())
+        line.update(record_fields(record))
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the INFO and DEBUG records of sampled events.
+
+    Attributes:
+        rates (dict): Event name -> fraction of its records kept, 0 to 1.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates or {})
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        fields = record_fields(record)
+        rate = self.rates.get(fields.get("event"))
+        if rate is None or rate >= 1:
+            return True
+        if random.random() >= rate:
+            return False
+        record.fields = {**fields, "sample_rate": rate}
+        return True
+
+
+class LogPipeline(logging.handlers.QueueHandler):
+    """
+    A QueueHandler whose listener thread starts the first time it's used in each process.
+
+    Records are formatted here, on the logging thread, while the request they
+    belong to is still current; the listener only writes the finished lines.
+
+    Attributes:
+        stream (file): Where the lines are written.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__(queue.SimpleQueue())
+        self.stream = stream
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._listener = None
+
+    def start(self):
+        """start the writer thread in this process if it isn't running yet"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            output = logging.StreamHandler(self.stream or sys.stderr)
+            output.setFormatter(logging.Formatter("%(message)s"))
+            self._listener = logging.handlers.QueueListener(self.queue, output)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """write out what's queued and stop the writer thread"""
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def enqueue(self, record):
+        self.start()
+        super().enqueue(record)
+
+
+def _start_request(sender, **extra):
+    request_id = request.headers.get("X-Request-ID", "")
+    g.request_id = request_id if _REQUEST_ID.match(request_id) else uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+
+
+def _log_request(response):
+    """after_request hook: log the request and send back its id"""
+    from flask import current_app
+
+    started = g.get("request_started")
+    duration = time.perf_counter() - started if started is not None else None
+    current_app.logger.log(
+        logging.WARNING if response.status_code >= 500 else logging.INFO,
+        "%s %s %s",
+        request.method,
+        request.path,
+        response.status_code,
+        extra={
+            "fields": {
+                "event": REQUEST_EVENT,
+                "status": response.status_code,
+                "duration_ms": round(duration * 1000, 1) if duration is not None else None,
+            }
+        },
+    )
+    if g.get("request_id"):
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+def init_logging(app):
+    """
+    Send the app logger's records through a LogPipeline as JSON, and log every request.
+
+    Args:
+        app (Flask): The app.
+    """
+    pipeline = LogPipeline()
+    pipeline.setFormatter(JsonFormatter())
+    pipeline.addFilter(SamplingFilter(app.config["LOG_SAMPLE_RATES"]))
+    # replaces Flask's default handler, and keeps records away from the root
+    # logger's handlers so each is written once
+    app.logger.handlers[:] = [pipeline]
+    app.logger.setLevel(app.config["LOG_LEVEL"])
+    app.logger.propagate = False
+    app.extensions["log_pipeline"] = pipeline
+
+    request_started.connect(_start_request, app)
+    if app.config["LOG_REQUESTS"]:
+        app.after_request(_log_request)
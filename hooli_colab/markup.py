@@ -0,0 +1,118 @@
+""" hooli comment markup: sanitize and render comments once, when they're written
+
+A comment is stored twice: content is what the user typed, content_html is
+the sanitized HTML that view_media emits as is.  Rendering keeps a small set
+of tags (bold, italics, code, quotes, lists and links), escapes everything
+else, turns line breaks into <br> and bare URLs into links.
+
+Bump MARKUP_VERSION whenever the policy below changes and run
+"flask render-comments" to bring the stored HTML up to date.
+"""
+
+import threading
+from functools import partial
+
+from bleach.callbacks import nofollow, target_blank
+from bleach.linkifier import LinkifyFilter
+from bleach.sanitizer import Cleaner
+
+from hooli_colab.models import Comments
+
+MARKUP_VERSION = 1
+
+ALLOWED_TAGS = {
+    "a",
+    "b",
+    "blockquote",
+    "br",
+    "code",
+    "em",
+    "i",
+    "li",
+    "ol",
+    "pre",
+    "strong",
+    "ul",
+}
+ALLOWED_ATTRIBUTES = {"a": ["href", "title"]}
+ALLOWED_PROTOCOLS = {"http", "https", "mailto"}
+
+# bleach cleaners keep parser state, so each thread gets its own
+_local = threading.local()
+
+
+def _cleaner():
+    cleaner = getattr(_local, "cleaner", None)
+    if cleaner is None:
+        cleaner = Cleaner(
+            tags=ALLOWED_TAGS,
+            attributes=ALLOWED_ATTRIBUTES,
+            protocols=ALLOWED_PROTOCOLS,
+            strip=True,
+            filters=[
+                partial(
+                    LinkifyFilter,
+                    callbacks=[nofollow, target_blank],
+                    skip_tags={"pre", "code"},
+                )
+            ],
+        )
+        _local.cleaner = cleaner
+    return cleaner
+
+
+def render_comment(content):
+    """
+    Turn what a user typed into safe HTML.
+
+    Args:
+        content (str): The comment as typed.
+
+    Returns:
+        str: Sanitized HTML with line breaks and links.
+    """
+    text = content.replace("\r\n", "\n").strip()
+    return _cleaner().clean(text.replace("\n", "<br>\n"))
+
+
+def set_comment_html(comment):
+    """render a Comments row's content into its content_html"""
+    comment.content_html = render_comment(comment.content)
+    comment.content_html_version = MARKUP_VERSION
+
+
+def rerender_comments(everything=False, batch_size=500):
+    """
+    Re-render stored comment HTML rendered by an older MARKUP_VERSION, or never.
+
+    Works through the table in id order, one transaction per batch, so it can
+    run while the app is up.  Must be called inside an app context.
+
+    Args:
+        everything (bool, optional): Re-render every comment.  Defaults to False.
+        batch_size (int, optional): Comments per transaction.  Defaults to 500.
+
+    Returns:
+        int: The number of comments re-rendered.
+    """
+    from hooli_colab import db
+
+    count = 0
+    last_id = 0
+    while True:
+        query = Comments.query.filter(Comments.id > last_id)
+        if not everything:
+            query = query.filter(
+                db.or_(
+                    Comments.content_html_version.is_(None),
+                    Comments.content_html_version != MARKUP_VERSION,
+                )
+            )
+        batch = query.order_by(Comments.id).limit(batch_size).all()
+        if not batch:
+            return count
+        for comment in batch:
+            set_comment_html(comment)
+        db.session.commit()
+        count += len(batch)
+        last_id = batch[-1].id
@@ -1,4 +1,12 @@
-""" hooli data models for sqlalchemy """
+""" hooli data models for sqlalchemy
+
+The catalog (MediaDirectory, MediaFile) lives in the default database.  The
+social tables (Comments, Stars, Likes) use the "social" bind and the users
+tables the "users" bind; by default both binds point at the same file as the
+catalog, see SQLALCHEMY_BINDS.  Because the binds can be separate files there
+are no foreign key constraints between the groups, so those relationships
+spell out their join conditions.
+"""
 
 import uuid
 from flask_security import UserMixin, RoleMixin
@@ -16,6 +24,8 @@ class MediaDirectory(db.Model):
         title (str): Title of the directory.
         description (str): Description of the directory.
         image_path (str): Path to the directory's image.
+        slug (str, optional): Its URL path, e.g. "artist/album", "" for the media
+            root.  Set by slugs.assign_slugs.
         media_files (List[MediaFile]): Related media files.
     """
 
@@ -25,8 +35,11 @@ class MediaDirectory(db.Model):
     title = db.Column(db.String(255))
     description = db.Column(db.Text)
     image_path = db.Column(db.String(500))
+    slug = db.Column(db.String(500))
     media_files = db.relationship("MediaFile", backref="media_directory", lazy=True)
 
+    __table_args__ = (db.Index("ix_media_directory_slug", "slug", unique=True),)
+
 
 class MediaFile(db.Model):
     """
@@ -46,6 +59,14 @@ class MediaFile(db.Model):
         tags (str, optional): Tags associated with the media file.
         description (str, optional): Description of the media file.
         image_path (str, optional): Path to the image associated with the media file.
+        content_hash (str, optional): SHA-256 of the file contents, set by the indexer.
+        mtime (float, optional): Modification time of the file when it was last hashed.
+        inode (int, optional): Inode of the file when it was last hashed.
+        storage_root (str, optional): The STORAGE_ROOTS root it's in, None for MEDIA_ROOT.
+        loudness_lufs (float, optional): Integrated loudness, set by the analysis.
+        peak_dbfs (float, optional): Sample peak, set by the analysis.
+        gain_db (float, optional): Playback gain to normalize loudness, None until analyzed.
+        slug (str, optional): Its URL name within its directory, set by slugs.assign_slugs.
         comments (list): List of comments related to the media file.
         stars (list): List of star ratings related to the media file.
         likes (list): List of likes related to the media file.
@@ -67,9 +88,36 @@ class MediaFile(db.Model):
     tags = db.Column(db.String(255))
     description = db.Column(db.Text)
     image_path = db.Column(db.String(500))
-    comments = db.relationship("Comments", back_populates="media_file", lazy=True)
-    stars = db.relationship("Stars", back_populates="media_file", lazy=True)
-    likes = db.relationship("Likes", back_populates="media_file", lazy=True)
+    content_hash = db.Column(db.String(64), index=True)
+    mtime = db.Column(db.Float)
+    inode = db.Column(db.Integer)
+    storage_root = db.Column(db.String(64))
+    loudness_lufs = db.Column(db.Float)
+    peak_dbfs = db.Column(db.Float)
+    gain_db = db.Column(db.Float)
+    slug = db.Column(db.String(100))
+    comments = db.relationship(
+        "Comments",
+        primaryjoin="MediaFile.id == foreign(Comments.media_file_id)",
+        back_populates="media_file",
+        lazy=True,
+    )
+    stars = db.relationship(
+        "Stars",
+        primaryjoin="MediaFile.id == foreign(Stars.media_file_id)",
+        back_populates="media_file",
+        lazy=True,
+    )
+    likes = db.relationship(
+        "Likes",
+        primaryjoin="MediaFile.id == foreign(Likes.media_file_id)",
+        back_populates="media_file",
+        lazy=True,
+    )
+
+    __table_args__ = (
+        db.Index("ix_media_file_directory_slug", "directory_id", "slug", unique=True),
+    )
 
 
 class Comments(db.Model):
@@ -80,6 +128,8 @@ class Comments(db.Model):
         id (int): Primary key for the comment.
         media_file_id (int): Foreign key referencing the media file.
         content (str): The content of the comment.
+        content_html (str, optional): Sanitized HTML rendering of content, see markup.py.
+        content_html_version (int, optional): The MARKUP_VERSION content_html was rendered with.
         ip_address (str): The IP address from which the comment was made.
         timestamp (datetime): The timestamp when the comment was created.
         user_id (int): Foreign key referencing the user who made the comment.
@@ -88,18 +138,37 @@ class Comments(db.Model):
     """
 
     __tablename__ = "comments"
+    __bind_key__ = "social"
     id = db.Column(db.Integer, primary_key=True)
-    media_file_id = db.Column(
-        db.Integer, db.ForeignKey("media_file.id"), nullable=False
-    )
+    media_file_id = db.Column(db.Integer, nullable=False)
     content = db.Column(db.Text, nullable=False)
+    content_html = db.Column(db.Text)
+    content_html_version = db.Column(db.Integer)
     ip_address = db.Column(db.String(45), nullable=False)
     timestamp = db.Column(
         db.DateTime, default=db.func.current_timestamp(), nullable=False
     )
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    user = db.relationship("User", back_populates="comments", lazy=True)
-    media_file = db.relationship("MediaFile", back_populates="comments", lazy=True)
+    user_id = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        # a file's comments newest first, a page at a time
+        db.Index("ix_comments_media_file_timestamp", "media_file_id", "timestamp", "id"),
+        # a user's comments newest first, for their library
+        db.Index("ix_comments_user_timestamp", "user_id", "timestamp"),
+    )
+
+    user = db.relationship(
+        "User",
+        primaryjoin="foreign(Comments.user_id) == User.id",
+        back_populates="comments",
+        lazy=True,
+    )
+    media_file = db.relationship(
+        "MediaFile",
+        primaryjoin="foreign(Comments.media_file_id) == MediaFile.id",
+        back_populates="comments",
+        lazy=True,
+    )
 
 
 class Stars(db.Model):
@@ -124,11 +193,10 @@ class Stars(db.Model):
     """
 
     __tablename__ = "stars"
+    __bind_key__ = "social"
     id = db.Column(db.Integer, primary_key=True)
-    media_file_id = db.Column(
-        db.Integer, db.ForeignKey("media_file.id"), nullable=False
-    )
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    media_file_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
     stars = db.Column(db.Integer, nullable=False)
     ip_address = db.Column(db.String(45), nullable=False)
     timestamp = db.Column(
@@ -137,10 +205,23 @@ class Stars(db.Model):
 
     __table_args__ = (
         db.UniqueConstraint("media_file_id", "user_id", name="_media_user_uc"),
+        # a user's ratings newest first, and highest first, for their library
+        db.Index("ix_stars_user_timestamp", "user_id", "timestamp"),
+        db.Index("ix_stars_user_stars_timestamp", "user_id", "stars", "timestamp"),
     )
 
-    user = db.relationship("User", back_populates="stars", lazy=True)
-    media_file = db.relationship("MediaFile", back_populates="stars", lazy=True)
+    user = db.relationship(
+        "User",
+        primaryjoin="foreign(Stars.user_id) == User.id",
+        back_populates="stars",
+        lazy=True,
+    )
+    media_file = db.relationship(
+        "MediaFile",
+        primaryjoin="foreign(Stars.media_file_id) == MediaFile.id",
+        back_populates="stars",
+        lazy=True,
+    )
 
 
 class Likes(db.Model):
@@ -170,11 +251,10 @@ class Likes(db.Model):
     """
 
     __tablename__ = "likes"
+    __bind_key__ = "social"
     id = db.Column(db.Integer, primary_key=True)
-    media_file_id = db.Column(
-        db.Integer, db.ForeignKey("media_file.id"), nullable=False
-    )
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    media_file_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
     like = db.Column(db.Boolean, nullable=False, default=False)
     ip_address = db.Column(db.String(45), nullable=False)
     timestamp = db.Column(
@@ -183,16 +263,199 @@ class Likes(db.Model):
 
     __table_args__ = (
         db.UniqueConstraint("media_file_id", "user_id", name="_media_user_uc"),
+        # a user's likes newest first, for their library
+        db.Index("ix_likes_user_timestamp", "user_id", "timestamp"),
     )
 
-    user = db.relationship("User", back_populates="likes", lazy=True)
-    media_file = db.relationship("MediaFile", back_populates="likes", lazy=True)
+    user = db.relationship(
+        "User",
+        primaryjoin="foreign(Likes.user_id) == User.id",
+        back_populates="likes",
+        lazy=True,
+    )
+    media_file = db.relationship(
+        "MediaFile",
+        primaryjoin="foreign(Likes.media_file_id) == MediaFile.id",
+        back_populates="likes",
+        lazy=True,
+    )
+
+
+class MediaFileNeighbor(db.Model):
+    """
+    Precomputed "more like this" list for a media file, built by the recommender.
+
+    Attributes:
+        media_file_id (int): The media file the list is for.
+        rank (int): Position in the list, 0 is the most similar.
+        neighbor_id (int): The similar media file.
+        score (float): Cosine similarity of the two files' likes and ratings.
+    """
+
+    __tablename__ = "media_file_neighbor"
+    media_file_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    neighbor_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+
+class RecommenderFingerprint(db.Model):
+    """
+    Digest of who liked and rated a media file when its neighbors were last computed,
+    so the recommender can tell which files' engagement has changed since.
+
+    Attributes:
+        media_file_id (int): The media file.
+        fingerprint (str): Hex digest of the file's column of the user x track matrix.
+        user_ids (bytes): The ids of the users in that column, packed int64s,
+            so tracks that shared a user who has since left it are recomputed too.
+    """
+
+    __tablename__ = "recommender_fingerprint"
+    media_file_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    fingerprint = db.Column(db.String(32), nullable=False)
+    user_ids = db.Column(db.LargeBinary)
+
+
+class MediaFileStats(db.Model):
+    """
+    Running engagement totals and chart scores for a media file, see hooli_colab/charts.py.
+
+    Kept in the "social" bind so it's written in the same database as the
+    likes, stars and comments that update it.  Each chart has an index of its
+    own and one per directory, so a chart page is a single index read.
+
+    Attributes:
+        media_file_id (int): The media file.
+        directory_id (int): The file's directory, copied here for per-directory charts.
+        like_count (int): Number of likes.
+        rating_count (int): Number of ratings.
+        rating_sum (int): Sum of the ratings' stars.
+        comment_count (int): Number of comments.
+        play_count (int): Number of plays rolled up from the play log, see hooli_colab/plays.py.
+        trending (float): Log of the time-decayed engagement sum, None for none.
+        top_rated (float): Bayesian average rating, None if unrated.
+    """
+
+    __tablename__ = "media_file_stats"
+    __bind_key__ = "social"
+    media_file_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    directory_id = db.Column(db.Integer)
+    like_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    comment_count = db.Column(db.Integer, nullable=False, default=0)
+    play_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    trending = db.Column(db.Float, index=True)
+    top_rated = db.Column(db.Float, index=True)
+
+    __table_args__ = (
+        db.Index("ix_media_file_stats_comment_count", "comment_count"),
+        db.Index("ix_media_file_stats_directory_trending", "directory_id", "trending"),
+        db.Index("ix_media_file_stats_directory_top_rated", "directory_id", "top_rated"),
+        db.Index(
+            "ix_media_file_stats_directory_comment_count", "directory_id", "comment_count"
+        ),
+        db.Index("ix_media_file_stats_play_count", "play_count"),
+        db.Index("ix_media_file_stats_directory_play_count", "directory_id", "play_count"),
+    )
+
+
+class ChartTotals(db.Model):
+    """
+    Library-wide rating totals for the Bayesian top rated chart.  There's one row, id 1.
+
+    Attributes:
+        id (int): Always 1.
+        rating_count (int): Number of ratings in the library.
+        rating_sum (int): Sum of their stars.
+    """
+
+    __tablename__ = "chart_totals"
+    __bind_key__ = "social"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PlayCountDaily(db.Model):
+    """
+    Plays of a media file on one UTC day, rolled up from the play log, see hooli_colab/plays.py.
+
+    In the default database: only the rollup writes it, a batch at a time.
+
+    Attributes:
+        media_file_id (int): The media file.
+        day (date): The UTC day.
+        plays (int): Plays that day.
+    """
+
+    __tablename__ = "play_count_daily"
+    media_file_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    day = db.Column(db.Date, primary_key=True)
+    plays = db.Column(db.Integer, nullable=False, default=0)
+
+    # for the most played over a range of days
+    __table_args__ = (db.Index("ix_play_count_daily_day", "day", "media_file_id", "plays"),)
+
+
+class PlayLogSegment(db.Model):
+    """
+    A play log segment that's been counted into play_count_daily but maybe not deleted yet.
+
+    Written in the same transaction as the counts, so a rollup that stops
+    before deleting a segment doesn't count it again next time.  Rows are
+    removed once their files are gone.
+
+    Attributes:
+        name (str): The segment's file name.
+    """
+
+    __tablename__ = "play_log_segment"
+    name = db.Column(db.String(64), primary_key=True)
+
+
+class CatalogVersion(db.Model):
+    """
+    A counter bumped whenever directory or file URLs change.  There's one row, id 1.
+
+    Each process keeps the URL map in memory (slugs.SlugResolver) and reloads
+    it when it sees the counter move, so the indexer running in another
+    process invalidates it.
+
+    Attributes:
+        id (int): Always 1.
+        version (int): Bumped on every change.
+    """
+
+    __tablename__ = "catalog_version"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class FormerSlug(db.Model):
+    """
+    A URL a media file had before the indexer moved it to another directory.
+
+    The file gets a new slug path under its new directory; the old one
+    redirects there (slugs.SlugResolver.moved_to) unless something else has
+    taken it since.
+
+    Attributes:
+        path (str): The old slug path, e.g. "artist/album/track-title".
+        media_file_id (int): The file it belonged to.
+    """
+
+    __tablename__ = "former_slug"
+    path = db.Column(db.String(600), primary_key=True)
+    media_file_id = db.Column(db.Integer, nullable=False, index=True)
 
 
 roles_users = db.Table(
     "roles_users",
     db.Column("user_id", db.Integer(), db.ForeignKey("user.id")),
     db.Column("role_id", db.Integer(), db.ForeignKey("role.id")),
+    bind_key="users",
 )
 
 
@@ -207,6 +470,7 @@ class Role(db.Model, RoleMixin):
     """
 
     __tablename__ = "role"
+    __bind_key__ = "users"
     id = db.Column(db.Integer(), primary_key=True)
     name = db.Column(db.String(80), unique=True)
     description = db.Column(db.String(255))
@@ -231,6 +495,7 @@ class User(db.Model, UserMixin):
     """
 
     __tablename__ = "user"
+    __bind_key__ = "users"
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255), unique=True)
     password = db.Column(db.String(255))
@@ -243,6 +508,21 @@ class User(db.Model, UserMixin):
     roles = db.relationship(
         "Role", secondary=roles_users, backref=db.backref("users", lazy="dynamic")
     )
-    comments = db.relationship("Comments", back_populates="user", lazy=True)
-    stars = db.relationship("Stars", back_populates="user", lazy=True)
-    likes = db.relationship("Likes", back_populates="user", lazy=True)
+    comments = db.relationship(
+        "Comments",
+        primaryjoin="User.id == foreign(Comments.user_id)",
+        back_populates="user",
+        lazy=True,
+    )
+    stars = db.relationship(
+        "Stars",
+        primaryjoin="User.id == foreign(Stars.user_id)",
+        back_populates="user",
+        lazy=True,
+    )
+    likes = db.relationship(
+        "Likes",
+        primaryjoin="User.id == foreign(Likes.user_id)",
+        back_populates="user",
+        lazy=True,
+    )
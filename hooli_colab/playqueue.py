@@ -0,0 +1,74 @@
+""" hooli play queue: what continuous play goes on to after the current track
+
+The browse page plays a directory's audio files in the order it lists them,
+or shuffled, optionally only the ones the listener has liked.  The server
+works out what comes next so the player can ask for it while the current
+track is still playing and start fetching it ahead of time, instead of
+finding out when the track ends.
+
+A shuffle is a seed the player picks when shuffle is turned on; the same
+seed always gives the same order, so asking again after each track carries
+on through one shuffle rather than picking at random every time.
+"""
+
+import random
+
+from hooli_colab.engagement import NOT_PENDING, pending_like
+from hooli_colab.models import Likes, MediaFile
+
+PLAYABLE_TYPES = ("mp3", "wav")
+
+
+def listing_key(media_file):
+    """how the browse page orders a directory's files: by title, or filename"""
+    return media_file.title.lower() if media_file.title else media_file.filename.lower()
+
+
+def liked_ids(user_id, media_file_ids):
+    """the ids among media_file_ids the user likes, counting likes not yet flushed"""
+    media_file_ids = list(media_file_ids)
+    # a likes row is a like; unliking deletes it
+    liked = {
+        row.media_file_id
+        for row in Likes.query.filter(
+            Likes.user_id == user_id, Likes.media_file_id.in_(media_file_ids)
+        )
+    }
+    for media_file_id in media_file_ids:
+        pending = pending_like(user_id, media_file_id)
+        if pending is not NOT_PENDING:
+            (liked.add if pending else liked.discard)(media_file_id)
+    return liked
+
+
+def upcoming(directory_id, after=None, shuffle_seed=None, liked_by=None, count=3):
+    """
+    The tracks continuous play goes on to.
+
+    Args:
+        directory_id (int): The directory being played.
+        after (int, optional): The track playing now.  Defaults to the start.
+        shuffle_seed (int, optional): Shuffle the directory with this seed.
+        liked_by (int, optional): Only this user's liked tracks.
+        count (int, optional): How many to return.  Defaults to 3.
+
+    Returns:
+        list: Up to count MediaFiles, in play order; empty at the end.
+    """
+    media_files = [
+        media_file
+        for media_file in MediaFile.query.filter_by(directory_id=directory_id)
+        if media_file.filetype.lower() in PLAYABLE_TYPES
+    ]
+    media_files.sort(key=listing_key)
+    if shuffle_seed is not None:
+        random.Random(shuffle_seed).shuffle(media_files)
+
+    ids = [media_file.id for media_file in media_files]
+    # the current track needn't pass the liked filter, it's where we go on from
+    start = ids.index(after) + 1 if after in ids else 0
+    following = media_files[start:]
+    if liked_by is not None:
+        liked = liked_ids(liked_by, (media_file.id for media_file in following))
+        following = [media_file for media_file in following if media_file.id in liked]
+    return following[:count]
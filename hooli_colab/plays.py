@@ -0,0 +1,350 @@
+""" hooli plays: a play beacon logged to append-only files, rolled up into per-day counts
+
+The player reports a play once a track has been listened to for a while
+(POST /api/play/<id>).  A row per play in media.db would put every listener
+behind the database's write lock, so the beacon only appends a line to a log
+file and returns; it doesn't write to the database at all.  Each process
+appends to its own segment file in PLAYS_LOG_DIR and starts a new one every
+PLAYS_SEGMENT_SECONDS, named for when it starts:
+
+    plays-<start, unix seconds>-<pid>.jsonl
+
+A rollup, "flask rollup-plays" or every PLAYS_ROLLUP_INTERVAL_MINUTES in the
+background, reads the segments nothing writes to any more, adds them up per
+file and UTC day into play_count_daily, counts them towards the files' play
+counts and trending in media_file_stats, and deletes them, so the log only
+ever holds the last few minutes.  The names of the segments it counted are
+committed in play_log_segment in the same transaction as play_count_daily,
+and a segment that's still there next time is deleted without being counted
+again.  media_file_stats is updated in a second transaction; if a rollup
+stops between the two, "flask rebuild-charts" recounts it from
+play_count_daily.
+
+play_count_daily is what to read for plays over a range of days
+(daily_plays, most_played); the all-time count is media_file_stats.play_count,
+the "most played" chart.
+"""
+
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+
+from hooli_colab.charts import record_plays
+from hooli_colab.models import MediaFile, PlayCountDaily, PlayLogSegment
+
+_SEGMENT = re.compile(r"plays-(\d+)-(\d+)\.jsonl")
+
+
+class PlayLog:
+    """
+    Appends plays to this process's current segment of the play log.
+
+    Attributes:
+        directory (str): Where the segments are written.
+        segment_seconds (int): How long each segment is written to.
+    """
+
+    def __init__(self, directory, segment_seconds):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self._lock = threading.Lock()
+        self._fd = None
+        self._segment = None  # (start, pid) of the open segment
+
+    def append(self, media_file_id, user_id=None):
+        """
+        Log a play.
+
+        Args:
+            media_file_id (int): The media file played.
+            user_id (int, optional): Who played it, None if they weren't logged in.
+
+        Raises:
+            OSError: If the log can't be written.
+        """
+        now = time.time()
+        start = int(now // self.segment_seconds * self.segment_seconds)
+        line = json.dumps({"t": round(now, 3), "f": media_file_id, "u": user_id}) + "\n"
+        with self._lock:
+            if self._segment != (start, os.getpid()):
+                self._open(start)
+            # one write on an O_APPEND descriptor, so lines from threads never interleave
+            os.write(self._fd, line.encode())
+
+    def _open(self, start):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"plays-{start}-{os.getpid()}.jsonl")
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._segment = (start, os.getpid())
+
+
+def sealed_segments(config, now=None):
+    """
+    The segments of the play log that nothing writes to any more.
+
+    A segment is written to for PLAYS_SEGMENT_SECONDS from its start; one more
+    segment's worth of time is allowed for appends that were already under way.
+
+    Returns:
+        list: File names, oldest first.
+    """
+    directory = config["PLAYS_LOG_DIR"]
+    cutoff = (time.time() if now is None else now) - 2 * config["PLAYS_SEGMENT_SECONDS"]
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    sealed = []
+    for name in names:
+        match = _SEGMENT.fullmatch(name)
+        if match and int(match.group(1)) <= cutoff:
+            sealed.append((int(match.group(1)), name))
+    return [name for _, name in sorted(sealed)]
+
+
+def read_segment(path):
+    """
+    The plays in a segment file.
+
+    Yields:
+        tuple: (unix time, media file id) of each play.  A torn last line,
+            from a process that died mid-write, is skipped.
+    """
+    with open(path) as f:
+        for line in f:
+            try:
+                play = json.loads(line)
+                yield float(play["t"]), int(play["f"])
+            except (ValueError, KeyError, TypeError):
+                continue
+
+
+def _remove(directory, names):
+    for name in names:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+
+def roll_up(config, now=None, wait=True):
+    """
+    Count the sealed segments of the play log into play_count_daily and the charts,
+    then delete them.
+
+    One rollup runs at a time, across processes: it holds an exclusive lock on
+    .rollup.lock in PLAYS_LOG_DIR, so two can't both count a segment before
+    either has recorded it in play_log_segment.
+
+    Must be called inside an app context.
+
+    Args:
+        config (dict): The app's config.
+        now (float, optional): Unix time to decide which segments are sealed.  Defaults to now.
+        wait (bool, optional): Wait for a rollup that's already running to finish, rather
+            than returning None.  Defaults to True.
+
+    Returns:
+        dict: "segments" counted, "plays" counted, "files" played, and
+            "unknown", plays of files that aren't in the catalog any more.
+            None if another rollup is running and wait is False.
+    """
+    os.makedirs(config["PLAYS_LOG_DIR"], exist_ok=True)
+    with open(os.path.join(config["PLAYS_LOG_DIR"], ".rollup.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        return _roll_up(config, now)
+
+
+def _roll_up(config, now):
+    from hooli_colab import db
+
+    directory = config["PLAYS_LOG_DIR"]
+    report = {"segments": 0, "plays": 0, "files": 0, "unknown": 0}
+    names = sealed_segments(config, now)
+    if names:
+        counted = {row.name for row in PlayLogSegment.query.filter(PlayLogSegment.name.in_(names))}
+        # a previous rollup committed these and stopped before deleting them
+        _remove(directory, counted)
+        names = [name for name in names if name not in counted]
+
+    if names:
+        plays = defaultdict(list)  # media file id -> play times
+        for name in names:
+            for when, media_file_id in read_segment(os.path.join(directory, name)):
+                plays[media_file_id].append(datetime.fromtimestamp(when, timezone.utc))
+        known = {
+            media_file_id
+            for (media_file_id,) in db.session.query(MediaFile.id).filter(
+                MediaFile.id.in_(list(plays))
+            )
+        }
+        daily = defaultdict(int)
+        for media_file_id in list(plays):
+            if media_file_id not in known:
+                report["unknown"] += len(plays.pop(media_file_id))
+                continue
+            for when in plays[media_file_id]:
+                daily[(media_file_id, when.date())] += 1
+
+        if daily:
+            statement = insert(PlayCountDaily.__table__)
+            db.session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=["media_file_id", "day"],
+                    set_={"plays": PlayCountDaily.__table__.c.plays + statement.excluded.plays},
+                ),
+                [
+                    {"media_file_id": media_file_id, "day": day, "plays": count}
+                    for (media_file_id, day), count in daily.items()
+                ],
+            )
+        db.session.add_all(PlayLogSegment(name=name) for name in names)
+        db.session.commit()
+        # media_file_stats may be in another database file, so it's a transaction of its own,
+        # after the one above: stopping in between leaves the charts short, never double
+        for media_file_id, times in plays.items():
+            record_plays(media_file_id, times)
+        db.session.commit()
+        _remove(directory, names)
+        report["segments"] = len(names)
+        report["plays"] = sum(daily.values())
+        report["files"] = len(plays)
+
+    # forget the segments that are gone; what's left failed to delete and is skipped next time
+    gone = [
+        row.name
+        for row in PlayLogSegment.query
+        if not os.path.exists(os.path.join(directory, row.name))
+    ]
+    if gone:
+        PlayLogSegment.query.filter(PlayLogSegment.name.in_(gone)).delete()
+        db.session.commit()
+    return report
+
+
+def _today():
+    return datetime.now(timezone.utc).date()
+
+
+def daily_plays(media_file_id, days=30):
+    """
+    A file's plays on each of the last days UTC days, counted up to the last rollup.
+
+    Args:
+        media_file_id (int): The media file.
+        days (int, optional): How many days, today included.  Defaults to 30.
+
+    Returns:
+        list: (date, plays) pairs, oldest first, with a 0 for days without plays.
+    """
+    first = _today() - timedelta(days=days - 1)
+    counts = dict(
+        PlayCountDaily.query.with_entities(PlayCountDaily.day, PlayCountDaily.plays).filter(
+            PlayCountDaily.media_file_id == media_file_id, PlayCountDaily.day >= first
+        )
+    )
+    return [(day, counts.get(day, 0)) for day in (first + timedelta(days=n) for n in range(days))]
+
+
+def most_played(days=7, directory_id=None, limit=50):
+    """
+    The files played most over the last days UTC days.
+
+    Args:
+        days (int, optional): How many days, today included.  Defaults to 7.
+        directory_id (int, optional): Only files in this directory.  Defaults to the whole library.
+        limit (int, optional): Number of entries.  Defaults to 50.
+
+    Returns:
+        list: (MediaFile, plays) tuples, most played first.
+    """
+    from hooli_colab import db
+
+    first = _today() - timedelta(days=days - 1)
+    plays = func.sum(PlayCountDaily.plays).label("plays")
+    query = (
+        db.session.query(MediaFile, plays)
+        .join(PlayCountDaily, PlayCountDaily.media_file_id == MediaFile.id)
+        .filter(PlayCountDaily.day >= first)
+    )
+    if directory_id is not None:
+        query = query.filter(MediaFile.directory_id == directory_id)
+    return (
+        query.group_by(MediaFile.id).order_by(plays.desc(), MediaFile.id.desc()).limit(limit).all()
+    )
+
+
+class PlayRollup:
+    """
+    Rolls up the play log every interval in a background thread, one process at a time.
+
+    Attributes:
+        app (Flask): The app.
+        interval (float): Seconds between rollups.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """start the thread in this process if it isn't running yet"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="play-rollup", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        config = self.app.config
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self.app.app_context():
+                    report = roll_up(config, wait=False)
+                # None when another process is rolling up
+                if report and report["segments"]:
+                    self.app.logger.info(
+                        "rolled up %s plays of %s files",
+                        report["plays"],
+                        report["files"],
+                        extra={"fields": {"event": "play_rollup", **report}},
+                    )
+            except Exception:  # keep the thread alive for the next rollup
+                self.app.logger.exception("play rollup failed")
+
+
+def init_plays(app):
+    """
+    Set up the play log if PLAYS_LOG_DIR is set, and its background rollup if
+    PLAYS_ROLLUP_INTERVAL_MINUTES is.
+
+    Args:
+        app (Flask): The app.
+    """
+    if not app.config["PLAYS_LOG_DIR"]:
+        return
+    app.extensions["play_log"] = PlayLog(
+        app.config["PLAYS_LOG_DIR"], app.config["PLAYS_SEGMENT_SECONDS"]
+    )
+    if app.config["PLAYS_ROLLUP_INTERVAL_MINUTES"]:
+        rollup = PlayRollup(app, app.config["PLAYS_ROLLUP_INTERVAL_MINUTES"] * 60)
+        app.before_request(rollup.start)
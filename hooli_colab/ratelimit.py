@@ -0,0 +1,219 @@
+""" hooli rate limiting: token buckets for the write and login endpoints
+
+Each limited endpoint has up to two buckets per caller, one keyed by user and
+one by IP address, configured in RATE_LIMITS as (burst, seconds): a bucket
+holds up to burst tokens and refills at burst per seconds, and each request
+takes one.  For the login and forgot-password forms, which come before there
+is a user, the "user" is the account name typed into the form, so guessing
+one account's password is slowed down from any number of addresses.
+
+The check runs in a before_request hook and only looks at the session cookie
+and the form, so a limited request gets its 429 without touching the
+database or hashing a password.
+
+Buckets live in this process's memory (MemoryStore, an LRU of recent keys)
+or, with several worker processes, in a small SQLite file they all share
+(SqliteStore), set by RATE_LIMIT_STORE.
+"""
+
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import jsonify, make_response, request, session
+
+USER = "user"
+IP = "ip"
+
+# form fields naming the account for the endpoints used before logging in
+ACCOUNT_FIELDS = {
+    "hooli.login": "username_or_email",
+    "hooli.forgot_password": "email",
+}
+
+
+def refill(tokens, updated, now, burst, seconds):
+    """a bucket's tokens at now, having had tokens at updated"""
+    return min(float(burst), tokens + (now - updated) * burst / seconds)
+
+
+class MemoryStore:
+    """
+    Buckets in this process's memory, forgetting the least recently used past max_keys.
+
+    Attributes:
+        max_keys (int): Most buckets kept.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, seconds, now=None):
+        """
+        Take a token from a bucket.
+
+        Args:
+            key (str): The bucket.
+            burst (int): Tokens the bucket holds when full.
+            seconds (float): Time the bucket takes to refill from empty.
+            now (float, optional): The time.  Defaults to time.time().
+
+        Returns:
+            float: 0 if a token was taken, otherwise seconds until there's one.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (float(burst), now))
+            tokens = refill(tokens, updated, now, burst, seconds)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) * seconds / burst
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SqliteStore:
+    """
+    Buckets in a SQLite file shared by every worker process.
+
+    Each take is one UPSERT, so processes can't both spend the same token.
+    The file only holds limiter state, not anything of the app's, so it's
+    written with synchronous=OFF; losing it in a crash just resets the limits.
+
+    Attributes:
+        path (str): The database file.
+        max_age (float): Buckets untouched for this many seconds are pruned.
+    """
+
+    # prune once every this many takes
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, max_age=86400):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+        self._takes = 0
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets"
+                " (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL,"
+                " allowed INTEGER NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, burst, seconds, now=None):
+        """like MemoryStore.take"""
+        now = time.time() if now is None else now
+        conn = self._connection()
+        # every SET expression sees the old row, so "refilled" is computed the
+        # same way for allowed and tokens
+        refilled = "min(:burst, tokens + (:now - updated) * :burst / :seconds)"
+        tokens, allowed = conn.execute(
+            "INSERT INTO buckets (key, tokens, updated, allowed)"
+            " VALUES (:key, :burst - 1, :now, 1)"
+            " ON CONFLICT (key) DO UPDATE SET"
+            f" allowed = {refilled} >= 1,"
+            f" tokens = CASE WHEN {refilled} >= 1 THEN {refilled} - 1 ELSE {refilled} END,"
+            " updated = :now"
+            " RETURNING tokens, allowed",
+            {"key": key, "burst": float(burst), "seconds": seconds, "now": now},
+        ).fetchone()
+        self._takes += 1
+        if self._takes % self.PRUNE_EVERY == 0:
+            conn.execute("DELETE FROM buckets WHERE updated < ?", (now - self.max_age,))
+        return 0.0 if allowed else (1 - tokens) * seconds / burst
+
+
+class RateLimiter:
+    """
+    Applies RATE_LIMITS to requests.
+
+    Attributes:
+        limits (dict): Endpoint -> {"user": (burst, seconds), "ip": (burst, seconds)}.
+        store (MemoryStore or SqliteStore): Where the buckets are.
+    """
+
+    def __init__(self, limits, store):
+        self.limits = limits
+        self.store = store
+
+    def keys(self, endpoint):
+        """(key, (burst, seconds)) for each bucket the current request takes from"""
+        limits = self.limits[endpoint]
+        keys = []
+        if USER in limits:
+            if endpoint in ACCOUNT_FIELDS:
+                account = request.form.get(ACCOUNT_FIELDS[endpoint], "").strip().lower()
+                user = f"account:{account}" if account else None
+            else:
+                # Flask-Login's id in the session cookie; reading it doesn't load the user
+                user = session.get("_user_id")
+            if user:
+                keys.append((f"{endpoint}|{USER}|{user}", limits[USER]))
+        if IP in limits:
+            keys.append((f"{endpoint}|{IP}|{request.remote_addr}", limits[IP]))
+        return keys
+
+    def check(self):
+        """before_request hook: a 429 response if the request is over a limit, else None"""
+        if request.method in ("GET", "HEAD", "OPTIONS") or request.endpoint not in self.limits:
+            return None
+        for key, (burst, seconds) in self.keys(request.endpoint):
+            wait = self.store.take(key, burst, seconds)
+            if wait:
+                return too_many_requests(wait)
+        return None
+
+
+def too_many_requests(wait):
+    """
+    The response for a limited request.
+
+    Args:
+        wait (float): Seconds until the request would be allowed.
+
+    Returns:
+        Response: 429 with Retry-After, JSON if the client asked for JSON.
+    """
+    retry_after = max(1, math.ceil(wait))
+    if request.accept_mimetypes.best == "application/json" or request.is_json:
+        response = jsonify({"status": "rate_limited", "retry_after": retry_after})
+    else:
+        response = make_response("Too many requests, please slow down.\n")
+        response.mimetype = "text/plain"
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def init_rate_limits(app):
+    """
+    Check RATE_LIMITS before every request.
+
+    Args:
+        app (Flask): The app.
+    """
+    if not app.config["RATE_LIMITS"]:
+        return
+    if app.config["RATE_LIMIT_STORE"] == "memory":
+        store = MemoryStore(app.config["RATE_LIMIT_MAX_KEYS"])
+    else:
+        store = SqliteStore(app.config["RATE_LIMIT_STORE"])
+    limiter = RateLimiter(app.config["RATE_LIMITS"], store)
+    app.extensions["rate_limiter"] = limiter
+    app.before_request(limiter.check)
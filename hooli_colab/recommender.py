@@ -0,0 +1,275 @@
+""" hooli "more like this": item-item similarity from likes and stars
+
+A batch job builds a sparse user x track matrix from Likes and Stars and
+computes the cosine similarity between tracks' columns.  The top K neighbors
+of each track go in the media_file_neighbor table, so view_media can show
+recommendations with one primary key lookup.
+
+Rebuilds are incremental.  Each track's column is fingerprinted; only tracks
+whose column changed, and tracks that share a listener with one of those, now
+or at the last rebuild (their similarity to a changed track may have moved),
+are recomputed.
+"""
+
+import hashlib
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, insert
+
+from hooli_colab.models import (
+    Likes,
+    MediaFile,
+    MediaFileNeighbor,
+    RecommenderFingerprint,
+    Stars,
+)
+
+# rows of the similarity matrix computed at once, bounds memory on big libraries
+BATCH_SIZE = 512
+
+
+def engagement_matrix():
+    """
+    Build the user x track matrix.
+
+    A like counts 1, a rating counts (stars - 3) / 2, so 5 stars is as good
+    as a like and 1 star counts against.  Must be called inside an app context.
+
+    Returns:
+        tuple: (matrix, item_ids, user_ids) where matrix is a CSC matrix with
+            one column per track, item_ids maps column number to MediaFile id
+            and user_ids maps row number to User id.
+    """
+    from hooli_colab import db
+
+    likes = db.session.query(Likes.user_id, Likes.media_file_id).all()
+    stars = db.session.query(Stars.user_id, Stars.media_file_id, Stars.stars).all()
+
+    users = np.array(
+        [row[0] for row in likes] + [row[0] for row in stars], dtype=np.int64
+    )
+    items = np.array(
+        [row[1] for row in likes] + [row[1] for row in stars], dtype=np.int64
+    )
+    weights = np.concatenate(
+        [
+            np.ones(len(likes)),
+            (np.array([row[2] for row in stars], dtype=np.float64) - 3.0) / 2.0,
+        ]
+    )
+
+    user_ids, user_index = np.unique(users, return_inverse=True)
+    item_ids, item_index = np.unique(items, return_inverse=True)
+    # duplicate (user, item) entries, a like and a rating, are summed
+    matrix = sparse.csc_matrix(
+        (weights, (user_index, item_index)), shape=(len(user_ids), len(item_ids))
+    )
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    return matrix, item_ids, user_ids
+
+
+def column_users(matrix, user_ids, col):
+    """the ids of the users in a column, sorted"""
+    return user_ids[matrix.indices[matrix.indptr[col] : matrix.indptr[col + 1]]]
+
+
+def column_fingerprints(matrix, item_ids, user_ids):
+    """
+    return {media_file_id: hex digest of its column}
+
+    The digest is of user ids, not row numbers, which shift whenever a user
+    gains or loses their only engagement.
+    """
+    fingerprints = {}
+    for col, item_id in enumerate(item_ids):
+        start, end = matrix.indptr[col], matrix.indptr[col + 1]
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(column_users(matrix, user_ids, col).tobytes())
+        digest.update(matrix.data[start:end].tobytes())
+        fingerprints[int(item_id)] = digest.hexdigest()
+    return fingerprints
+
+
+def affected_columns(matrix, changed, user_ids, previous_users=None):
+    """
+    Return the columns whose neighbor lists may differ because of the changed columns.
+
+    Args:
+        matrix (csc_matrix): The user x track matrix.
+        changed (ndarray): Column numbers of tracks whose engagement changed.
+        user_ids (ndarray): User id of each row, sorted.
+        previous_users (ndarray, optional): Ids of the users the changed and
+            dropped tracks had at the last rebuild.
+
+    Returns:
+        ndarray: Sorted column numbers: the changed ones plus every track that
+            shares a user with one of them, now or at the last rebuild.
+    """
+    previous_users = np.array([], dtype=np.int64) if previous_users is None else previous_users
+    if len(changed) == 0 and len(previous_users) == 0:
+        return changed
+    rows = np.searchsorted(user_ids, previous_users)
+    # users with no engagement left have no row, and are in no column to recompute
+    present = rows < len(user_ids)
+    present[present] = user_ids[rows[present]] == previous_users[present]
+    touched_users = np.union1d(matrix[:, changed].indices, rows[present])
+    co_listened = np.unique(matrix.tocsr()[touched_users].indices)
+    return np.union1d(changed, co_listened)
+
+
+def top_neighbors(matrix, columns, top_k):
+    """
+    Compute the top_k most similar tracks for each of the given columns.
+
+    Args:
+        matrix (csc_matrix): The user x track matrix.
+        columns (ndarray): Column numbers to compute neighbors for.
+        top_k (int): Neighbors to keep per track.
+
+    Yields:
+        tuple: (column, neighbor columns, scores), best first.
+    """
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    norms[norms == 0] = 1.0
+    normalized = matrix @ sparse.diags(1.0 / norms)
+    normalized_t = normalized.T.tocsr()
+
+    for start in range(0, len(columns), BATCH_SIZE):
+        batch = columns[start:start + BATCH_SIZE]
+        similarity = (normalized_t[batch] @ normalized).tocsr()
+        for row, col in enumerate(batch):
+            lo, hi = similarity.indptr[row], similarity.indptr[row + 1]
+            neighbors = similarity.indices[lo:hi]
+            scores = similarity.data[lo:hi]
+            keep = (neighbors != col) & (scores > 0)
+            neighbors, scores = neighbors[keep], scores[keep]
+            if len(scores) > top_k:
+                best = np.argpartition(-scores, top_k)[:top_k]
+                neighbors, scores = neighbors[best], scores[best]
+            order = np.argsort(-scores, kind="stable")
+            yield col, neighbors[order], scores[order]
+
+
+def rebuild_neighbors(top_k=20, full=False):
+    """
+    Recompute the media_file_neighbor table for tracks whose engagement changed.
+
+    Must be called inside an app context.
+
+    Args:
+        top_k (int, optional): Neighbors to keep per track.  Defaults to 20.
+        full (bool, optional): Recompute every track.  Defaults to False.
+
+    Returns:
+        dict: Counts of tracks with engagement, changed, recomputed and dropped.
+    """
+    from hooli_colab import db
+
+    matrix, item_ids, user_ids = engagement_matrix()
+    fingerprints = column_fingerprints(matrix, item_ids, user_ids)
+    stored = {
+        row.media_file_id: row
+        for row in db.session.query(
+            RecommenderFingerprint.media_file_id,
+            RecommenderFingerprint.fingerprint,
+            RecommenderFingerprint.user_ids,
+        )
+    }
+
+    if full:
+        changed = np.arange(len(item_ids))
+    else:
+        changed = np.array(
+            [
+                col
+                for col, item_id in enumerate(item_ids)
+                if int(item_id) not in stored
+                or stored[int(item_id)].fingerprint != fingerprints[int(item_id)]
+            ],
+            dtype=np.int64,
+        )
+    # tracks that had engagement last time and have none now
+    dropped = set(stored) - set(fingerprints)
+    if full:
+        dropped |= {
+            row[0] for row in db.session.query(MediaFileNeighbor.media_file_id).distinct()
+        } - set(fingerprints)
+
+    previous = [
+        np.frombuffer(stored[media_file_id].user_ids, dtype=np.int64)
+        for media_file_id in [int(item_ids[col]) for col in changed] + list(dropped)
+        if media_file_id in stored and stored[media_file_id].user_ids
+    ]
+    previous_users = np.unique(np.concatenate(previous)) if previous else None
+    columns = affected_columns(matrix, changed, user_ids, previous_users)
+    recompute_ids = [int(item_ids[col]) for col in columns] + list(dropped)
+
+    rows = []
+    for col, neighbors, scores in top_neighbors(matrix, columns, top_k):
+        media_file_id = int(item_ids[col])
+        for rank, (neighbor, score) in enumerate(zip(neighbors, scores)):
+            rows.append(
+                {
+                    "media_file_id": media_file_id,
+                    "rank": rank,
+                    "neighbor_id": int(item_ids[neighbor]),
+                    "score": float(score),
+                }
+            )
+
+    for start in range(0, len(recompute_ids), 500):
+        chunk = recompute_ids[start:start + 500]
+        db.session.execute(
+            delete(MediaFileNeighbor).where(MediaFileNeighbor.media_file_id.in_(chunk))
+        )
+    if rows:
+        db.session.execute(insert(MediaFileNeighbor), rows)
+
+    if dropped:
+        db.session.execute(
+            delete(RecommenderFingerprint).where(
+                RecommenderFingerprint.media_file_id.in_(list(dropped))
+            )
+        )
+    for col in changed:
+        media_file_id = int(item_ids[col])
+        db.session.merge(
+            RecommenderFingerprint(
+                media_file_id=media_file_id,
+                fingerprint=fingerprints[media_file_id],
+                user_ids=column_users(matrix, user_ids, col).astype(np.int64).tobytes(),
+            )
+        )
+    db.session.commit()
+
+    return {
+        "tracks": len(item_ids),
+        "changed": len(changed),
+        "recomputed": len(columns),
+        "dropped": len(dropped),
+    }
+
+
+def similar_media_files(media_file_id, limit=10):
+    """
+    Return the precomputed "more like this" list for a media file.
+
+    Args:
+        media_file_id (int): The media file.
+        limit (int, optional): Maximum number to return.  Defaults to 10.
+
+    Returns:
+        list: MediaFile objects, most similar first.
+    """
+    return (
+        MediaFile.query.join(
+            MediaFileNeighbor, MediaFileNeighbor.neighbor_id == MediaFile.id
+        )
+        .filter(MediaFileNeighbor.media_file_id == media_file_id)
+        .order_by(MediaFileNeighbor.rank)
+        .limit(limit)
+        .all()
+    )
@@ -1,16 +1,22 @@
 """ hooli flask app route switches et al """
 
+import mimetypes
 import os
 from urllib.parse import urljoin
 import uuid
 
 from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
     render_template,
     request,
     redirect,
     url_for,
     send_from_directory,
     flash,
+    get_template_attribute,
     jsonify,
 )
 from flask_security import (
@@ -22,16 +28,21 @@ from flask_security import (
 )
 
 from flask_security.utils import hash_password, verify_password
-from flask_wtf.csrf import CSRFProtect
 
 from werkzeug.utils import secure_filename
 
 from sqlalchemy import func
 from itsdangerous import URLSafeTimedSerializer
 
-from hooli_colab import app
-
-from hooli_colab.models import User, MediaFile, Comments, MediaDirectory, Stars, Likes
+from hooli_colab.models import (
+    User,
+    MediaFile,
+    MediaFileStats,
+    Comments,
+    MediaDirectory,
+    Stars,
+    Likes,
+)
 from hooli_colab.forms import (
     CustomLoginForm,
     ForgotPasswordForm,
@@ -40,31 +51,72 @@ from hooli_colab.forms import (
     AddCommentForm,
 )
 from hooli_colab.email import send_email
+from hooli_colab.indexer import get_or_create_directory
+from hooli_colab.assets import (
+    ENCODINGS,
+    asset_urls,
+    is_built_asset,
+    precompressed_encodings,
+)
+from hooli_colab.caching import (
+    add_static_version,
+    cache_control_for,
+    media_file_validators,
+    not_modified_response,
+    static_version,
+)
 from hooli_colab.doodads import (rating_to_stars, log_message)
+from hooli_colab.charts import (
+    CHARTS,
+    MOST_PLAYED,
+    TRENDING,
+    chart,
+    record_comment,
+    trending_score,
+)
+from hooli_colab.markup import set_comment_html
+from hooli_colab.events import TooManySubscribers, stream
+from hooli_colab.bulkedit import (
+    GRID_FIELDS,
+    BulkEditError,
+    bulk_edit,
+)
+from hooli_colab.slugs import DIRECTORY, FILE, assign_slugs, resolver
+from hooli_colab.playqueue import listing_key, upcoming
+from hooli_colab.plays import daily_plays, most_played
+from hooli_colab.storage import StorageError, root_path
+from hooli_colab.comments import comment_count, comment_page
+from hooli_colab.library import (
+    CursorError,
+    LIKED as LIBRARY_LIKED,
+    RECENT as LIBRARY_RECENT,
+    SECTIONS as LIBRARY_SECTIONS,
+    SORTS as LIBRARY_SORTS,
+    library_page,
+)
+from hooli_colab.uploads import (
+    UploadError,
+    cancel_upload,
+    complete_upload,
+    start_upload,
+    upload_status,
+    write_chunk,
+)
+from hooli_colab.engagement import (
+    NOT_PENDING,
+    pending_like,
+    pending_rating,
+    set_like,
+    set_rating,
+)
 
 # from app import mail  # Ensure Flask-Mail is configured
 # from werkzeug.security import generate_password_hash
 
-csrf = CSRFProtect(app)
-
-
-def get_or_create_directory(relative_dirpath):
-    """Get or create a MediaDirectory object for the given directory path
-
-    Args:
-        relative_dirpath (str): The relative directory path.
-
-    Returns:
-        MediaDirectory: The MediaDirectory object for the given directory path.
-    """
-    from hooli_colab import db
-
-    directory = MediaDirectory.query.filter_by(dirpath=relative_dirpath).first()
-    if not directory:
-        directory = MediaDirectory(dirpath=relative_dirpath)
-        db.session.add(directory)
-        db.session.commit()
-    return directory
+# create_app registers this, and static_files as the app's own "static" endpoint
+bp = Blueprint("hooli", __name__)
+bp.app_url_defaults(add_static_version)
+bp.add_app_template_global(asset_urls)
 
 
 def user_likes(file_id):
@@ -79,6 +131,9 @@ def user_likes(file_id):
     """
     if not current_user.is_authenticated:
         return False
+    pending = pending_like(current_user.id, file_id)
+    if pending is not NOT_PENDING:
+        return pending
     liked = Likes.query.filter_by(
         user_id=current_user.id, media_file_id=file_id
     ).first()
@@ -87,6 +142,27 @@ def user_likes(file_id):
     return liked
 
 
+def user_rating(file_id):
+    """
+    Return the current user's rating of a media file, including one not yet flushed.
+
+    Args:
+        file_id (int): The ID of the media file.
+
+    Returns:
+        int: The number of stars, or None if the user isn't logged in or hasn't rated it.
+    """
+    if not current_user.is_authenticated:
+        return None
+    pending = pending_rating(current_user.id, file_id)
+    if pending is not NOT_PENDING:
+        return pending
+    rating_record = Stars.query.filter_by(
+        user_id=current_user.id, media_file_id=file_id
+    ).first()
+    return rating_record.stars if rating_record else None
+
+
 def get_rating_summary(file_id):
     """
     Return a tuple containing the average rating and number of ratings for a media file.
@@ -117,6 +193,19 @@ def get_rating_summary(file_id):
     return average_stars, number_of_ratings
 
 
+def file_counts(stats):
+    """the like, rating, comment and play counts from a MediaFileStats row, zeros if it's None"""
+    if stats is None:
+        return {"likes": 0, "ratings": 0, "rating_sum": 0, "comments": 0, "plays": 0}
+    return {
+        "likes": stats.like_count,
+        "ratings": stats.rating_count,
+        "rating_sum": stats.rating_sum,
+        "comments": stats.comment_count,
+        "plays": stats.play_count,
+    }
+
+
 def generate_reset_token(email):
     """Generate a password reset token for the given email address
 
@@ -127,8 +216,8 @@ def generate_reset_token(email):
         str: The generated password reset token.
     """
 
-    serializer = URLSafeTimedSerializer(app.config["SECRET_KEY"])
-    return serializer.dumps(email, salt=app.config["SECURITY_PASSWORD_SALT"])
+    serializer = URLSafeTimedSerializer(current_app.config["SECRET_KEY"])
+    return serializer.dumps(email, salt=current_app.config["SECURITY_PASSWORD_SALT"])
 
 
 def verify_reset_token(token, expiration=3600):
@@ -142,10 +231,10 @@ def verify_reset_token(token, expiration=3600):
         str: The email address if the token is valid, None otherwise.
     """
 
-    serializer = URLSafeTimedSerializer(app.config["SECRET_KEY"])
+    serializer = URLSafeTimedSerializer(current_app.config["SECRET_KEY"])
     try:
         email = serializer.loads(
-            token, salt=app.config["SECURITY_PASSWORD_SALT"], max_age=expiration
+            token, salt=current_app.config["SECURITY_PASSWORD_SALT"], max_age=expiration
         )
     except:
         return None
@@ -160,81 +249,283 @@ def send_reset_email(user):
         user (User): The user object to whom the password reset email will be sent.
     """
     token = generate_reset_token(user.email)
-    app_name = app.config["MYAPP_NAME"]
-    reset_url = url_for("reset_password", token=token, _external=True)
+    app_name = current_app.config["MYAPP_NAME"]
+    reset_url = url_for("hooli.reset_password", token=token, _external=True)
     subject = f"Password Reset Request for {app_name}"
     body = f"Click the link to reset your {app_name} password: {reset_url}"
     send_email(to_email=user.email, subject=subject, content=body)
 
 
-# Routes
-@app.route("/", defaults={"path": ""})
-@app.route("/<path:path>")
-def browse_media(path):
-    """Display all media files in the given directory path
+def media_url(media_file_id, **values):
+    """
+    The URL of a media file's page: its slug path, or /file/<id> until it has one.
+
+    Args:
+        media_file_id (int): The media file.
+        **values: Extra url_for arguments, e.g. _external=True.
+
+    Returns:
+        str: The URL.
+    """
+    path = resolver().file_path(media_file_id)
+    if path is None:
+        return url_for("hooli.view_media", file_id=media_file_id, **values)
+    return url_for("hooli.browse_media", path=path, **values)
+
+
+bp.add_app_template_global(media_url)
+
+
+def directory_for_path(path):
+    """
+    Find the directory a URL path names: its slug path, or for old links its dirpath.
 
     Args:
-        path (str): The directory path to browse.
+        path (str): The path from the URL, "" for the media root.
+
+    Returns:
+        MediaDirectory: The directory, or None.
     """
     from hooli_colab import db
 
-    full_path = os.path.join(app.config["MEDIA_ROOT"], path)
-    if os.path.isdir(full_path):
-        # Get or create directory metadata
-        relative_dirpath = os.path.relpath(full_path, app.config["MEDIA_ROOT"])
-        directory = get_or_create_directory(relative_dirpath)
-
-        # Scan for media files
-        media_files = []
-        for entry in os.scandir(full_path):
-            if entry.is_file() and entry.name.lower().endswith(
-                (".mp3", ".wav", ".mp4", ".avi", ".pdf")
-            ):
-                relative_filepath = os.path.relpath(
-                    entry.path, app.config["MEDIA_ROOT"]
-                )
-                media_file = MediaFile.query.filter_by(
-                    filepath=relative_filepath
-                ).first()
-                if not media_file:
-                    media_file = MediaFile(
-                        filepath=relative_filepath,
-                        filename=entry.name,
-                        filetype=entry.name.split(".")[-1],
-                        filesize=os.path.getsize(entry.path),
-                        directory_id=directory.id,
-                    )
-                    db.session.add(media_file)
-                    db.session.commit()
-                media_files.append(media_file)
-
-        media_files.sort(
-            key=lambda x: (x.title.lower() if x.title else x.filename.lower())
+    found = resolver().resolve(path)
+    if found is not None:
+        kind, found_id = found
+        return db.session.get(MediaDirectory, found_id) if kind == DIRECTORY else None
+    dirpath = os.path.normpath(path) if path else "."
+    return MediaDirectory.query.filter_by(dirpath=dirpath).first()
+
+
+# Routes
+@bp.route("/", defaults={"path": ""})
+@bp.route("/<path:path>")
+def browse_media(path):
+    """Display the media files of a directory, or a media file's page
+
+    The URL is a slug path (see slugs.py) looked up in memory, so nothing on
+    disk is touched; "flask index" is what finds new files.  A directory's
+    old on-disk path redirects to its slug path, and so does the old slug
+    path of a file the indexer has since found in another directory.
+
+    Args:
+        path (str): The directory or file slug path.
+    """
+    found = resolver().resolve(path)
+    if found is not None and found[0] == FILE:
+        return render_media_file(found[1])
+    if found is None:
+        moved_to = resolver().moved_to(path)
+        if moved_to is not None:
+            return redirect(url_for("hooli.browse_media", path=moved_to), 301)
+    directory = directory_for_path(path)
+    if directory is None and not path:
+        # nothing has been indexed yet
+        directory = get_or_create_directory(".")
+        assign_slugs()
+    if directory is None or directory.slug is None:
+        return "Not a directory", 404
+    if found is None:
+        return redirect(url_for("hooli.browse_media", path=directory.slug), 301)
+
+    media_files = MediaFile.query.filter_by(directory_id=directory.id).all()
+    media_files.sort(key=listing_key)
+    media_files_with_ratings_and_likes = []
+    for media_file in media_files:
+        average_stars, number_of_ratings = get_rating_summary(media_file.id)
+        liked = user_likes(media_file.id)
+        media_files_with_ratings_and_likes.append(
+            {
+                "media_file": media_file,
+                "average_stars": average_stars,
+                "number_of_ratings": number_of_ratings,
+                "liked": liked,
+                "unicode_stars": rating_to_stars(average_stars),
+            }
         )
-        media_files_with_ratings_and_likes = []
-        for media_file in media_files:
-            average_stars, number_of_ratings = get_rating_summary(media_file.id)
-            liked = user_likes(media_file.id)
-            media_files_with_ratings_and_likes.append(
+    return render_template(
+        "browse.html",
+        directory=directory,
+        media_files=media_files_with_ratings_and_likes,
+        path=directory.slug,
+        event_stream=url_for("hooli.directory_events", dir_id=directory.id),
+        counts_url=url_for("hooli.browse_media_json", path=directory.slug),
+    )
+
+
+@bp.route("/api/browse/", defaults={"path": ""})
+@bp.route("/api/browse/<path:path>")
+def browse_media_json(path):
+    """
+    List the media files of a directory as JSON, with the playback gain for each.
+
+    Args:
+        path (str): The directory's slug path (or its dirpath).
+
+    Returns:
+        Response: {"directory": ..., "files": [...]} with each file's gain and
+            counts, or 404 if the directory isn't known.
+    """
+    directory = directory_for_path(path)
+    if directory is None:
+        return jsonify({"status": "not_found"}), 404
+    media_files = (
+        MediaFile.query.filter_by(directory_id=directory.id)
+        .order_by(MediaFile.filepath)
+        .all()
+    )
+    stats = {
+        row.media_file_id: row
+        for row in MediaFileStats.query.filter_by(directory_id=directory.id)
+    }
+    return jsonify(
+        {
+            "directory": {
+                "id": directory.id,
+                "dirpath": directory.dirpath,
+                "slug": directory.slug,
+                "title": directory.title,
+            },
+            "files": [
                 {
-                    "media_file": media_file,
-                    "average_stars": average_stars,
-                    "number_of_ratings": number_of_ratings,
-                    "liked": liked,
-                    "unicode_stars": rating_to_stars(average_stars),
+                    "id": media_file.id,
+                    "title": media_file.title or media_file.filename,
+                    "filename": media_file.filename,
+                    "page_url": media_url(media_file.id),
+                    "url": url_for("hooli.download_file", filename=media_file.filepath),
+                    "gain_db": media_file.gain_db,
+                    "loudness_lufs": media_file.loudness_lufs,
+                    "peak_dbfs": media_file.peak_dbfs,
+                    **file_counts(stats.get(media_file.id)),
                 }
-            )
-        return render_template(
-            "browse.html",
-            directory=directory,
-            media_files=media_files_with_ratings_and_likes,
-            path=path,
-        )
-    return "Not a directory", 404
+                for media_file in media_files
+            ],
+        }
+    )
+
+
+@bp.route("/api/queue/<int:dir_id>")
+def play_queue(dir_id):
+    """
+    The tracks continuous play goes on to after the current one, see playqueue.py.
+
+    Query parameters are after (the id of the track playing now), shuffle (the
+    player's shuffle seed, absent for listing order), liked=1 for only the
+    user's liked tracks, continuous=0 when continuous play is off, and count.
+
+    The first track is also named in a Link: rel=preload header, so an HTTP/2
+    front end can push it; the player itself starts loading it near the end
+    of the current track.
 
+    Args:
+        dir_id (int): The directory being played.
 
-@app.route("/directory/<int:dir_id>", methods=["GET", "POST"])
-def edit_directory(dir_id):
+    Returns:
+        Response: {"status": "ok", "queue": [{"id", "title", "file_url",
+            "page_url", "gain_db"}, ...]}, or 404 for an unknown directory.
+    """
+    from hooli_colab import db
+
+    if db.session.get(MediaDirectory, dir_id) is None:
+        return jsonify({"status": "not_found"}), 404
+    if request.args.get("continuous") == "0":
+        return jsonify({"status": "ok", "queue": []})
+    liked_by = None
+    if request.args.get("liked") == "1":
+        if not current_user.is_authenticated:
+            return jsonify({"status": "ok", "queue": []})
+        liked_by = current_user.id
+    count = max(1, min(request.args.get("count", 3, type=int), 20))
+    media_files = upcoming(
+        dir_id,
+        after=request.args.get("after", type=int),
+        shuffle_seed=request.args.get("shuffle", type=int),
+        liked_by=liked_by,
+        count=count,
+    )
+    queue = [
+        {
+            "id": media_file.id,
+            "title": media_file.title or media_file.filename,
+            "file_url": url_for("hooli.download_file", filename=media_file.filepath),
+            "page_url": media_url(media_file.id),
+            "gain_db": media_file.gain_db,
+        }
+        for media_file in media_files
+    ]
+    response = jsonify({"status": "ok", "queue": queue})
+    if queue:
+        response.headers["Link"] = f'<{queue[0]["file_url"]}>; rel=preload; as=audio'
+    return response
+
+
+@bp.route("/api/play/<int:file_id>", methods=["POST"])
+def record_play(file_id):
+    """
+    Count a play of a media file; the player calls this once a track has played for a while.
+
+    The play is only appended to the play log, and shows up in the counts
+    after the next rollup, see hooli_colab/plays.py.  Plays count whether or
+    not the listener is logged in.
+
+    Args:
+        file_id (int): The media file played.
+
+    Returns:
+        Response: 204, 404 if plays aren't counted, or 503 if the play log can't be written.
+    """
+    play_log = current_app.extensions.get("play_log")
+    if play_log is None:
+        abort(404)
+    try:
+        play_log.append(file_id, current_user.id if current_user.is_authenticated else None)
+    except OSError:
+        current_app.logger.exception("can't write the play log")
+        return jsonify({"status": "unavailable"}), 503
+    return "", 204
+
+
+@bp.route("/api/plays/<int:file_id>")
+def play_history(file_id):
+    """
+    A media file's plays per UTC day, up to the last rollup of the play log.
+
+    Query parameter days is how many days back, today included, 30 by default.
+
+    Args:
+        file_id (int): The media file.
+
+    Returns:
+        Response: {"status": "ok", "days": [{"day", "plays"}, ...]} oldest first,
+            or 404 for an unknown file.
+    """
+    from hooli_colab import db
+
+    if db.session.get(MediaFile, file_id) is None:
+        return jsonify({"status": "not_found"}), 404
+    days = max(1, min(request.args.get("days", 30, type=int), 366))
+    return jsonify(
+        {
+            "status": "ok",
+            "days": [
+                {"day": day.isoformat(), "plays": plays}
+                for day, plays in daily_plays(file_id, days)
+            ],
+        }
+    )
+
+
+@bp.route("/directory/<int:dir_id>")
+def edit_directory_by_id(dir_id):
+    """old id URL for editing a directory, redirects to its slug path"""
+    directory = MediaDirectory.query.get_or_404(dir_id)
+    if directory.slug is None:
+        abort(404)
+    return redirect(url_for("hooli.edit_directory", path=directory.slug), 301)
+
+
+@bp.route("/edit-directory/", defaults={"path": ""}, methods=["GET", "POST"])
+@bp.route("/edit-directory/<path:path>", methods=["GET", "POST"])
+def edit_directory(path):
     """
     Edit the metadata for a directory.
 
@@ -243,7 +534,7 @@ def edit_directory(dir_id):
     On a POST request, it updates the directory metadata with the submitted form data.
 
     Args:
-        dir_id (int): The ID of the directory to be edited.
+        path (str): The directory's slug path.
 
     Returns:
         Response: The rendered template for GET requests.
@@ -251,7 +542,9 @@ def edit_directory(dir_id):
     """
     from hooli_colab import db
 
-    directory = MediaDirectory.query.get_or_404(dir_id)
+    directory = directory_for_path(path)
+    if directory is None:
+        abort(404)
     if request.method == "GET":
         return render_template(
             "edit_directory.html",
@@ -269,94 +562,327 @@ def edit_directory(dir_id):
             if image and allowed_image(image.filename):
                 filename = secure_filename(image.filename)
                 unique_filename = str(uuid.uuid4()) + "_" + filename
-                image.save(os.path.join(app.config["MEDIA_ROOT"], unique_filename))
+                image.save(os.path.join(current_app.config["MEDIA_ROOT"], unique_filename))
                 directory.image_path = unique_filename
         db.session.commit()
         flash("Directory information updated successfully.")
-        return redirect(url_for("browse_media", path=directory.dirpath, _external=True))
+        return redirect(url_for("hooli.browse_media", path=directory.slug, _external=True))
     return render_template("edit_directory.html", directory=directory)
 
 
-@app.route("/file/<int:file_id>", methods=["GET", "POST"])
+@bp.route("/file/<int:file_id>", methods=["GET", "POST"])
 def view_media(file_id):
+    """
+    Old id URL for a media file: redirects to its slug path, or shows the page
+    if it hasn't got one yet.
+
+    Args:
+        file_id (int): The ID of the media file to be viewed.
+
+    Returns:
+        Response: A redirect, or the page from render_media_file.
+    """
+    path = resolver().file_path(file_id)
+    if path is not None:
+        return redirect(url_for("hooli.browse_media", path=path), 301)
+    return render_media_file(file_id)
+
+
+def render_media_file(file_id):
     """
     Drill down into a single media file and display details such as rating and comments.
 
-    This view handles both GET and POST requests. On GET requests, it fetches and displays
-    the media file details, user comments, and ratings. On POST requests, it processes
-    comment and rating submissions.
+    Fetches and displays the media file details, user comments, and ratings;
+    comments and ratings are posted to add_comment and add_rating.
 
     Args:
         file_id (int): The ID of the media file to be viewed.
 
     Returns:
         Response: Renders the 'view_media.html' template with the media file details,
-                  comments, user rating, average rating, number of ratings, and like status.
+                  comments, user rating, average rating, number of ratings, like status,
+                  and the precomputed "more like this" recommendations.
     """
+    from hooli_colab.recommender import similar_media_files
     media_file = MediaFile.query.get_or_404(file_id)
     liked = user_likes(file_id)
     comment_form = AddCommentForm()
 
-    # Fetch Comments
-    comments = (
-        Comments.query.filter_by(media_file_id=file_id)
-        .order_by(Comments.timestamp.desc())
-        .all()
-    )
+    # the first page of comments, with their authors' names; the rest come from comments_json
+    page = comment_page(file_id, limit=current_app.config["COMMENTS_PAGE_SIZE"])
 
     # Get rating summary
     average_stars, number_of_ratings = get_rating_summary(file_id)
 
     # Fetch User Rating
-    user_stars = None
-    if current_user.is_authenticated:
-        rating_record = Stars.query.filter_by(
-            user_id=current_user.id, media_file_id=file_id
-        ).first()
-        if rating_record:
-            user_stars = rating_record.stars
+    user_stars = user_rating(file_id)
+
+    recommendations = similar_media_files(
+        file_id, limit=current_app.config["RECOMMENDATIONS_SHOWN"]
+    )
 
     return render_template(
         "view_media.html",
         media_file=media_file,
-        comments=comments,
+        comments=page["comments"],
+        comments_next=page["next"],
+        comment_count=comment_count(file_id),
+        can_delete_comments=can_delete_comments(),
         user_rating=user_stars,
         average_rating=average_stars,
         number_of_ratings=number_of_ratings,
         liked=liked,
         comment_form=comment_form,
+        recommendations=recommendations,
+        event_stream=url_for("hooli.file_events", file_id=file_id),
+        counts_url=url_for(
+            "hooli.browse_media_json", path=media_file.media_directory.slug
+        ),
+    )
+
+
+def can_delete_comments():
+    """True if the current user may delete comments"""
+    return current_user.is_authenticated and (
+        current_user.has_role("Admin") or current_user.has_role("Editor")
+    )
+
+
+@bp.route("/api/comments/<int:file_id>")
+def comments_json(file_id):
+    """
+    A page of a media file's comments, newest first, after the ones view_media showed.
+
+    Query parameters are after, the "next" cursor of the previous page, and limit.
+
+    Args:
+        file_id (int): The media file.
+
+    Returns:
+        Response: {"status": "ok", "comments": [{"id", "username", "timestamp",
+            "content_html", "html"}, ...], "next"}, where html is the comment's
+            list item as view_media renders it; 400 for a bad cursor.
+    """
+    limit = request.args.get("limit", current_app.config["COMMENTS_PAGE_SIZE"], type=int)
+    limit = max(1, min(limit, current_app.config["COMMENTS_MAX_PAGE_SIZE"]))
+    try:
+        page = comment_page(file_id, cursor=request.args.get("after") or None, limit=limit)
+    except CursorError as e:
+        return jsonify({"status": "invalid", "error": str(e)}), 400
+    comment_item = get_template_attribute("comment_macro.html", "comment_item")
+    can_delete = can_delete_comments()
+    return jsonify(
+        {
+            "status": "ok",
+            "comments": [
+                {
+                    "id": comment.id,
+                    "username": username,
+                    "timestamp": comment.timestamp.isoformat(),
+                    "content_html": comment.content_html,
+                    "html": str(comment_item(comment, username, can_delete)),
+                }
+                for comment, username in page["comments"]
+            ],
+            "next": page["next"],
+        }
+    )
+
+
+# the ranges of the most played chart besides all time: days -> title
+PLAY_CHART_DAYS = {7: "This week", 1: "Today"}
+
+
+@bp.route("/charts/", defaults={"path": None})
+@bp.route("/charts/<path:path>")
+def charts(path):
+    """
+    Show a chart (trending, top rated, most discussed or most played) for the
+    library or one directory.
+
+    The chart is read from the precomputed media_file_stats table, see
+    hooli_colab/charts.py.  Most played also takes days=7 or days=1, for the
+    plays of the last week or today from play_count_daily, see hooli_colab/plays.py.
+
+    Args:
+        path (str): The directory's slug path, or None for the whole library.
+
+    Returns:
+        Response: Renders 'charts.html' with the chart entries.
+    """
+    name = request.args.get("chart", TRENDING)
+    if name not in CHARTS:
+        name = TRENDING
+    directory = None
+    if path is not None:
+        directory = directory_for_path(path)
+        if directory is None:
+            abort(404)
+
+    days = request.args.get("days", type=int) if name == MOST_PLAYED else None
+    if days not in PLAY_CHART_DAYS:
+        days = None
+    if days is not None:
+        entries = [
+            {"media_file": media_file, "plays": plays}
+            for media_file, plays in most_played(
+                days,
+                directory_id=directory.id if directory else None,
+                limit=current_app.config["CHART_LENGTH"],
+            )
+        ]
+    else:
+        entries = [
+            {
+                "media_file": media_file,
+                "stats": stats,
+                "heat": trending_score(stats.trending),
+                "average_stars": (
+                    stats.rating_sum / stats.rating_count if stats.rating_count else 0
+                ),
+                "plays": stats.play_count,
+            }
+            for stats, media_file in chart(
+                name,
+                directory_id=directory.id if directory else None,
+                limit=current_app.config["CHART_LENGTH"],
+            )
+        ]
+    return render_template(
+        "charts.html",
+        charts={key: title for key, (title, _) in CHARTS.items()},
+        chart_name=name,
+        play_days=PLAY_CHART_DAYS,
+        days=days,
+        directory=directory,
+        entries=entries,
     )
 
 
-@app.route("/download/<path:filename>")
+def event_stream(channel):
+    """
+    Open a server-sent event stream of count updates on a channel.
+
+    Args:
+        channel (str): The channel, "file:<id>" or "directory:<id>".
+
+    Returns:
+        Response: The text/event-stream response, or 503 if too many are open.
+    """
+    broker = current_app.extensions["event_broker"]
+    try:
+        subscription, replay = broker.subscribe(
+            [channel], request.headers.get("Last-Event-ID")
+        )
+    except TooManySubscribers:
+        return Response(
+            "too many live update streams", status=503, headers={"Retry-After": "30"}
+        )
+    response = Response(
+        stream(broker, subscription, replay, current_app.config["EVENTS_HEARTBEAT_SECONDS"]),
+        mimetype="text/event-stream",
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # don't let nginx buffer the stream
+    # in case the client is gone before the stream starts
+    response.call_on_close(lambda: broker.unsubscribe(subscription))
+    return response
+
+
+@bp.route("/events/directory/<int:dir_id>")
+def directory_events(dir_id):
+    """Stream like, rating and comment counts for the files in a directory."""
+    return event_stream(f"directory:{dir_id}")
+
+
+@bp.route("/events/file/<int:file_id>")
+def file_events(file_id):
+    """Stream like, rating and comment counts for one file."""
+    return event_stream(f"file:{file_id}")
+
+
+@bp.route("/download/<path:filename>")
 def download_file(filename):
     """
     Download a file from the media directory.
 
+    Media files that have been indexed get a strong ETag (their content hash)
+    and a Last-Modified from the stored metadata, so a conditional request
+    from a browser replaying a track is answered with a 304 without touching
+    the disk.  Cache-Control comes from the CACHE_CONTROL_POLICIES config.
+
     Args:
         filename (str): The name of the file to be downloaded.
 
     Returns:
         Response: A Flask response object that initiates the file download.
     """
-    return send_from_directory(app.config["MEDIA_ROOT"], filename, as_attachment=True)
+    cache_control = cache_control_for(filename)
+    media_file = MediaFile.query.filter_by(filepath=filename).first()
+    etag, last_modified = media_file_validators(media_file)
+    if etag is not None:
+        response = not_modified_response(etag, last_modified, cache_control)
+        if response is not None:
+            return response
+
+    # whichever storage root the file is in now; a file being moved is served
+    # from its old root until its row is switched to the new one
+    try:
+        root = root_path(current_app.config, media_file.storage_root if media_file else None)
+    except StorageError:
+        abort(404)
+    response = send_from_directory(
+        root,
+        filename,
+        as_attachment=True,
+        etag=etag if etag is not None else True,
+        last_modified=last_modified,
+    )
+    response.headers["Cache-Control"] = cache_control
+    return response
 
 
-@app.route("/static/<path:filename>")
 def static_files(filename):
     """
     Serve static files from the media directory.
 
+    url_for('static', ...) adds a ?v=<content hash> parameter; when that
+    matches the file it's served as immutable, otherwise it gets the normal
+    policy for its type.  Built bundles already have the hash in their name
+    and are served from their gzip or brotli precompressed copy when the
+    client accepts it.
+
     Args:
         filename (str): The name of the file to be served.
 
     Returns:
         Response: The response object containing the static file.
     """
-    return send_from_directory("static", filename)
+    if is_built_asset(filename):
+        versioned = True
+        encodings = precompressed_encodings(filename)
+        for encoding, suffix in ENCODINGS:
+            if encoding in encodings and request.accept_encodings[encoding]:
+                response = send_from_directory(
+                    "static",
+                    filename + suffix,
+                    mimetype=mimetypes.guess_type(filename)[0],
+                    download_name=os.path.basename(filename),
+                )
+                response.headers["Content-Encoding"] = encoding
+                break
+        else:
+            response = send_from_directory("static", filename)
+        response.vary.add("Accept-Encoding")
+    else:
+        version = request.args.get("v")
+        versioned = version is not None and version == static_version(filename)
+        response = send_from_directory("static", filename)
+    response.headers["Cache-Control"] = cache_control_for(filename, versioned=versioned)
+    return response
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     """
     Logs the user out and redirects them to the previous page or the media browsing page.
@@ -369,10 +895,10 @@ def logout():
         Response: A redirect response to the referring page or 'browse_media' page.
     """
     logout_user()
-    return redirect(request.referrer or url_for("browse_media", _external=True))
+    return redirect(request.referrer or url_for("hooli.browse_media", _external=True))
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     """
     Handle user login.
@@ -388,12 +914,12 @@ def login():
     """
     form = CustomLoginForm()
     if form.validate_on_submit():
-        print(f'Login successful for "{form.user.email}" ({form.user.username})')
         login_user(form.user)
+        log_message("login succeeded for %s", form.user.username, event="login", outcome="ok")
 
         # figure out where to direct to
         if not form.next.data:
-            next_page = url_for("browse_media")
+            next_page = url_for("hooli.browse_media")
         else:
             next_link = form.next.data
             app_root = request.script_root  # e.g., "/hooli"
@@ -402,17 +928,23 @@ def login():
             relative_next = next_link.lstrip('/')
             next_page = urljoin(app_root, relative_next)
 
-        print(f'next page {next_page}')
+        log_message("login next page %s", next_page, level="debug", event="login")
         return redirect(next_page)
 
-    print(f'Login failed for "{form.username_or_email.data}"')
     if form.is_submitted():
+        log_message(
+            "login failed for %r",
+            form.username_or_email.data,
+            level="warning",
+            event="login",
+            outcome="failed",
+        )
         flash("Invalid credentials", "danger")
     form.next.data = request.args.get("next")
     return render_template("login.html", form=form)
 
 
-@app.route("/forgot-password", methods=["GET", "POST"])
+@bp.route("/forgot-password", methods=["GET", "POST"])
 def forgot_password():
     """
     Handle the forgot password process.
@@ -434,15 +966,15 @@ def forgot_password():
             # Pass email as query parameter
             return redirect(
                 url_for(
-                    "password_reset_email_sent", email=form.email.data, _external=True
+                    "hooli.password_reset_email_sent", email=form.email.data, _external=True
                 )
             )
         flash("Email address not found.", "danger")
-        return redirect(url_for("forgot_password", _external=True))
+        return redirect(url_for("hooli.forgot_password", _external=True))
     return render_template("forgot_password.html", form=form)
 
 
-@app.route("/reset-password/<token>", methods=["GET", "POST"])
+@bp.route("/reset-password/<token>", methods=["GET", "POST"])
 def reset_password(token):
     """
     Handle password reset requests.
@@ -463,7 +995,7 @@ def reset_password(token):
     email = verify_reset_token(token)
     if not email:
         flash("The reset link is invalid or has expired.", "danger")
-        return redirect(url_for("forgot_password", _external=True))
+        return redirect(url_for("hooli.forgot_password", _external=True))
 
     user = User.query.filter_by(email=email).first()
     form = ResetPasswordForm()
@@ -474,12 +1006,12 @@ def reset_password(token):
         )  # Use Flask-Security's hash_password
         db.session.commit()
         flash("Your password has been updated.", "success")
-        return redirect(url_for("login", _external=True))
+        return redirect(url_for("hooli.login", _external=True))
 
     return render_template("reset_password.html", form=form, token=token)
 
 
-@app.route("/password-reset-email-sent")
+@bp.route("/password-reset-email-sent")
 def password_reset_email_sent():
     """
     Handles the password reset email sent page.
@@ -495,13 +1027,13 @@ def password_reset_email_sent():
     """
     email = request.args.get("email", "")  # Get email from query params
     if not email:
-        return redirect(url_for("login", _external=True))
+        return redirect(url_for("hooli.login", _external=True))
     # Mask email for privacy
     masked_email = email[:2] + "*" * (email.find("@") - 2) + email[email.find("@") :]
     return render_template("password_reset_email_sent.html", email=masked_email)
 
 
-@app.route("/user-profile", methods=["GET"])
+@bp.route("/user-profile", methods=["GET"])
 @login_required
 def user_profile():
     """
@@ -513,7 +1045,83 @@ def user_profile():
     return render_template("user_profile.html")
 
 
-@app.route("/change-password", methods=["GET", "POST"])
+def library_args():
+    """the section, sort, cursor and page size a library request asks for"""
+    section = request.args.get("section", LIBRARY_LIKED)
+    sort = request.args.get("sort", LIBRARY_RECENT)
+    limit = request.args.get("limit", current_app.config["LIBRARY_PAGE_SIZE"], type=int)
+    limit = max(1, min(limit, current_app.config["LIBRARY_MAX_PAGE_SIZE"]))
+    return section, sort, request.args.get("after") or None, limit
+
+
+@bp.route("/library")
+@login_required
+def library():
+    """
+    The current user's library: the tracks they've liked or rated and their
+    comments, from every folder, a page at a time.
+
+    Query parameters are section (liked, rated or comments), sort (recent,
+    oldest, or top for ratings) and after, the cursor of the next page.
+
+    Returns:
+        Response: The rendered library page.
+    """
+    section, sort, cursor, limit = library_args()
+    try:
+        page = library_page(current_user.id, section, sort=sort, cursor=cursor, limit=limit)
+    except ValueError:
+        abort(404)
+    return render_template(
+        "library.html",
+        sections=LIBRARY_SECTIONS,
+        sorts=LIBRARY_SORTS[section],
+        section=section,
+        sort=sort,
+        entries=page["entries"],
+        next_cursor=page["next"],
+    )
+
+
+@bp.route("/api/library")
+@login_required
+def library_json():
+    """
+    The current user's library as JSON, see library().
+
+    Returns:
+        Response: {"status": "ok", "section", "sort", "entries": [...], "next"},
+            or 400 with {"status": "invalid"} for an unknown section, sort or cursor.
+    """
+    section, sort, cursor, limit = library_args()
+    try:
+        page = library_page(current_user.id, section, sort=sort, cursor=cursor, limit=limit)
+    except ValueError as e:
+        return jsonify({"status": "invalid", "error": str(e)}), 400
+    entries = []
+    for entry in page["entries"]:
+        media_file = entry["media_file"]
+        item = {
+            "id": media_file.id,
+            "title": media_file.title or media_file.filename,
+            "artist": media_file.artist,
+            "page_url": media_url(media_file.id),
+            "file_url": url_for("hooli.download_file", filename=media_file.filepath),
+            "timestamp": entry["timestamp"].isoformat(),
+        }
+        if "stars" in entry:
+            item["stars"] = entry["stars"]
+        if "comment" in entry:
+            item["comment_id"] = entry["comment"].id
+            item["comment"] = entry["comment"].content
+            item["comment_html"] = entry["comment"].content_html
+        entries.append(item)
+    return jsonify(
+        {"status": "ok", "section": section, "sort": sort, "entries": entries, "next": page["next"]}
+    )
+
+
+@bp.route("/change-password", methods=["GET", "POST"])
 @login_required
 def change_password():
     """
@@ -533,21 +1141,21 @@ def change_password():
     if request.method == "POST":
         if not verify_password(request.form["current_password"], current_user.password):
             flash("Current password is incorrect", "danger")
-            return redirect(url_for("change_password", _external=True))
+            return redirect(url_for("hooli.change_password", _external=True))
 
         if request.form["new_password"] != request.form["confirm_password"]:
             flash("New passwords don't match", "danger")
-            return redirect(url_for("change_password", _external=True))
+            return redirect(url_for("hooli.change_password", _external=True))
 
         current_user.password = hash_password(request.form["new_password"])
         db.session.commit()
         flash("Password updated successfully", "success")
-        return redirect(url_for("user_profile"))
+        return redirect(url_for("hooli.user_profile"))
 
     return render_template("change_password.html")
 
 
-@app.route("/edit/<int:media_id>", methods=["GET", "POST"])
+@bp.route("/edit/<int:media_id>", methods=["GET", "POST"])
 @roles_accepted("Admin", "Editor")
 def edit_media_file_metadata(media_id):
     """
@@ -576,22 +1184,213 @@ def edit_media_file_metadata(media_id):
         form.populate_obj(media_file)
         db.session.commit()
         flash("Media file metadata updated successfully.", "success")
-        return redirect(url_for("view_media", file_id=media_id, _external=True))
+        return redirect(media_url(media_id, _external=True))
     return render_template(
         "edit_media_file_metadata.html", media_file=media_file, form=form
     )
 
 
-@app.route("/toggle_like/<int:file_id>", methods=["POST"])
+@bp.route("/bulk-edit/", defaults={"path": ""})
+@bp.route("/bulk-edit/<path:path>")
+@roles_accepted("Admin", "Editor")
+def bulk_edit_media(path):
+    """
+    Show the bulk metadata editor for a directory's files, or for ?ids=1,2,3.
+
+    The grid posts its changes to bulk_edit_json.
+
+    Args:
+        path (str): The directory's slug path.
+
+    Returns:
+        Response: Renders 'bulk_edit.html', or 404 if the directory isn't known.
+    """
+    ids = request.args.get("ids")
+    directory = None
+    if ids:
+        try:
+            media_file_ids = [int(i) for i in ids.split(",")]
+        except ValueError:
+            abort(400)
+        media_files = MediaFile.query.filter(MediaFile.id.in_(media_file_ids)).all()
+    else:
+        directory = directory_for_path(path)
+        if directory is None:
+            abort(404)
+        media_files = MediaFile.query.filter_by(directory_id=directory.id).all()
+    media_files.sort(key=lambda media_file: media_file.filepath)
+    return render_template(
+        "bulk_edit.html",
+        directory=directory,
+        media_files=media_files[: current_app.config["BULK_EDIT_MAX_FILES"]],
+        fields=GRID_FIELDS,
+    )
+
+
+@bp.route("/api/bulk-edit", methods=["POST"])
+@roles_accepted("Admin", "Editor")
+def bulk_edit_json():
+    """
+    Apply metadata changes to many media files in one transaction.
+
+    Takes {"ids": [...]} or {"directory": slug path}, plus "operations" (see
+    hooli_colab/bulkedit.py), "rows" ({id: {field: value}} from the grid) and
+    "dry_run".  Nothing is changed unless every row validates.
+
+    Returns:
+        Response: {"status": "ok", "dry_run", "changed", "rows": [per-file diffs]},
+            or 400 with {"status": "invalid", "errors": [...]}.
+    """
+
+    def invalid(error):
+        return jsonify({"status": "invalid", "errors": [{"id": None, "error": error}]}), 400
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return invalid("expected a JSON object")
+    if data.get("directory") is not None:
+        directory = directory_for_path(data["directory"])
+        if directory is None:
+            return jsonify({"status": "not_found"}), 404
+        media_file_ids = [
+            media_file_id
+            for (media_file_id,) in MediaFile.query.filter_by(directory_id=directory.id)
+            .order_by(MediaFile.filepath)
+            .with_entities(MediaFile.id)
+        ]
+    else:
+        media_file_ids = data.get("ids") or []
+        if not isinstance(media_file_ids, list) or not all(
+            isinstance(i, int) for i in media_file_ids
+        ):
+            return invalid("ids must be a list of integers")
+    if len(media_file_ids) > current_app.config["BULK_EDIT_MAX_FILES"]:
+        return invalid(f"at most {current_app.config['BULK_EDIT_MAX_FILES']} files at a time")
+    operations = data.get("operations") or []
+    rows = data.get("rows") or {}
+    if not isinstance(operations, list) or not isinstance(rows, dict):
+        return invalid("operations must be a list and rows an object")
+
+    dry_run = bool(data.get("dry_run"))
+    try:
+        diff = bulk_edit(media_file_ids, operations, rows=rows, dry_run=dry_run)
+    except BulkEditError as e:
+        return jsonify({"status": "invalid", "errors": e.errors}), 400
+    return jsonify({"status": "ok", "dry_run": dry_run, "changed": len(diff), "rows": diff})
+
+
+def upload_error(e):
+    """the JSON response for an UploadError"""
+    body = {"status": "error", "error": str(e)}
+    if e.offset is not None:
+        body["offset"] = e.offset
+    return jsonify(body), e.status
+
+
+@bp.route("/api/uploads", methods=["POST"])
+@roles_accepted("Admin", "Editor")
+def start_upload_json():
+    """
+    Start a chunked upload of an audio file into a directory.
+
+    Takes {"directory_id", "filename", "size", "sha256"}, see hooli_colab/uploads.py.
+
+    Returns:
+        Response: {"status": "ok", "upload_id", "offset", "size", "chunk_size"},
+            or an error status with {"status": "error", "error"}.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "error": "expected a JSON object"}), 400
+    try:
+        upload = start_upload(
+            current_app.config,
+            data.get("directory_id"),
+            data.get("filename"),
+            data.get("size"),
+            sha256=data.get("sha256"),
+            user_id=current_user.id,
+        )
+    except UploadError as e:
+        return upload_error(e)
+    return jsonify({"status": "ok", **upload})
+
+
+@bp.route("/api/uploads/<upload_id>", methods=["GET", "PUT", "DELETE"])
+@roles_accepted("Admin", "Editor")
+def upload_chunk(upload_id):
+    """
+    An upload in progress: GET how much has arrived, PUT the next chunk
+    (Content-Range: bytes start-end/size, optional X-Chunk-SHA256), or DELETE
+    it.
+
+    Args:
+        upload_id (str): The upload.
+
+    Returns:
+        Response: {"status": "ok", "upload_id", "offset", "size"}, or an error
+            status with {"status": "error", "error"}, and "offset" when a
+            chunk didn't start where the upload has got to.
+    """
+    try:
+        if request.method == "DELETE":
+            cancel_upload(current_app.config, upload_id)
+            return jsonify({"status": "ok"})
+        if request.method == "GET":
+            status = upload_status(current_app.config, upload_id)
+        else:
+            status = write_chunk(
+                current_app.config,
+                upload_id,
+                request.stream,
+                request.headers.get("Content-Range"),
+                chunk_sha256=request.headers.get("X-Chunk-SHA256"),
+            )
+    except UploadError as e:
+        return upload_error(e)
+    return jsonify({"status": "ok", **status})
+
+
+@bp.route("/api/uploads/<upload_id>/complete", methods=["POST"])
+@roles_accepted("Admin", "Editor")
+def complete_upload_json(upload_id):
+    """
+    Finish an upload: check it, move it into its directory and add it to the catalog.
+
+    Args:
+        upload_id (str): The upload.
+
+    Returns:
+        Response: {"status": "ok", "id", "filepath", "page_url"} for the new
+            media file, or an error status with {"status": "error", "error"}.
+    """
+    try:
+        media_file = complete_upload(current_app.config, upload_id)
+    except UploadError as e:
+        return upload_error(e)
+    return jsonify(
+        {
+            "status": "ok",
+            "id": media_file.id,
+            "filepath": media_file.filepath,
+            "page_url": media_url(media_file.id),
+        }
+    )
+
+
+@bp.route("/toggle_like/<int:file_id>", methods=["POST"])
 def toggle_like(file_id):
     """
-    Toggle the like status of a media file for the current user.
+    Like or unlike a media file for the current user.
 
     This route handles the toggling of a like status for a media file identified by `file_id`.
     If the user is not authenticated, it returns a JSON response indicating the user
     is not authenticated.
-    If the user has already liked the media file, the like is removed (unliked).
-    If the user has not liked the media file, a new like is added.
+    The request body says which state the user wants, {"liked": true} or
+    {"liked": false}, so two quick clicks that reach different processes before a
+    write-behind flush still end up where the user left the button.  Without it
+    (an old copy of site.js), the like is removed if the user has already liked
+    the file, and added if not.
 
     Args:
         file_id (int): The ID of the media file to toggle the like status for.
@@ -601,32 +1400,23 @@ def toggle_like(file_id):
         If the user is not authenticated, returns a JSON response with status 'not_authenticated'
         and HTTP status code 401.
     """
-    from hooli_colab import db
-
     if not current_user.is_authenticated:
         # flash(
         #    "You must be logged in to like a song. Please login or register.", "danger"
         # )
         return jsonify({"status": "not_authenticated"}), 401
 
-    like = Likes.query.filter_by(user_id=current_user.id, media_file_id=file_id).first()
-    if like:
-        db.session.delete(like)
-        db.session.commit()
-        status = "unliked"
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and isinstance(data.get("liked"), bool):
+        liked = data["liked"]
     else:
-        new_like = Likes(
-            user_id=current_user.id,
-            media_file_id=file_id,
-            ip_address=request.remote_addr,
-        )
-        db.session.add(new_like)
-        db.session.commit()
-        status = "liked"
+        liked = not user_likes(file_id)
+    set_like(current_user.id, file_id, liked, request.remote_addr)
+    status = "liked" if liked else "unliked"
     return jsonify({"status": status})
 
 
-@app.route("/<int:media_id>/add_comment", methods=["POST"])
+@bp.route("/<int:media_id>/add_comment", methods=["POST"])
 @login_required
 def add_comment(media_id):
     from hooli_colab import db
@@ -639,22 +1429,18 @@ def add_comment(media_id):
             content=comment_form.comment.data,
             ip_address=request.remote_addr,
         )
+        set_comment_html(comment)
         db.session.add(comment)
+        record_comment(media_id, True)
         db.session.commit()
         flash("Your comment has been added.", "success")
 
-    return redirect(
-        url_for(
-            "view_media", file_id=media_id, comment_form=comment_form, _external=True
-        )
-    )
+    return redirect(media_url(media_id, _external=True))
 
 
-@app.route("/<int:media_id>/add_rating", methods=["POST"])
+@bp.route("/<int:media_id>/add_rating", methods=["POST"])
 @login_required
 def add_rating(media_id):
-    from hooli_colab import db
-
     rating = request.form.get("rating")
     if rating:
         try:
@@ -663,42 +1449,30 @@ def add_rating(media_id):
                 raise ValueError
         except ValueError:
             flash("Invalid rating value.", "danger")
-            return redirect(url_for("view_media", file_id=media_id, _external=True))
+            return redirect(media_url(media_id, _external=True))
 
-        existing_rating = Stars.query.filter_by(
-            user_id=current_user.id, media_file_id=media_id
-        ).first()
-        if existing_rating:
-            existing_rating.stars = rating
+        if user_rating(media_id) is not None:
             flash("Your rating has been updated.", "success")
         else:
-            new_rating = Stars(
-                user_id=current_user.id,
-                media_file_id=media_id,
-                stars=rating,
-                ip_address=request.remote_addr,
-            )
-            db.session.add(new_rating)
             flash("Your rating has been submitted.", "success")
-        db.session.commit()
-        return redirect(url_for("view_media", file_id=media_id, _external=True))
+        set_rating(current_user.id, media_id, rating, request.remote_addr)
+        return redirect(media_url(media_id, _external=True))
     flash("Rating is required.", "danger")
-    return redirect(url_for("view_media", file_id=media_id, _external=True))
+    return redirect(media_url(media_id, _external=True))
 
 
-@app.route("/delete_comment/<int:comment_id>", methods=["POST"])
+@bp.route("/delete_comment/<int:comment_id>", methods=["POST"])
 @roles_accepted("Admin", "Editor")
 def delete_comment(comment_id):
     from hooli_colab import db
 
     # if not current_user.has_role("Admin") and not current_user.has_role("Editor"):
     #    flash("You do not have permission to delete comments.", "danger")
-    #    return redirect(url_for("view_media", _external=True))
+    #    return redirect(url_for("hooli.view_media", _external=True))
 
     comment = Comments.query.get_or_404(comment_id)
     db.session.delete(comment)
+    record_comment(comment.media_file_id, False, when=comment.timestamp)
     db.session.commit()
     flash("Comment has been deleted.", "success")
-    return redirect(
-        url_for("view_media", file_id=comment.media_file_id, _external=True)
-    )
+    return redirect(media_url(comment.media_file_id, _external=True))
@@ -0,0 +1,52 @@
+""" hooli schema upkeep: create missing tables, columns and indexes """
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+
+def upgrade_schema(db):
+    """
+    Bring the database up to date with the models.
+
+    db.create_all() only creates tables that don't exist yet, so columns and
+    indexes added to existing models never make it into a database that was
+    created earlier.  This adds any missing columns that are nullable or have
+    a server default with ALTER TABLE, and creates any missing indexes.  Must
+    be called inside an app context.
+
+    Args:
+        db (SQLAlchemy): The Flask-SQLAlchemy instance.
+
+    Returns:
+        list: Human readable descriptions of the changes that were made.
+    """
+    db.create_all()
+
+    changes = []
+    for bind_key, metadata in db.metadatas.items():
+        engine = db.engines[bind_key]
+        inspector = inspect(engine)
+        with engine.begin() as conn:
+            for table in metadata.sorted_tables:
+                existing = {col["name"] for col in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    if not column.nullable and column.server_default is None:
+                        changes.append(
+                            f"skipped {table.name}.{column.name}: NOT NULL without default"
+                        )
+                        continue
+                    # the full column spec, so existing rows get its server default
+                    spec = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {spec}'))
+                    changes.append(f"added column {table.name}.{column.name}")
+
+                for index in table.indexes:
+                    existing_indexes = {
+                        ix["name"] for ix in inspect(conn).get_indexes(table.name)
+                    }
+                    if index.name not in existing_indexes:
+                        index.create(conn)
+                        changes.append(f"added index {index.name}")
+    return changes
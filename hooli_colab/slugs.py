@@ -0,0 +1,276 @@
+""" hooli slugs: readable URLs for directories and files
+
+A directory's URL is its slug, e.g. /artist/album, built from its parent's
+slug and its own name; a file's is its directory's plus its own slug, e.g.
+/artist/album/track-title, made from its title (or filename) when it's first
+seen.  Slugs are stored (MediaDirectory.slug, MediaFile.slug) and don't change
+when a title does, so links keep working; clashes get a -2, -3, ... suffix.
+A file the indexer finds in another directory gets a new slug path there, and
+its old one is kept in former_slug and redirects to it.
+
+Each process holds the whole URL map in memory (SlugResolver), so resolving a
+URL is a dict lookup with no query and no filesystem stat.  Writers bump the
+catalog_version row and resolvers reload when they notice, at most every
+SLUG_REFRESH_SECONDS.
+"""
+
+import re
+import threading
+import time
+import unicodedata
+
+from sqlalchemy import text
+
+from hooli_colab.models import CatalogVersion, FormerSlug, MediaDirectory, MediaFile
+
+DIRECTORY = "directory"
+FILE = "file"
+
+SLUG_MAX_LENGTH = 80
+
+
+def slugify(value, fallback="untitled"):
+    """
+    Turn a title or file name into lowercase ASCII words joined by hyphens.
+
+    Args:
+        value (str): The text.
+        fallback (str, optional): What to use if nothing is left.  Defaults to "untitled".
+
+    Returns:
+        str: The slug, at most SLUG_MAX_LENGTH characters.
+    """
+    value = unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode()
+    slug = re.sub(r"[^a-z0-9]+", "-", value.lower()).strip("-")
+    return slug[:SLUG_MAX_LENGTH].rstrip("-") or fallback
+
+
+def _join(parent, name):
+    return f"{parent}/{name}" if parent else name
+
+
+def _unique(parent, name, taken):
+    """the first of parent/name, parent/name-2, ... that isn't taken"""
+    candidate = _join(parent, name)
+    number = 2
+    while candidate in taken:
+        candidate = _join(parent, f"{name}-{number}")
+        number += 1
+    return candidate
+
+
+def reserved_names(app):
+    """first path segments the app's own routes use, which top level slugs can't take"""
+    names = set()
+    for rule in app.url_map.iter_rules():
+        first = rule.rule.lstrip("/").split("/", 1)[0]
+        if first and "<" not in first:
+            names.add(first)
+    return names
+
+
+def bump_catalog_version(session):
+    """
+    Tell every process's resolver that URLs have changed, once the session commits.
+
+    Args:
+        session (Session): The session making the change.
+    """
+    session.execute(
+        text(
+            "INSERT INTO catalog_version (id, version) VALUES (1, 1) "
+            "ON CONFLICT (id) DO UPDATE SET version = version + 1"
+        )
+    )
+
+
+def retire_file_slug(media_file):
+    """
+    Clear a file's slug so assign_slugs gives it a new one, keeping its old
+    slug path in former_slug so links to it redirect.  Doesn't commit.
+
+    Args:
+        media_file (MediaFile): The file, still in its old directory.
+    """
+    from hooli_colab import db
+
+    if media_file.slug is None:
+        return
+    directory = db.session.get(MediaDirectory, media_file.directory_id)
+    if directory is not None and directory.slug is not None:
+        db.session.merge(
+            FormerSlug(path=_join(directory.slug, media_file.slug), media_file_id=media_file.id)
+        )
+    media_file.slug = None
+
+
+def assign_slugs():
+    """
+    Give every directory and file that doesn't have a slug one, and commit.
+
+    Directories are done parents first so a child's slug extends its
+    parent's.  Must be called inside an app context.
+
+    Returns:
+        int: The number of slugs assigned.
+    """
+    from flask import current_app
+
+    from hooli_colab import db
+
+    directories = MediaDirectory.query.all()
+    by_dirpath = {directory.dirpath: directory for directory in directories}
+    directory_slugs = {d.id: d.slug for d in directories if d.slug is not None}
+    taken = set(reserved_names(current_app)) | set(directory_slugs.values())
+    files = MediaFile.query.all()
+    for media_file in files:
+        if media_file.slug is not None and media_file.directory_id in directory_slugs:
+            taken.add(_join(directory_slugs[media_file.directory_id], media_file.slug))
+
+    count = 0
+    for directory in sorted(directories, key=lambda d: (d.dirpath.count("/"), d.dirpath)):
+        if directory.slug is not None:
+            continue
+        if directory.dirpath == ".":
+            directory.slug = ""
+        else:
+            parent_dirpath, _, name = directory.dirpath.rpartition("/")
+            parent = by_dirpath.get(parent_dirpath or ".")
+            if parent is not None and parent.slug is not None:
+                parent_slug = parent.slug
+            else:
+                parts = [part for part in parent_dirpath.split("/") if part]
+                parent_slug = "/".join(slugify(part) for part in parts)
+            directory.slug = _unique(parent_slug, slugify(name), taken)
+        taken.add(directory.slug)
+        directory_slugs[directory.id] = directory.slug
+        count += 1
+
+    for media_file in sorted(files, key=lambda f: f.filepath):
+        if media_file.slug is not None:
+            continue
+        parent_slug = directory_slugs.get(media_file.directory_id, "")
+        name = media_file.title or media_file.filename.rsplit(".", 1)[0]
+        full = _unique(parent_slug, slugify(name, fallback="track"), taken)
+        taken.add(full)
+        media_file.slug = full.rpartition("/")[2]
+        count += 1
+
+    if count:
+        bump_catalog_version(db.session)
+    db.session.commit()
+    if count and "slug_resolver" in current_app.extensions:
+        current_app.extensions["slug_resolver"].invalidate()
+    return count
+
+
+class SlugResolver:
+    """
+    The URL map of one process: slug paths to directory and file ids and back.
+
+    Attributes:
+        refresh_seconds (float): How often catalog_version is checked.
+    """
+
+    def __init__(self, refresh_seconds=5):
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = float("-inf")
+        # (path -> (kind, id), directory id -> path, file id -> path, former path -> file id)
+        self._maps = ({}, {}, {}, {})
+
+    def invalidate(self):
+        """check catalog_version on the next lookup instead of waiting"""
+        self._checked = float("-inf")
+
+    def _load(self):
+        from hooli_colab import db
+
+        paths, directory_paths, file_paths = {}, {}, {}
+        for directory_id, slug in db.session.query(
+            MediaDirectory.id, MediaDirectory.slug
+        ).filter(MediaDirectory.slug.isnot(None)):
+            directory_paths[directory_id] = slug
+            paths[slug] = (DIRECTORY, directory_id)
+        for file_id, directory_id, slug in db.session.query(
+            MediaFile.id, MediaFile.directory_id, MediaFile.slug
+        ).filter(MediaFile.slug.isnot(None)):
+            if directory_id not in directory_paths:
+                continue
+            path = _join(directory_paths[directory_id], slug)
+            file_paths[file_id] = path
+            # a directory wins if a file somehow ended up with the same path
+            paths.setdefault(path, (FILE, file_id))
+        former_paths = {
+            path: file_id
+            for path, file_id in db.session.query(FormerSlug.path, FormerSlug.media_file_id)
+            if path not in paths
+        }
+        return paths, directory_paths, file_paths, former_paths
+
+    def _current(self):
+        """the maps, reloaded first if catalog_version has moved"""
+        if time.monotonic() - self._checked < self.refresh_seconds:
+            return self._maps
+        from hooli_colab import db
+
+        with self._lock:
+            if time.monotonic() - self._checked >= self.refresh_seconds:
+                version = db.session.query(CatalogVersion.version).scalar()
+                if version != self._version or not self._maps[0]:
+                    self._maps = self._load()
+                    self._version = version
+                self._checked = time.monotonic()
+        return self._maps
+
+    def resolve(self, path):
+        """
+        Look up a URL path.
+
+        Args:
+            path (str): The path without leading or trailing slashes.
+
+        Returns:
+            tuple: (DIRECTORY or FILE, id), or None if nothing has that path.
+        """
+        return self._current()[0].get(path.strip("/"))
+
+    def directory_path(self, directory_id):
+        """a directory's slug path, None if it hasn't got one"""
+        return self._current()[1].get(directory_id)
+
+    def file_path(self, file_id):
+        """a file's slug path, None if it hasn't got one"""
+        return self._current()[2].get(file_id)
+
+    def moved_to(self, path):
+        """
+        Where a file that used to be at a URL path is now.
+
+        Args:
+            path (str): The path without leading or trailing slashes.
+
+        Returns:
+            str: The file's slug path, or None if no moved file had that path.
+        """
+        _, _, file_paths, former_paths = self._current()
+        file_id = former_paths.get(path.strip("/"))
+        return None if file_id is None else file_paths.get(file_id)
+
+
+def init_slugs(app):
+    """
+    Give the app its URL map.
+
+    Args:
+        app (Flask): The app.
+    """
+    app.extensions["slug_resolver"] = SlugResolver(app.config["SLUG_REFRESH_SECONDS"])
+
+
+def resolver():
+    """the current app's SlugResolver"""
+    from flask import current_app
+
+    return current_app.extensions["slug_resolver"]
@@ -0,0 +1,289 @@
+// JavaScript to control the central audio player
+let currentPlaying = null;
+let currentButton = null;
+let continuousPlay = true;
+let shufflePlay = false;
+let shuffleSeed = null;
+
+// What plays next, from the server's /api/queue (see playqueue.py).  The
+// first of it is fetched into a muted standby element near the end of the
+// current track, so switching to it doesn't start with a cold request.
+const PREFETCH_SECONDS = 20;
+let upcomingQueue = [];
+let queueRequest = 0;
+let standbyAudio = null;
+let prefetchedUrl = null;
+
+// A play is reported to the server (see plays.py) once a track has been
+// listened to for PLAY_REPORT_SECONDS, or half of it if it's shorter.
+// Skipping ahead doesn't count as listening.
+const PLAY_REPORT_SECONDS = 30;
+let listenedSeconds = 0;
+let lastPosition = 0;
+let playReported = false;
+
+function reportPlay(audioPlayer) {
+    const step = audioPlayer.currentTime - lastPosition;
+    lastPosition = audioPlayer.currentTime;
+    if (playReported || !currentButton || step <= 0 || step > 1) return;
+    listenedSeconds += step;
+    const needed = audioPlayer.duration ? Math.min(PLAY_REPORT_SECONDS, audioPlayer.duration / 2) : PLAY_REPORT_SECONDS;
+    if (listenedSeconds < needed) return;
+    playReported = true;
+    fetch(`${baseUrl}/api/play/${currentButton.getAttribute('data-file-id')}`, {
+        method: 'POST',
+        headers: { 'X-CSRFToken': csrfToken },
+        keepalive: true
+    }).catch(() => {});
+}
+
+// Loudness normalization: each play button carries the track's gain in dB
+// (data-gain-db, from the server's loudness analysis).  A Web Audio gain node
+// can boost as well as cut; without Web Audio we can only turn quiet tracks
+// down to match, via the element's volume.
+let audioContext = null;
+let gainNode = null;
+
+function applyTrackGain(audioPlayer, gainDb) {
+    const gain = Math.pow(10, (parseFloat(gainDb) || 0) / 20);
+    const AudioContextClass = window.AudioContext || window.webkitAudioContext;
+    if (!gainNode && AudioContextClass) {
+        try {
+            audioContext = new AudioContextClass();
+            gainNode = audioContext.createGain();
+            audioContext.createMediaElementSource(audioPlayer).connect(gainNode);
+            gainNode.connect(audioContext.destination);
+        } catch (e) {
+            gainNode = null;
+        }
+    }
+    if (gainNode) {
+        if (audioContext.state === 'suspended') {
+            audioContext.resume();
+        }
+        gainNode.gain.value = gain;
+    } else {
+        audioPlayer.volume = Math.min(1, gain);
+    }
+}
+
+// Toggle Continuous Play
+function toggleContinuousPlay() {
+    continuousPlay = !continuousPlay;
+    const button = document.getElementById('continuous-toggle');
+    button.classList.toggle('active', continuousPlay);
+    fetchQueue();
+}
+
+// Toggle Shuffle Play
+function toggleShufflePlay() {
+    shufflePlay = !shufflePlay;
+    shuffleSeed = shufflePlay ? Math.floor(Math.random() * 2147483647) : null;
+    const button = document.getElementById('shuffle-toggle');
+    button.classList.toggle('active', shufflePlay);
+    fetchQueue();
+}
+
+// Ask the server what follows the current track
+function fetchQueue() {
+    const audioPlayer = document.getElementById('main-audio-player');
+    const queueUrl = audioPlayer && audioPlayer.getAttribute('data-queue-url');
+    upcomingQueue = [];
+    if (!queueUrl || !currentButton) return;
+    const params = new URLSearchParams({
+        after: currentButton.getAttribute('data-file-id'),
+        continuous: continuousPlay ? '1' : '0',
+        liked: document.getElementById('heart-toggle').classList.contains('active') ? '1' : '0',
+    });
+    if (shuffleSeed !== null) {
+        params.set('shuffle', shuffleSeed);
+    }
+    // only the latest request counts if the listener clicks around
+    const request = ++queueRequest;
+    fetch(`${queueUrl}?${params}`, { headers: { 'Accept': 'application/json' } })
+        .then(response => response.ok ? response.json() : { queue: [] })
+        .then(data => {
+            if (request === queueRequest) {
+                upcomingQueue = data.queue || [];
+            }
+        })
+        .catch(() => {});
+}
+
+// Start loading the next track before this one ends
+function prefetchNext(audioPlayer) {
+    if (!continuousPlay || upcomingQueue.length === 0 || !audioPlayer.duration) return;
+    const nextUrl = upcomingQueue[0].file_url;
+    if (nextUrl === prefetchedUrl || audioPlayer.duration - audioPlayer.currentTime > PREFETCH_SECONDS) {
+        return;
+    }
+    if (!standbyAudio) {
+        standbyAudio = new Audio();
+        standbyAudio.muted = true;
+        standbyAudio.preload = 'auto';
+    }
+    standbyAudio.src = nextUrl;
+    standbyAudio.load();
+    prefetchedUrl = nextUrl;
+}
+
+// Helper function to get visible media files
+function getVisibleMediaFiles() {
+    const listItems = document.querySelectorAll('.list-group-item');
+    const visibleFiles = [];
+    listItems.forEach(item => {
+        if (item.style.display !== 'none') {
+            const playButton = item.querySelector('.play-button');
+            const fileUrl = playButton && playButton.getAttribute('data-file-url');
+            if (fileUrl) {
+                visibleFiles.push(fileUrl);
+            }
+        }
+    });
+    return visibleFiles;
+}
+
+function togglePlay(button, fileUrl) {
+    const audioPlayer = document.getElementById('main-audio-player');
+    const listItem = button.closest('.list-group-item');
+
+    if (currentPlaying && currentButton) {
+        currentButton.textContent = 'Play';
+        currentButton.classList.remove('btn-danger');
+        currentButton.classList.add('btn-primary');
+        currentButton.closest('.list-group-item').classList.remove('playing');
+    }
+
+    if (currentPlaying === fileUrl) {
+        audioPlayer.pause();
+        button.textContent = 'Play';
+        button.classList.remove('btn-danger');
+        button.classList.add('btn-primary');
+        listItem.classList.remove('playing');
+        currentPlaying = null;
+        currentButton = null;
+    } else {
+        audioPlayer.src = fileUrl;
+        applyTrackGain(audioPlayer, button.getAttribute('data-gain-db'));
+        audioPlayer.play();
+        button.textContent = 'Stop';
+        button.classList.remove('btn-primary');
+        button.classList.add('btn-danger');
+        listItem.classList.add('playing');
+        currentPlaying = fileUrl;
+        currentButton = button;
+        listenedSeconds = 0;
+        lastPosition = 0;
+        playReported = false;
+        fetchQueue();
+    }
+
+    audioPlayer.onended = () => {
+        skipToNextSong();
+    };
+
+    const currentTimeDisplay = document.getElementById('current-time');
+
+    audioPlayer.ontimeupdate = () => {
+        const minutes = Math.floor(audioPlayer.currentTime / 60);
+        const seconds = Math.floor(audioPlayer.currentTime % 60);
+        const tenths = Math.floor((audioPlayer.currentTime % 1) * 10);
+        currentTimeDisplay.textContent = `${String(minutes).padStart(2, '0')}:${String(seconds).padStart(2, '0')}.${tenths}`;
+        prefetchNext(audioPlayer);
+        reportPlay(audioPlayer);
+    };
+
+    // Scroll to the playing song
+    if (listItem) {
+        listItem.scrollIntoView({ behavior: 'smooth', block: 'center' });
+    }
+}
+
+function skipToNextSong() {
+    if (continuousPlay && upcomingQueue.length > 0) {
+        const next = upcomingQueue[0];
+        const nextButton = document.querySelector(`.play-button[data-file-id="${next.id}"]`);
+        if (nextButton) {
+            togglePlay(nextButton, nextButton.getAttribute('data-file-url'));
+            return;
+        }
+    }
+    if (continuousPlay) {
+        const files = getVisibleMediaFiles();
+        if (files.length === 0) return;
+
+        let nextIndex;
+        if (shufflePlay) {
+            nextIndex = Math.floor(Math.random() * files.length);
+        } else {
+            nextIndex = files.indexOf(currentPlaying) + 1;
+        }
+
+        if (nextIndex < files.length) {
+            const nextFile = files[nextIndex];
+            const nextButton = document.querySelector(`.play-button[data-file-url="${nextFile}"]`);
+            if (nextButton) {
+                togglePlay(nextButton, nextFile);
+            }
+        } else {
+            // Last song reached
+            document.getElementById('main-audio-player').pause();
+            currentPlaying = null;
+            currentButton = null;
+        }
+    } else {
+        // Continuous Play is off; do nothing
+        currentPlaying = null;
+        currentButton = null;
+    }
+}
+
+function toggleLiked() {
+    const button = document.getElementById('heart-toggle');
+    const showLikedOnly = button.classList.toggle('active');
+    const listItems = document.querySelectorAll('.list-group-item');
+    listItems.forEach(item => {
+        if (showLikedOnly && item.getAttribute('data-liked') !== 'true') {
+            item.style.display = 'none';
+        } else {
+            item.style.display = '';
+        }
+    });
+    fetchQueue();
+}
+
+// Responsive Adjustments
+function adjustLayout() {
+    const songList = document.querySelector('.song-list-container');
+    const controls = document.querySelector('.control-buttons');
+    if (!songList || !controls) return;
+
+    if (window.innerWidth <= 768) {
+        songList.style.height = '400px';
+        controls.classList.add('flex-column');
+        document.querySelectorAll('.control-buttons .btn').forEach(btn => {
+            btn.classList.remove('mx-1');
+            btn.classList.add('w-100', 'mb-2');
+        });
+    } else {
+        songList.style.height = '800px';
+        controls.classList.remove('flex-column');
+        document.querySelectorAll('.control-buttons .btn').forEach(btn => {
+            btn.classList.remove('w-100', 'mb-2');
+            btn.classList.add('mx-1');
+        });
+    }
+}
+
+window.addEventListener('resize', adjustLayout);
+window.addEventListener('load', adjustLayout);
+
+function isMobileDevice() {
+    return /Mobi|Android/i.test(navigator.userAgent);
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+    if (isMobileDevice()) {
+        document.body.classList.add('mobile-device');
+    }
+});
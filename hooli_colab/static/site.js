@@ -0,0 +1,107 @@
+// dark mode, like buttons and live counts, shared by every page
+const theme = localStorage.getItem('theme');
+const prefersDark = window.matchMedia('(prefers-color-scheme: dark)').matches;
+
+if (theme === 'dark') {
+    document.body.classList.add('dark-mode');
+} else if (theme === 'light') {
+    document.body.classList.remove('dark-mode');
+} else if (prefersDark) {
+    document.body.classList.add('dark-mode');
+}
+
+const darkModeToggle = document.getElementById('darkModeToggle');
+if (darkModeToggle) {
+    darkModeToggle.addEventListener('click', function() {
+        document.body.classList.toggle('dark-mode');
+        // Save preference
+        if (document.body.classList.contains('dark-mode')) {
+            localStorage.setItem('theme', 'dark');
+        } else {
+            localStorage.setItem('theme', 'light');
+        }
+    });
+}
+
+function metaContent(name) {
+    const meta = document.querySelector(`meta[name="${name}"]`);
+    return meta ? meta.getAttribute('content') : '';
+}
+
+const baseUrl = metaContent('script-root');
+const csrfToken = metaContent('csrf-token');
+
+function toggleLike(element) {
+    const fileId = element.getAttribute('data-file-id');
+    fetch(`${baseUrl}/toggle_like/${fileId}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': csrfToken
+        },
+        // the state we want rather than "toggle", so it doesn't depend on what the
+        // server has committed yet
+        body: JSON.stringify({liked: !element.classList.contains('liked')})
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.status === 'liked') {
+            element.classList.remove('unliked');
+            element.classList.add('liked');
+        } else if (data.status === 'unliked') {
+            element.classList.remove('liked');
+            element.classList.add('unliked');
+        }
+    });
+}
+
+// Live counts: pages that set the event-stream meta tag get like, rating and
+// comment counts pushed as they change instead of reloading the page.
+function starsText(rating) {
+    let stars = '';
+    for (let i = 1; i <= 5; i++) {
+        if (rating >= i) {
+            stars += '★';
+        } else if (rating >= i - 0.5) {
+            stars += '⭐';
+        } else {
+            stars += '☆';
+        }
+    }
+    return stars;
+}
+
+function setLive(className, fileId, text) {
+    document.querySelectorAll(`.${className}[data-file-id="${fileId}"]`).forEach(element => {
+        element.textContent = text;
+    });
+}
+
+function updateCounts(counts) {
+    const fileId = counts.media_file_id;
+    const average = counts.ratings ? Math.round(counts.rating_sum / counts.ratings * 100) / 100 : 0;
+    setLive('live-stars', fileId, starsText(average));
+    setLive('live-average', fileId, average);
+    setLive('live-ratings', fileId, counts.ratings);
+    setLive('live-comments', fileId, counts.comments);
+    setLive('live-comment-badge', fileId, counts.comments ? `${counts.comments} \u{1F4DD}` : '');
+}
+
+function reloadCounts() {
+    const countsUrl = metaContent('counts-url');
+    if (!countsUrl) return;
+    fetch(countsUrl)
+        .then(response => response.json())
+        .then(data => {
+            data.files.forEach(file => updateCounts({ media_file_id: file.id, ...file }));
+        });
+}
+
+const eventStreamUrl = metaContent('event-stream');
+if (eventStreamUrl && window.EventSource) {
+    // EventSource reconnects by itself and sends Last-Event-ID, so the server
+    // can replay what was missed or tell us to reset
+    const liveCounts = new EventSource(eventStreamUrl);
+    liveCounts.addEventListener('counts', event => updateCounts(JSON.parse(event.data)));
+    liveCounts.addEventListener('reset', reloadCounts);
+}
@@ -0,0 +1,416 @@
+""" hooli storage: media files spread over several roots, hot ones on the fast disks
+
+MEDIA_ROOT is the main root, and STORAGE_ROOTS adds more, each with a tier,
+"fast" or "slow", and optionally a max_bytes budget:
+
+    STORAGE_ROOTS = {"ssd": {"path": "/mnt/ssd/hooli", "tier": "fast", "max_bytes": 200 * 2**30}}
+
+A file's filepath is the same whichever root holds it; MediaFile.storage_root
+names the root, None for MEDIA_ROOT, so an install with no extra roots is
+unchanged.  Urls don't change when a file moves.
+
+The mover ranks files by heat (the charts' trending score, which counts
+plays) and moves those over STORAGE_PROMOTE_HEAT onto the fast roots, hottest
+first and within their budgets, and those that have cooled below
+STORAGE_DEMOTE_HEAT back to the slow ones.  Each move is copy, verify, switch: the file is copied next to
+its new place under a temporary name, hashed and checked against its
+content_hash, renamed into place, and only then is the row pointed at it, so
+download_file serves the old copy until the new one is whole.  The old copy
+is deleted STORAGE_MOVE_GRACE_SECONDS later, once downloads that looked the
+file up before the switch have opened it.  Old copies waiting to be deleted
+are listed in .storage-old-copies in MEDIA_ROOT, so a process that stops
+meanwhile doesn't leave them behind: whichever process runs next deletes them.
+
+"flask rebalance-storage" runs the mover once; STORAGE_MOVE_INTERVAL_MINUTES
+has each app process run it in the background, one at a time.
+"""
+
+import fcntl
+import math
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+
+from hooli_colab.indexer import hash_file
+from hooli_colab.models import MediaFile, MediaFileStats
+
+FAST = "fast"
+SLOW = "slow"
+TIERS = (FAST, SLOW)
+
+StorageRoot = namedtuple("StorageRoot", "name path tier max_bytes")
+
+# what MEDIA_ROOT, the root named None, is called in messages
+MAIN = "main"
+
+
+class StorageError(Exception):
+    """raised when a file can't be moved"""
+
+
+def storage_roots(config):
+    """
+    Every storage root, MEDIA_ROOT first (named None).
+
+    Returns:
+        list: StorageRoot tuples.
+
+    Raises:
+        StorageError: If STORAGE_ROOTS is misconfigured.
+    """
+    roots = [StorageRoot(None, config["MEDIA_ROOT"], config["MEDIA_ROOT_TIER"], None)]
+    for name, spec in (config["STORAGE_ROOTS"] or {}).items():
+        if not name or spec.get("tier", SLOW) not in TIERS:
+            raise StorageError(f"storage root {name!r} needs a name and a tier of {TIERS}")
+        roots.append(StorageRoot(name, spec["path"], spec.get("tier", SLOW), spec.get("max_bytes")))
+    return roots
+
+
+def root_paths(config):
+    """{root name: path}, for the indexer"""
+    return {root.name: root.path for root in storage_roots(config)}
+
+
+def root_path(config, name):
+    """
+    The path of a storage root.
+
+    Raises:
+        StorageError: If there's no root by that name (it's been removed from STORAGE_ROOTS).
+    """
+    for root in storage_roots(config):
+        if root.name == name:
+            return root.path
+    raise StorageError(f"no storage root {name!r}")
+
+
+def media_path(config, media_file):
+    """where a media file is on disk"""
+    return os.path.join(root_path(config, media_file.storage_root), media_file.filepath)
+
+
+def path_taken(config, filepath):
+    """True if any storage root has something at filepath"""
+    return any(os.path.exists(os.path.join(root.path, filepath)) for root in storage_roots(config))
+
+
+def chart_heat():
+    """{media file id: its current trending score} for files with any"""
+    from hooli_colab.charts import trending_score
+
+    return {
+        stats.media_file_id: trending_score(stats.trending)
+        for stats in MediaFileStats.query.filter(MediaFileStats.trending.isnot(None))
+    }
+
+
+def plan_moves(config, heat):
+    """
+    Work out which files should change roots.
+
+    Args:
+        config (dict): The app's config.
+        heat (dict): Media file id -> heat; missing files count as 0.
+
+    Returns:
+        list: (MediaFile, target root name) pairs, demotions first so they
+            make room, then promotions hottest first.
+    """
+    roots = storage_roots(config)
+    tiers = {root.name: root.tier for root in roots}
+    fast = [root for root in roots if root.tier == FAST]
+    slow = [root for root in roots if root.tier == SLOW]
+    if not fast or not slow:
+        return []
+    free = {root.name: shutil.disk_usage(root.path).free for root in slow}
+    promote, demote = config["STORAGE_PROMOTE_HEAT"], config["STORAGE_DEMOTE_HEAT"]
+    budget = {
+        root.name: root.max_bytes if root.max_bytes is not None else math.inf for root in fast
+    }
+
+    files = MediaFile.query.filter(MediaFile.content_hash.isnot(None)).all()
+    files.sort(key=lambda media_file: heat.get(media_file.id, 0.0), reverse=True)
+    demotions, promotions = [], []
+    for media_file in files:
+        current = media_file.storage_root
+        if current not in tiers:
+            continue  # its root has been removed from the config; leave it to the admin
+        hot = heat.get(media_file.id, 0.0)
+        size = media_file.filesize or 0
+        on_fast = tiers[current] == FAST
+        if hot >= promote or (on_fast and hot >= demote):
+            if on_fast and budget[current] >= size:
+                budget[current] -= size
+                continue
+            roomiest = max(fast, key=lambda root: budget[root.name])
+            if budget[roomiest.name] >= size:
+                budget[roomiest.name] -= size
+                promotions.append((media_file, roomiest.name))
+                continue
+        if on_fast:
+            target = max(free, key=free.get)
+            free[target] -= size
+            demotions.append((media_file, target))
+    return demotions + promotions
+
+
+def move_file(config, media_file, target):
+    """
+    Copy a media file to another root, verify the copy and switch its row to it.
+
+    Must be called inside an app context.  The old copy is left in place for
+    the caller to delete once nothing can still be opening it.
+
+    Args:
+        config (dict): The app's config.
+        media_file (MediaFile): The file.
+        target (str): The root to move it to.
+
+    Returns:
+        str: The path of the old copy.
+
+    Raises:
+        StorageError: If there isn't room, the copy doesn't match, something
+            else is already at the destination, or the file changed meanwhile.
+    """
+    from hooli_colab import db
+
+    source = media_path(config, media_file)
+    destination = os.path.join(root_path(config, target), media_file.filepath)
+    if os.path.exists(destination):
+        raise StorageError(f"{destination} already exists")
+    expected = media_file.content_hash or hash_file(source)
+    size = os.path.getsize(source)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if (
+        shutil.disk_usage(os.path.dirname(destination)).free
+        < size + config["STORAGE_RESERVE_BYTES"]
+    ):
+        raise StorageError(f"not enough room in {target} for {media_file.filepath}")
+
+    # hidden from the indexer by its extension, and on the destination's filesystem so the
+    # last step is a rename
+    partial = os.path.join(
+        os.path.dirname(destination), f".{os.path.basename(destination)}.{os.getpid()}.moving"
+    )
+    try:
+        shutil.copy2(source, partial)  # keeps the mtime, so Last-Modified doesn't change
+        with open(partial, "rb+") as f:
+            os.fsync(f.fileno())
+        if hash_file(partial) != expected:
+            raise StorageError(f"the copy of {media_file.filepath} doesn't match")
+        os.replace(partial, destination)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+    st = os.stat(destination)
+    current = MediaFile.storage_root
+    switched = MediaFile.query.filter(
+        MediaFile.id == media_file.id,
+        (
+            current.is_(None)
+            if media_file.storage_root is None
+            else current == media_file.storage_root
+        ),
+        MediaFile.content_hash == expected,
+    ).update(
+        {"storage_root": target, "filesize": st.st_size, "mtime": st.st_mtime, "inode": st.st_ino},
+        synchronize_session="fetch",
+    )
+    db.session.commit()
+    if not switched:
+        # the indexer or another mover got to it first; if the other mover switched the row
+        # to the same root, what's at destination is the copy it points at now
+        now_at = db.session.query(MediaFile.storage_root).filter_by(id=media_file.id).scalar()
+        if now_at != target:
+            os.remove(destination)
+        raise StorageError(f"{media_file.filepath} changed while it was being moved")
+    return source
+
+
+def _old_copies_journal(config):
+    return os.path.join(config["MEDIA_ROOT"], ".storage-old-copies")
+
+
+def schedule_old_copies(config, paths, due):
+    """
+    Note old copies to delete once their grace period is over.
+
+    Each is noted with its inode and ctime, so if a file has been moved back to
+    the same place by then, the new copy there isn't taken for the old one.
+
+    Args:
+        config (dict): The app's config.
+        paths (list): The old copies.
+        due (float): Unix time they can be deleted at.
+    """
+    lines = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            lines.append(f"{due}\t{st.st_ino}:{st.st_ctime_ns}\t{path}\n")
+        except FileNotFoundError:
+            pass
+    if not lines:
+        return
+    with open(_old_copies_journal(config), "a") as journal:
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        journal.write("".join(lines))
+
+
+def delete_old_copies(config, now=None):
+    """
+    Delete the old copies whose grace period is over, ignoring ones already gone.
+
+    Args:
+        config (dict): The app's config.
+        now (float, optional): Unix time.  Defaults to now.
+
+    Returns:
+        int: How many are still waiting.
+    """
+    now = time.time() if now is None else now
+    try:
+        journal = open(_old_copies_journal(config), "r+")
+    except FileNotFoundError:
+        return 0
+    with journal:
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        waiting = []
+        for line in journal:
+            try:
+                due, identity, path = line.rstrip("\n").split("\t", 2)
+                due = float(due)
+            except ValueError:
+                continue  # a torn line
+            if due > now:
+                waiting.append(line)
+                continue
+            try:
+                st = os.stat(path)
+                if f"{st.st_ino}:{st.st_ctime_ns}" == identity:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+        journal.seek(0)
+        journal.truncate()
+        journal.write("".join(waiting))
+    return len(waiting)
+
+
+def rebalance(config, heat=None, limit=None, echo=None, wait=True):
+    """
+    Make one pass of moves from plan_moves, first deleting the old copies
+    earlier passes left that are due.
+
+    One pass runs at a time, across processes: it holds an exclusive lock on
+    .storage.lock in MEDIA_ROOT, so two can't plan and make the same move.
+
+    Must be called inside an app context.  Each old copy is noted with
+    schedule_old_copies as soon as its file has moved.
+
+    Args:
+        config (dict): The app's config.
+        heat (dict, optional): Media file id -> heat.  Defaults to chart_heat().
+        limit (int, optional): Most moves to make.  Defaults to STORAGE_MOVES_PER_PASS.
+        echo (callable, optional): Called with a line about each move.
+        wait (bool, optional): Wait for a pass that's already running to finish, rather
+            than returning None.  Defaults to True.
+
+    Returns:
+        dict: "moved", "failed" and "bytes" counts and "old_copies", the
+            paths that will be deleted once the grace period is over.
+            None if another pass is running and wait is False.
+    """
+    with open(os.path.join(config["MEDIA_ROOT"], ".storage.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        return _rebalance(config, heat, limit, echo)
+
+
+def _rebalance(config, heat, limit, echo):
+    delete_old_copies(config)
+    heat = chart_heat() if heat is None else heat
+    limit = config["STORAGE_MOVES_PER_PASS"] if limit is None else limit
+    report = {"moved": 0, "failed": 0, "bytes": 0, "old_copies": []}
+    for media_file, target in plan_moves(config, heat)[:limit]:
+        source_name = media_file.storage_root or MAIN
+        try:
+            old_copy = move_file(config, media_file, target)
+        except (StorageError, OSError) as e:
+            report["failed"] += 1
+            if echo:
+                echo(f"couldn't move {media_file.filepath}: {e}")
+            continue
+        schedule_old_copies(config, [old_copy], time.time() + config["STORAGE_MOVE_GRACE_SECONDS"])
+        report["old_copies"].append(old_copy)
+        report["moved"] += 1
+        report["bytes"] += media_file.filesize or 0
+        if echo:
+            echo(f"{media_file.filepath}: {source_name} -> {target or MAIN}")
+    return report
+
+
+class StorageMover:
+    """
+    Rebalances storage every interval in a background thread, one process at a time.
+
+    Attributes:
+        app (Flask): The app.
+        interval (float): Seconds between passes.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._next_pass = 0.0
+
+    def start(self):
+        """start the thread in this process if it isn't running yet"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="storage-mover", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        config = self.app.config
+        while True:
+            time.sleep(min(self.interval, config["STORAGE_MOVE_GRACE_SECONDS"]))
+            now = time.time()
+            try:
+                delete_old_copies(config, now)
+            except OSError:
+                self.app.logger.exception("deleting old copies failed")
+            if self._next_pass > now:
+                continue
+            self._next_pass = now + self.interval
+            try:
+                with self.app.app_context():
+                    # returns None when another process is rebalancing
+                    rebalance(config, echo=self.app.logger.info, wait=False)
+            except Exception:  # keep the thread alive for the next pass
+                self.app.logger.exception("storage rebalance failed")
+
+
+def init_storage(app):
+    """
+    Rebalance storage in the background, if STORAGE_MOVE_INTERVAL_MINUTES is set.
+
+    Args:
+        app (Flask): The app.
+    """
+    if not app.config["STORAGE_MOVE_INTERVAL_MINUTES"] or not app.config["STORAGE_ROOTS"]:
+        return
+    mover = StorageMover(app, app.config["STORAGE_MOVE_INTERVAL_MINUTES"] * 60)
+    app.extensions["storage_mover"] = mover
+    app.before_request(mover.start)
@@ -0,0 +1,200 @@
+""" hooli streaming: an asyncio (ASGI) sidecar that serves /download/ for long listens
+
+Behind the normal WSGI app every listener holds a worker thread for as long as
+their track takes to download.  This app serves the same /download/<path>
+urls from one event loop instead, so one process can feed hundreds of
+listeners while the Flask workers are left for pages.  Run it under any ASGI
+server and send /download/ to it from the web server, e.g.
+
+    uvicorn asgi:application --root-path /hooli
+
+Each request is still answered by the Flask app's own download_file view, in
+a test request context built from the ASGI request, so the session cookie,
+ETags, 304s, Range/If-Range and Cache-Control are exactly what the WSGI app
+would give.  Only the view call and the file reads run on a small thread
+pool; the bytes go out from the event loop, which waits on slow clients
+without holding a thread.  STREAM_MAX_CONCURRENT bounds the streams in
+flight and anything over it gets a 503 straight away.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import FileWrapper
+
+DOWNLOAD_PREFIX = "/download/"
+
+
+class StreamingApp:
+    """
+    The ASGI app.
+
+    Attributes:
+        app (Flask): The hooli app whose download_file view answers requests.
+        max_streams (int): Most responses in flight at once.
+        chunk_size (int): Bytes read from the file per send.
+        require_login (bool): Refuse requests without a logged-in session.
+    """
+
+    def __init__(
+        self, app, max_streams=500, chunk_size=256 * 1024, threads=16, require_login=False
+    ):
+        self.app = app
+        self.max_streams = max_streams
+        self.chunk_size = chunk_size
+        self.require_login = require_login
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix="hooli-stream")
+        self._streams = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path) :]
+        if not path.startswith(DOWNLOAD_PREFIX) or len(path) == len(DOWNLOAD_PREFIX):
+            await _send_plain(send, 404, "Not Found")
+            return
+        if scope["method"] not in ("GET", "HEAD"):
+            await _send_plain(send, 405, "Method Not Allowed", [(b"allow", b"GET, HEAD")])
+            return
+        if self._streams >= self.max_streams:
+            await _send_plain(
+                send, 503, "Too many streams, try again shortly.", [(b"retry-after", b"5")]
+            )
+            return
+
+        self._streams += 1
+        try:
+            await self._stream(scope, receive, send, path[len(DOWNLOAD_PREFIX) :])
+        finally:
+            self._streams -= 1
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _stream(self, scope, receive, send, filename):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(self._executor, self._respond, scope, filename)
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            headers = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in response.headers.items()
+            ]
+            await send(
+                {"type": "http.response.start", "status": response.status_code, "headers": headers}
+            )
+            if scope["method"] == "HEAD":
+                await send({"type": "http.response.body", "body": b""})
+                return
+            body = iter(response.response)
+            while not disconnected.is_set():
+                data = await loop.run_in_executor(self._executor, self._read, body)
+                if not data:
+                    break
+                await send({"type": "http.response.body", "body": data, "more_body": True})
+            else:
+                return
+            await send({"type": "http.response.body", "body": b""})
+        except OSError:
+            pass  # the client went away mid-send
+        finally:
+            watcher.cancel()
+            await loop.run_in_executor(self._executor, response.close)
+
+    def _respond(self, scope, filename):
+        """the Flask response to a download request, built on a pool thread"""
+        from hooli_colab.routes import download_file
+
+        headers = [
+            (name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]
+        ]
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REMOTE_ADDR": client[0],
+            # send_file reads through this, so each read is a whole chunk
+            "wsgi.file_wrapper": lambda file, _: FileWrapper(file, self.chunk_size),
+        }
+        # the path is set directly rather than as a url, which would split it at a "?" or
+        # "#" in the file's name and unquote it a second time; WSGI paths are latin-1 strings
+        path_info = (DOWNLOAD_PREFIX + filename).encode("utf-8").decode("latin-1")
+        with self.app.test_request_context(
+            DOWNLOAD_PREFIX,
+            method=scope["method"],
+            headers=headers,
+            query_string=scope.get("query_string", b""),
+            environ_base=environ,
+            environ_overrides={"PATH_INFO": path_info},
+        ):
+            try:
+                if self.require_login and not current_user.is_authenticated:
+                    return self.app.make_response(("Log in to listen.", 401))
+                return self.app.make_response(download_file(filename))
+            except HTTPException as e:
+                return e.get_response()
+
+    def _read(self, body):
+        """up to chunk_size bytes from a response body, or b"" at the end"""
+        pieces = []
+        size = 0
+        for piece in body:
+            pieces.append(piece)
+            size += len(piece)
+            if size >= self.chunk_size:
+                break
+        return b"".join(pieces)
+
+
+async def _send_plain(send, status, text, headers=()):
+    body = text.encode() + b"\n"
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain; charset=utf-8"), *headers],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_streaming_app(config=None):
+    """
+    Build the streaming sidecar around a new hooli app.
+
+    Args:
+        config (dict, optional): Overrides for the app's config, as for create_app.
+
+    Returns:
+        StreamingApp: The ASGI app.
+    """
+    from hooli_colab import create_app
+
+    app = create_app(config)
+    return StreamingApp(
+        app,
+        max_streams=app.config["STREAM_MAX_CONCURRENT"],
+        chunk_size=app.config["STREAM_CHUNK_BYTES"],
+        threads=app.config["STREAM_READ_THREADS"],
+        require_login=app.config["STREAM_REQUIRE_LOGIN"],
+    )
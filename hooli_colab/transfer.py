@@ -0,0 +1,473 @@
+""" hooli catalog dumps: stream the catalog and social data out as JSONL, and back in
+
+A dump is one JSON object per line: a header, then every directory, file,
+user, comment, star and like in that order, then an "end" line.  Rows refer to
+each other by natural keys (dirpath, filepath, username) rather than ids, so a
+dump loads into any database: an empty one, or one that already has some of
+the same files and users, whose ids differ.  Users are only references
+(username and email); passwords and roles aren't dumped.
+
+Exporting reads each table in id order through a streaming cursor, so memory
+stays flat however big the library is.  Each line carries its row's id; an
+interrupted export is resumed by reading the last complete line and carrying
+on after it.  Importing loads batches, one transaction each, and records the
+byte offset it has reached in <dump>.progress after every commit, so an
+interrupted import picks up from the last committed batch.
+"""
+
+import json
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.sqlite import insert
+
+from hooli_colab.models import (
+    Comments,
+    Likes,
+    MediaDirectory,
+    MediaFile,
+    Stars,
+    User,
+)
+
+FORMAT = "hooli-jsonl"
+FORMAT_VERSION = 1
+
+DIRECTORY = "directory"
+FILE = "file"
+USER = "user"
+COMMENT = "comment"
+STAR = "star"
+LIKE = "like"
+# the order records appear in, each after the ones it refers to
+KINDS = (DIRECTORY, FILE, USER, COMMENT, STAR, LIKE)
+
+DIRECTORY_FIELDS = ("dirpath", "title", "description", "image_path", "slug")
+FILE_FIELDS = (
+    "filepath",
+    "filename",
+    "filetype",
+    "filesize",
+    "title",
+    "artist",
+    "album",
+    "genre",
+    "tags",
+    "description",
+    "image_path",
+    "content_hash",
+    "mtime",
+    "inode",
+    "loudness_lufs",
+    "peak_dbfs",
+    "gain_db",
+    "slug",
+)
+USER_FIELDS = ("username", "email")
+COMMENT_FIELDS = (
+    "content",
+    "content_html",
+    "content_html_version",
+    "ip_address",
+    "timestamp",
+)
+STAR_FIELDS = ("stars", "ip_address", "timestamp")
+LIKE_FIELDS = ("like", "ip_address", "timestamp")
+
+# rows fetched from the cursor at a time while exporting
+EXPORT_CHUNK = 2000
+
+
+class DumpError(Exception):
+    """raised when a dump file can't be read or resumed"""
+
+
+def _export_query(kind, after_id):
+    """the select for one kind of record, rows with id > after_id in id order"""
+    if kind == DIRECTORY:
+        columns = [MediaDirectory.id] + [getattr(MediaDirectory, f) for f in DIRECTORY_FIELDS]
+        return select(*columns).where(MediaDirectory.id > after_id).order_by(MediaDirectory.id)
+    if kind == FILE:
+        columns = [MediaFile.id, MediaDirectory.dirpath] + [
+            getattr(MediaFile, f) for f in FILE_FIELDS
+        ]
+        return (
+            select(*columns)
+            .join(MediaDirectory, MediaDirectory.id == MediaFile.directory_id)
+            .where(MediaFile.id > after_id)
+            .order_by(MediaFile.id)
+        )
+    if kind == USER:
+        columns = [User.id] + [getattr(User, f) for f in USER_FIELDS]
+        return select(*columns).where(User.id > after_id).order_by(User.id)
+    model, fields = {
+        COMMENT: (Comments, COMMENT_FIELDS),
+        STAR: (Stars, STAR_FIELDS),
+        LIKE: (Likes, LIKE_FIELDS),
+    }[kind]
+    # social rows name their file and user; the catalog and users databases
+    # are attached to the social connection so this is one statement
+    columns = [model.id, MediaFile.filepath, User.username] + [getattr(model, f) for f in fields]
+    return (
+        select(*columns)
+        .outerjoin(MediaFile, MediaFile.id == model.media_file_id)
+        .outerjoin(User, User.id == model.user_id)
+        .where(model.id > after_id)
+        .order_by(model.id)
+    )
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _last_record(path):
+    """
+    Find the last complete line of a partly written dump, dropping anything after it.
+
+    Returns:
+        dict: The last record, or None if the file has no complete line.
+    """
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        tail = b""
+        while position > 0:
+            step = min(65536, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+            # the last newline, then the one before it
+            last = tail.rfind(b"\n")
+            if last == -1:
+                continue
+            previous = tail.rfind(b"\n", 0, last)
+            if previous != -1 or position == 0:
+                break
+        last = tail.rfind(b"\n")
+        if last == -1:
+            f.truncate(0)
+            return None
+        f.truncate(position + last + 1)
+        line = tail[tail.rfind(b"\n", 0, last) + 1 : last]
+    return json.loads(line)
+
+
+def export_catalog(path, resume=False):
+    """
+    Write the catalog and social data to a JSONL dump.
+
+    Must be called inside an app context.
+
+    Args:
+        path (str): The dump file.
+        resume (bool, optional): Carry on an interrupted export of path instead
+            of starting over.  Defaults to False.
+
+    Returns:
+        dict: Records written by this run, by kind.
+    """
+    from hooli_colab import db
+
+    start_kind, after_id = KINDS[0], 0
+    mode = "w"
+    if resume and os.path.exists(path):
+        last = _last_record(path)
+        if last is not None:
+            if last["type"] == "end":
+                return {kind: 0 for kind in KINDS}
+            if last["type"] in KINDS:
+                start_kind, after_id = last["type"], last["id"]
+            mode = "a"
+
+    counts = {kind: 0 for kind in KINDS}
+    with open(path, mode, encoding="utf-8", buffering=1024 * 1024) as out:
+        if mode == "w":
+            header = {
+                "type": "header",
+                "format": FORMAT,
+                "version": FORMAT_VERSION,
+                "exported_at": datetime.now(timezone.utc).isoformat(),
+            }
+            out.write(json.dumps(header) + "\n")
+        for kind in KINDS[KINDS.index(start_kind) :]:
+            query = _export_query(kind, after_id if kind == start_kind else 0)
+            result = db.session.execute(query, execution_options={"yield_per": EXPORT_CHUNK})
+            keys = ["id"] + list(result.keys())[1:]
+            for row in result:
+                record = {"type": kind}
+                record.update(zip(keys, map(_json_value, row)))
+                out.write(json.dumps(record, separators=(",", ":")) + "\n")
+                counts[kind] += 1
+            result.close()
+            # don't hold a read transaction open across the whole export
+            db.session.commit()
+        out.write(json.dumps({"type": "end"}) + "\n")
+    return counts
+
+
+def _parse_timestamps(rows):
+    for row in rows:
+        if row.get("timestamp"):
+            row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+
+
+def _lookup(column, key_column, keys):
+    """map of key -> id for the keys that exist"""
+    from hooli_colab import db
+
+    if not keys:
+        return {}
+    return dict(
+        (key, row_id)
+        for row_id, key in db.session.execute(
+            select(column, key_column).where(key_column.in_(keys))
+        )
+    )
+
+
+def _load_directories(records):
+    from hooli_colab import db
+
+    rows = [{f: r.get(f) for f in DIRECTORY_FIELDS} for r in records]
+    # keep stored slugs, unless another directory already has one
+    slugs = {row["slug"] for row in rows if row["slug"] is not None}
+    if slugs:
+        owners = {
+            slug: dirpath
+            for slug, dirpath in db.session.execute(
+                select(MediaDirectory.slug, MediaDirectory.dirpath).where(
+                    MediaDirectory.slug.in_(slugs)
+                )
+            )
+        }
+        for row in rows:
+            if row["slug"] in owners and owners[row["slug"]] != row["dirpath"]:
+                row["slug"] = None
+    result = db.session.execute(
+        insert(MediaDirectory.__table__).on_conflict_do_nothing(index_elements=["dirpath"]),
+        rows,
+    )
+    return result.rowcount, len(rows) - result.rowcount
+
+
+def _load_files(records):
+    from hooli_colab import db
+    from hooli_colab.indexer import get_or_create_directory
+
+    dirpaths = {r["dirpath"] for r in records}
+    directory_ids = _lookup(MediaDirectory.id, MediaDirectory.dirpath, dirpaths)
+    for dirpath in dirpaths - set(directory_ids):
+        directory_ids[dirpath] = get_or_create_directory(dirpath, commit=False).id
+
+    rows = []
+    for record in records:
+        row = {f: record.get(f) for f in FILE_FIELDS}
+        row["directory_id"] = directory_ids[record["dirpath"]]
+        rows.append(row)
+    # keep stored slugs, unless another file in the directory already has one
+    pairs = {(row["directory_id"], row["slug"]) for row in rows if row["slug"] is not None}
+    if pairs:
+        owners = {
+            (directory_id, slug): filepath
+            for directory_id, slug, filepath in db.session.execute(
+                select(MediaFile.directory_id, MediaFile.slug, MediaFile.filepath).where(
+                    tuple_(MediaFile.directory_id, MediaFile.slug).in_(pairs)
+                )
+            )
+        }
+        for row in rows:
+            owner = owners.get((row["directory_id"], row["slug"]))
+            if owner is not None and owner != row["filepath"]:
+                row["slug"] = None
+    result = db.session.execute(
+        insert(MediaFile.__table__).on_conflict_do_nothing(index_elements=["filepath"]),
+        rows,
+    )
+    return result.rowcount, len(rows) - result.rowcount
+
+
+def _load_users(records, create_users):
+    from hooli_colab import db
+
+    if not create_users:
+        return 0, len(records)
+    existing = _lookup(User.id, User.username, {r["username"] for r in records})
+    rows = [
+        {"username": r["username"], "email": r.get("email"), "active": False}
+        for r in records
+        if r["username"] not in existing
+    ]
+    for row in rows:
+        row["fs_uniquifier"] = str(uuid.uuid4())
+    if not rows:
+        return 0, len(records)
+    # OR IGNORE: an email that's already someone else's leaves that user out
+    result = db.session.execute(insert(User.__table__).prefix_with("OR IGNORE"), rows)
+    return result.rowcount, len(records) - result.rowcount
+
+
+def _load_social(kind, records):
+    from hooli_colab import db
+
+    model, fields = {
+        COMMENT: (Comments, COMMENT_FIELDS),
+        STAR: (Stars, STAR_FIELDS),
+        LIKE: (Likes, LIKE_FIELDS),
+    }[kind]
+    file_ids = _lookup(
+        MediaFile.id,
+        MediaFile.filepath,
+        {r["filepath"] for r in records if r.get("filepath")},
+    )
+    user_ids = _lookup(
+        User.id, User.username, {r["username"] for r in records if r.get("username")}
+    )
+    rows = []
+    for record in records:
+        media_file_id = file_ids.get(record.get("filepath"))
+        user_id = user_ids.get(record.get("username"))
+        if media_file_id is None or user_id is None:
+            continue
+        row = {f: record.get(f) for f in fields}
+        row["media_file_id"] = media_file_id
+        row["user_id"] = user_id
+        rows.append(row)
+    _parse_timestamps(rows)
+
+    if kind == COMMENT and rows:
+        # comments have no natural key; one by the same user on the same file
+        # at the same moment is taken to be the same comment, so loading a
+        # dump twice (or resuming one) doesn't duplicate them
+        # the window is narrowed in SQL and matched here, since stored
+        # timestamps aren't always in the format a bound datetime compares as
+        timestamps = [row["timestamp"] for row in rows]
+        seen = set(
+            tuple(key)
+            for key in db.session.execute(
+                select(Comments.media_file_id, Comments.user_id, Comments.timestamp).where(
+                    Comments.media_file_id.in_({row["media_file_id"] for row in rows}),
+                    Comments.timestamp.between(
+                        min(timestamps) - timedelta(seconds=1),
+                        max(timestamps) + timedelta(seconds=1),
+                    ),
+                )
+            )
+        )
+        rows = [
+            row
+            for row in rows
+            if (row["media_file_id"], row["user_id"], row["timestamp"]) not in seen
+        ]
+    if not rows:
+        return 0, len(records)
+    statement = insert(model.__table__)
+    if kind != COMMENT:
+        # keep the rating or like already there
+        statement = statement.on_conflict_do_nothing(index_elements=["media_file_id", "user_id"])
+    result = db.session.execute(statement, rows)
+    return result.rowcount, len(records) - result.rowcount
+
+
+def progress_path(path):
+    """where import_catalog records how far it got"""
+    return path + ".progress"
+
+
+def import_catalog(path, batch_size=5000, resume=False, create_users=False):
+    """
+    Load a JSONL dump, in batches of one kind of record, one transaction each.
+
+    Directories and files are matched to existing ones by dirpath and
+    filepath; ratings and likes by file and user, keeping what's there.
+    Comments, ratings and likes whose file or user isn't in the database
+    are skipped.  Must be called inside an app context.
+
+    Args:
+        path (str): The dump file.
+        batch_size (int, optional): Records per transaction.  Defaults to 5000.
+        resume (bool, optional): Start after the last batch a previous run of
+            this dump committed.  Defaults to False.
+        create_users (bool, optional): Create missing users as inactive
+            accounts with no password.  Defaults to False, which skips their
+            comments, ratings and likes.
+
+    Returns:
+        dict: {kind: [loaded, skipped]} over the whole dump, skipped counting
+            rows already there as well as unresolved ones, and "complete",
+            False if the dump ended without its end line.
+
+    Raises:
+        DumpError: If the file isn't a hooli dump.
+    """
+    from hooli_colab import db
+    from hooli_colab.slugs import assign_slugs, bump_catalog_version
+
+    state_path = progress_path(path)
+    state = {"offset": 0, "counts": {kind: [0, 0] for kind in KINDS}}
+    if resume and os.path.exists(state_path):
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+    counts = state["counts"]
+
+    def save_state(offset):
+        state["offset"] = offset
+        temporary = state_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(temporary, state_path)
+
+    def flush(kind, records, offset):
+        if kind == DIRECTORY:
+            loaded, skipped = _load_directories(records)
+        elif kind == FILE:
+            loaded, skipped = _load_files(records)
+        elif kind == USER:
+            loaded, skipped = _load_users(records, create_users)
+        else:
+            loaded, skipped = _load_social(kind, records)
+        if kind in (DIRECTORY, FILE) and loaded:
+            bump_catalog_version(db.session)
+        db.session.commit()
+        counts[kind][0] += loaded
+        counts[kind][1] += skipped
+        save_state(offset)
+
+    complete = False
+    with open(path, "rb") as f:
+        first = f.readline()
+        try:
+            header = json.loads(first)
+        except ValueError:
+            header = None
+        if not header or header.get("format") != FORMAT:
+            raise DumpError(f"{path} isn't a {FORMAT} dump")
+        if header.get("version", 0) > FORMAT_VERSION:
+            raise DumpError(f"{path} is format version {header['version']}, too new")
+        offset = max(state["offset"], len(first))
+        f.seek(offset)
+        kind, records = None, []
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # a partly written last line, from an export that was cut off
+            record = json.loads(line)
+            if record["type"] != kind or len(records) >= batch_size:
+                if records:
+                    flush(kind, records, offset)
+                kind, records = record["type"], []
+            offset += len(line)
+            if kind == "end":
+                complete = True
+                break
+            if kind not in KINDS:
+                raise DumpError(f"unknown record type {kind!r} at byte {offset - len(line)}")
+            records.append(record)
+        if records:
+            flush(kind, records, offset)
+
+    if complete and os.path.exists(state_path):
+        os.remove(state_path)
+    assign_slugs()
+    return {"complete": complete, **counts}
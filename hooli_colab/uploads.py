@@ -0,0 +1,334 @@
+""" hooli uploads: resumable chunked uploads of audio files into a directory
+
+An upload goes in three steps, all JSON:
+
+    POST /api/uploads                 {"directory_id", "filename", "size", "sha256"}
+    PUT  /api/uploads/<id>            one chunk, with Content-Range: bytes start-end/size
+    POST /api/uploads/<id>/complete
+
+Chunks are streamed from the request straight into a staging file under
+UPLOAD_STAGING_DIR, never held in memory, and each must start where the last
+one ended; GET /api/uploads/<id> says where that is, so an interrupted upload
+carries on from the last chunk that made it.  A chunk may carry an
+X-Chunk-SHA256 header, and is cut off again if it doesn't match.
+
+Completing checks the size and the whole file's SHA-256, links the staging
+file into the directory's folder (failing rather than overwriting if
+something's already there), and creates its MediaFile with the stat and hash
+the indexer would have recorded, so "flask index" has nothing to redo.
+Loudness analysis is queued rather than run while the client waits.
+
+The staging file and a small JSON description of the upload are all the
+state there is, so any worker process can take any chunk.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+from hooli_colab.indexer import HASH_CHUNK_SIZE, hash_file
+from hooli_colab.models import MediaDirectory, MediaFile
+from hooli_colab.storage import path_taken
+
+
+class UploadError(Exception):
+    """
+    Raised when an upload request can't be carried out.
+
+    Attributes:
+        status (int): The HTTP status to answer with.
+        offset (int): Where the staging file ends, for a chunk that didn't start there.
+    """
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def staging_dir(config):
+    """where uploads are staged: UPLOAD_STAGING_DIR, or .uploads in the media root"""
+    # the indexer skips dot directories, and being on the media root's
+    # filesystem lets completing an upload be a link instead of a copy
+    return config["UPLOAD_STAGING_DIR"] or os.path.join(config["MEDIA_ROOT"], ".uploads")
+
+
+def _paths(config, upload_id):
+    if not upload_id.isalnum():
+        raise UploadError("no such upload", 404)
+    base = os.path.join(staging_dir(config), upload_id)
+    return base + ".json", base + ".part"
+
+
+def _load(config, upload_id):
+    info_path, part_path = _paths(config, upload_id)
+    try:
+        with open(info_path, encoding="utf-8") as f:
+            return json.load(f), part_path
+    except FileNotFoundError:
+        raise UploadError("no such upload", 404)
+
+
+def prune_stale_uploads(config, now=None):
+    """
+    Delete staged uploads nobody has added to for UPLOAD_STALE_HOURS.
+
+    Returns:
+        int: The number deleted.
+    """
+    directory = staging_dir(config)
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = (now or time.time()) - config["UPLOAD_STALE_HOURS"] * 3600
+    pruned = 0
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        upload_id = name[: -len(".json")]
+        info_path, part_path = _paths(config, upload_id)
+        try:
+            latest = max(os.path.getmtime(p) for p in (info_path, part_path) if os.path.exists(p))
+        except ValueError:
+            continue
+        if latest < cutoff:
+            for path in (part_path, info_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            pruned += 1
+    return pruned
+
+
+def start_upload(config, directory_id, filename, size, sha256=None, user_id=None):
+    """
+    Create an upload.
+
+    Args:
+        config (dict): The app's config.
+        directory_id (int): The MediaDirectory the file goes into.
+        filename (str): The file's name; made safe with secure_filename.
+        size (int): The file's size in bytes.
+        sha256 (str, optional): The whole file's hex SHA-256, checked on completion.
+        user_id (int, optional): Who's uploading.
+
+    Returns:
+        dict: {"upload_id", "offset", "size", "chunk_size"}.
+
+    Raises:
+        UploadError: If the directory, name, size or checksum won't do.
+    """
+    from hooli_colab import db
+
+    directory = db.session.get(MediaDirectory, directory_id) if directory_id is not None else None
+    if directory is None:
+        raise UploadError("no such directory", 404)
+    filename = secure_filename(filename or "")
+    if not filename.lower().endswith(tuple(config["UPLOAD_EXTENSIONS"])):
+        raise UploadError(f"only {', '.join(config['UPLOAD_EXTENSIONS'])} files can be uploaded")
+    if not isinstance(size, int) or size <= 0 or size > config["UPLOAD_MAX_BYTES"]:
+        raise UploadError(f"size must be between 1 and {config['UPLOAD_MAX_BYTES']} bytes")
+    if sha256 is not None:
+        sha256 = str(sha256).lower()
+        if len(sha256) != 64 or not all(c in "0123456789abcdef" for c in sha256):
+            raise UploadError("sha256 must be 64 hex digits")
+    filepath = filename if directory.dirpath == "." else f"{directory.dirpath}/{filename}"
+    if MediaFile.query.filter_by(filepath=filepath).first() is not None or path_taken(
+        config, filepath
+    ):
+        raise UploadError(f"{filepath} already exists", 409)
+
+    prune_stale_uploads(config)
+    os.makedirs(staging_dir(config), exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    info_path, part_path = _paths(config, upload_id)
+    info = {
+        "directory_id": directory.id,
+        "filepath": filepath,
+        "size": size,
+        "sha256": sha256,
+        "user_id": user_id,
+    }
+    open(part_path, "wb").close()
+    with open(info_path, "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    return {
+        "upload_id": upload_id,
+        "offset": 0,
+        "size": size,
+        "chunk_size": config["UPLOAD_CHUNK_BYTES"],
+    }
+
+
+def upload_status(config, upload_id):
+    """{"upload_id", "offset", "size"}: how much of the upload has arrived"""
+    info, part_path = _load(config, upload_id)
+    return {"upload_id": upload_id, "offset": os.path.getsize(part_path), "size": info["size"]}
+
+
+def parse_content_range(header):
+    """
+    Parse "bytes start-end/size".
+
+    Returns:
+        tuple: (start, end exclusive, size).
+
+    Raises:
+        UploadError: If the header is missing or malformed.
+    """
+    try:
+        unit, _, spec = header.partition(" ")
+        span, _, size = spec.partition("/")
+        first, _, last = span.partition("-")
+        start, end, size = int(first), int(last) + 1, int(size)
+    except (AttributeError, ValueError):
+        raise UploadError("Content-Range must be bytes start-end/size")
+    if unit != "bytes" or start < 0 or end <= start:
+        raise UploadError("Content-Range must be bytes start-end/size")
+    return start, end, size
+
+
+def write_chunk(config, upload_id, stream, content_range, chunk_sha256=None):
+    """
+    Append one chunk from a request stream to the staging file.
+
+    Args:
+        config (dict): The app's config.
+        upload_id (str): The upload.
+        stream (file): The request body, read a piece at a time.
+        content_range (str): The Content-Range header.
+        chunk_sha256 (str, optional): The chunk's hex SHA-256.
+
+    Returns:
+        dict: upload_status after the chunk.
+
+    Raises:
+        UploadError: 409 with the current offset if the chunk doesn't start
+            where the staging file ends, 400 if it's malformed, too big or
+            its checksum is wrong (the chunk is then dropped).
+    """
+    info, part_path = _load(config, upload_id)
+    start, end, size = parse_content_range(content_range)
+    if size != info["size"] or end > size:
+        raise UploadError("Content-Range doesn't fit the upload's size")
+    if end - start > config["UPLOAD_CHUNK_BYTES"]:
+        raise UploadError(f"chunks can be at most {config['UPLOAD_CHUNK_BYTES']} bytes")
+
+    with open(part_path, "r+b") as f:
+        # one writer per upload at a time, even across processes
+        fcntl.flock(f, fcntl.LOCK_EX)
+        offset = f.seek(0, os.SEEK_END)
+        if start != offset:
+            raise UploadError("chunk doesn't start at the upload's offset", 409, offset)
+        digest = hashlib.sha256()
+        remaining = end - start
+        while remaining:
+            piece = stream.read(min(HASH_CHUNK_SIZE, remaining))
+            if not piece:
+                break
+            f.write(piece)
+            digest.update(piece)
+            remaining -= len(piece)
+        if remaining or stream.read(1):
+            f.truncate(start)
+            raise UploadError("the body isn't the length Content-Range says")
+        if chunk_sha256 and digest.hexdigest() != chunk_sha256.lower():
+            f.truncate(start)
+            raise UploadError("chunk checksum mismatch")
+    return upload_status(config, upload_id)
+
+
+def _link_into_place(part_path, target_path):
+    """move the staged file to target_path, failing if target_path exists"""
+    try:
+        # link never replaces, so a file that turned up meanwhile is kept
+        os.link(part_path, target_path)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            raise UploadError(f"{target_path} already exists", 409)
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+            raise
+        # staging is on another filesystem (or it can't do links): copy next to
+        # the target first so the last step is still one rename
+        temporary = os.path.join(
+            os.path.dirname(target_path), f".{os.path.basename(target_path)}.{os.getpid()}.part"
+        )
+        shutil.copyfile(part_path, temporary)
+        if os.path.exists(target_path):
+            os.remove(temporary)
+            raise UploadError(f"{target_path} already exists", 409)
+        os.replace(temporary, target_path)
+    os.remove(part_path)
+
+
+def complete_upload(config, upload_id):
+    """
+    Check a fully sent upload, move it into its directory and add its MediaFile.
+
+    Must be called inside an app context.
+
+    Args:
+        config (dict): The app's config.
+        upload_id (str): The upload.
+
+    Returns:
+        MediaFile: The new media file.
+
+    Raises:
+        UploadError: If it isn't all there, the checksum doesn't match (the
+            upload is then discarded), or the file already exists.
+    """
+    from hooli_colab import db
+    from hooli_colab.analysis import queue_analysis
+    from hooli_colab.slugs import assign_slugs
+
+    info, part_path = _load(config, upload_id)
+    info_path = _paths(config, upload_id)[0]
+    with open(part_path, "r+b") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        received = f.seek(0, os.SEEK_END)
+        if received != info["size"]:
+            raise UploadError(f"only {received} of {info['size']} bytes have arrived", 409, received)
+        content_hash = hash_file(part_path)
+        if info["sha256"] and content_hash != info["sha256"]:
+            os.remove(part_path)
+            os.remove(info_path)
+            raise UploadError("checksum mismatch, upload it again")
+
+        directory = db.session.get(MediaDirectory, info["directory_id"])
+        if directory is None:
+            raise UploadError("the directory has gone", 404)
+        target_path = os.path.join(config["MEDIA_ROOT"], info["filepath"])
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        _link_into_place(part_path, target_path)
+    os.remove(info_path)
+
+    st = os.stat(target_path)
+    filename = os.path.basename(info["filepath"])
+    media_file = MediaFile(
+        directory_id=directory.id,
+        filepath=info["filepath"],
+        filename=filename,
+        filetype=filename.rsplit(".", 1)[-1],
+        filesize=st.st_size,
+        mtime=st.st_mtime,
+        inode=st.st_ino,
+        content_hash=content_hash,
+    )
+    db.session.add(media_file)
+    db.session.commit()
+    assign_slugs()
+    queue_analysis([media_file.id])
+    return media_file
+
+
+def cancel_upload(config, upload_id):
+    """throw away an upload and what's arrived of it"""
+    for path in _paths(config, upload_id):
+        if os.path.exists(path):
+            os.remove(path)